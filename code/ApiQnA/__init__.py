@@ -1,31 +1,85 @@
 '''Main function for QnA API Azure Function App'''
 import os
-from utilities.helper import LLMHelper
+import json
+import base64
+import asyncio
+from utilities.helper import get_llm_helper
+from utilities.streaming import format_server_sent_event
+from utilities.filters import normalize_filters
 import azure.functions
 from dotenv import load_dotenv
 load_dotenv()
 
 
-def main(req: azure.functions.HttpRequest) -> str:
-    'Main function for QnA API Azure Function App'
+async def stream_answer(llm_helper, question, history, filters):
+    '''Yield the answer as server-sent events, the sources first and then the tokens.
+
+    The response is buffered SSE-formatted output, main sends every event at once when the answer is complete.
+    '''
+    async for event in llm_helper.astream_semantic_answer(question, history, filters=filters):
+        if event['type'] == 'sources':
+            yield format_server_sent_event('sources', {'sources': event['sources'],
+                                                       'context': event['context']})
+        elif event['type'] == 'token':
+            yield format_server_sent_event('token', event['token'])
+        else:
+            yield format_server_sent_event('done', {'question': event['question'],
+                                                    'response': event['answer']})
+
+
+def get_principal_groups(req: azure.functions.HttpRequest) -> list:
+    '''AAD groups of the caller signed in with App Service Authentication, none for other callers.
+
+    App Service only strips a forged X-MS-CLIENT-PRINCIPAL header when its authentication is enabled,
+    the header is ignored otherwise.
+    '''
+    principal = req.headers.get('X-MS-CLIENT-PRINCIPAL')
+    if not principal or os.getenv('WEBSITE_AUTH_ENABLED', '').lower() != 'true':
+        return []
+    claims = json.loads(base64.b64decode(principal)).get('claims', [])
+    return [claim['val'] for claim in claims if claim.get('typ') == 'groups']
+
+
+async def main(req: azure.functions.HttpRequest) -> azure.functions.HttpResponse:
+    '''Main function for QnA API Azure Function App, the worker serves other requests while this one waits.
+
+    With stream, the body is SSE-formatted but buffered: it is sent when the whole answer is complete,
+    with no earlier first token than the plain answer.
+    '''
     # Get data from POST request
     try:
         req_body = req.get_json()
     except ValueError:
-        pass
+        return azure.functions.HttpResponse('The body must be a JSON object', status_code=400)
     else:
+        if not isinstance(req_body, dict):
+            return azure.functions.HttpResponse('The body must be a JSON object', status_code=400)
         question = req_body.get('question')
         history = req_body.get('history', [])
         custom_prompt = req_body.get('custom_prompt', '')
+        stream = req_body.get('stream', False)
+        # Metadata filters: filenames, tags, ingested_after and ingested_before
+        filters = req_body.get('filters')
         custom_temperature = float(req_body.get('custom_temperature',
                                                 os.getenv('OPENAI_TEMPERATURE', '0.7')))
-    # Create LLMHelper object
-    llm_helper = LLMHelper(custom_prompt=custom_prompt, temperature=custom_temperature)
+    try:
+        filters = normalize_filters(filters)
+    except (TypeError, ValueError) as exc:
+        return azure.functions.HttpResponse(f'Invalid filters: {exc}', status_code=400)
+    # The caller cannot choose its groups, only the public documents are searched for anonymous callers
+    filters['groups'] = get_principal_groups(req)
+    # Reuse the warm LLMHelper of this worker, only the prompt and temperature vary per request
+    llm_helper = await asyncio.to_thread(get_llm_helper, custom_prompt=custom_prompt, temperature=custom_temperature)
+    if stream:
+        # Not streamed: the Python v1 programming model buffers the body, the events are sent when the answer is complete
+        events = [event async for event in stream_answer(llm_helper, question, history, filters)]
+        return azure.functions.HttpResponse(''.join(events),
+                                            mimetype='text/event-stream')
     # Get answer
     data = {}
     data['question'], \
     data['response'], \
     data['context'], \
-    data["sources"] = llm_helper.get_semantic_answer_lang_chain(question, history)
+    data["sources"] = await llm_helper.aget_semantic_answer(question, history, filters)
     # Return answer
-    return f'{data}'
+    return azure.functions.HttpResponse(f'{data}')
@@ -1,27 +1,32 @@
 '''Function to add embeddings to the LLM'''
+import asyncio
 import logging
 import json
 import azure.functions as func
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 
-def main(msg: func.QueueMessage) -> None:
+async def main(msg: func.QueueMessage) -> None:
     'Main function to add embeddings to the LLM'
     logging.info('Python queue trigger function processed a queue item: %s',
                  msg.get_body().decode('utf-8'))
 
-    # Set up LLM Helper
-    llm_helper = LLMHelper()
+    # Reuse the warm LLM Helper of this worker across queue messages
+    llm_helper = await asyncio.to_thread(get_llm_helper)
     # Get the file name from the message
     file_name = json.loads(msg.get_body().decode('utf-8'))['filename']
     # Generate the SAS URL for the file
     file_sas = llm_helper.blob_client.get_blob_sas(file_name)
+    # Tags and groups allowed to read the file, comma separated in the blob metadata
+    blob_metadata = await asyncio.to_thread(llm_helper.blob_client.get_blob_metadata, file_name)
+    tags, groups = blob_metadata.get('tags'), blob_metadata.get('groups')
 
     # Check the file extension
     if file_name.endswith('.txt'):
         # Add the text to the embeddings
-        llm_helper.add_embeddings_lc(file_sas)
+        await llm_helper.aadd_embeddings_lc(file_sas, tags=tags, groups=groups)
     else:
         # Get OCR with Layout API and then add embeddigns
-        llm_helper.convert_file_and_add_embeddings(file_sas , file_name)
+        await llm_helper.aconvert_file_and_add_embeddings(file_sas , file_name, tags=tags, groups=groups)
 
-    llm_helper.blob_client.upsert_blob_metadata(file_name, {'embeddings_added': 'true'})
+    await asyncio.to_thread(llm_helper.blob_client.upsert_blob_metadata,
+                            file_name, {'embeddings_added': 'true'})
@@ -4,24 +4,24 @@ import json
 import os
 import azure.functions as func
 from azure.storage.queue import QueueClient, BinaryBase64EncodePolicy
-from utilities.helper import LLMHelper
+from utilities.azureblobstorage import AzureBlobStorageClient
 
 queue_name = os.environ['QUEUE_NAME']
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     'Main function for BatchStartProcessing Azure Function App'
     logging.info('Requested to start processing all documents received')
-    # Set up LLM Helper
-    llm_helper = LLMHelper()
+    # Only the blob listing is needed, the LLM Helper is not loaded here
+    blob_client = AzureBlobStorageClient()
     # Get all files from Blob Storage
-    files_data = llm_helper.blob_client.get_all_files()
+    files_data = blob_client.get_all_files()
     # Filter out files that have already been processed
     files_data = list(filter(lambda x : not x['embeddings_added'], files_data)) \
                         if req.params.get('process_all') != 'true' else files_data
     files_data = list(map(lambda x: {'filename': x['filename']}, files_data))
     # Create the QueueClient object
     queue_client = QueueClient.from_connection_string(
-                        llm_helper.blob_client.connect_str,
+                        blob_client.connect_str,
                         queue_name,
                         message_encode_policy=BinaryBase64EncodePolicy()
                     )
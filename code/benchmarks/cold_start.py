@@ -0,0 +1,60 @@
+'''Measure the import time of the Azure Function App entry points on a cold interpreter
+
+Run from the code folder:
+    python benchmarks/cold_start.py --repeat 5
+'''
+
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+ENTRY_POINTS = ['BatchStartProcessing', 'BatchPushResults', 'ApiQnA', 'utilities.helper']
+HEAVY_MODULES = ['pandas', 'bs4', 'fake_useragent', 'langchain.document_loaders',
+                 'azure.ai.formrecognizer', 'azure.search.documents', 'utilities.translator']
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+# The entry points read these settings when they are imported
+DEFAULT_ENV = {'QUEUE_NAME': 'doc-processing'}
+
+
+def measure(module, python=sys.executable):
+    'Import the module in a new interpreter, return the cumulative import time in ms and the heavy modules loaded'
+    env = {**DEFAULT_ENV, **os.environ}
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([python, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    total = 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        # Top level imports are the ones without indentation
+        if match and match.group(3) == ' ':
+            total += int(match.group(2))
+    return total / 1000, [m for m in result.stdout.strip().split(',') if m]
+
+
+def main():
+    'Print the median import time of every entry point'
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='Number of cold imports per entry point')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='Modules to import')
+    args = parser.parse_args()
+
+    print(f"{'entry point':<24} {'median ms':>10} {'min ms':>10}  heavy modules loaded")
+    for module in args.modules:
+        try:
+            runs = [measure(module) for _ in range(args.repeat)]
+        except RuntimeError as exc:
+            print(f"{module:<24} {'failed':>10} {'':>10}  {exc}")
+            continue
+        times = [t for t, _ in runs]
+        print(f"{module:<24} {statistics.median(times):>10.1f} {min(times):>10.1f}  {', '.join(runs[-1][1]) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''Compare the recall, latency and memory of Redis vector index settings
+
+Run from the code folder against a Redis Stack instance that can hold the test indexes:
+    python benchmarks/redis_index.py --redis-url redis://localhost:6379 --vectors 20000 \\
+        FLAT:FLOAT32 HNSW:FLOAT32:m=16,ef_construction=200,ef_runtime=10 HNSW:FLOAT16:m=16,ef_runtime=50
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import redis
+from redis.commands.search.query import Query
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from utilities.redis import VECTOR_DTYPES, create_vector_field, get_vector_index_settings, knn_query
+
+
+def parse_settings(spec, dimensions, count):
+    'Parse ALGORITHM:TYPE[:name=value,...] into index settings'
+    parts = spec.split(':')
+    settings = {**get_vector_index_settings(), 'algorithm': parts[0].upper(), 'vector_type': parts[1].upper(),
+                'dimensions': dimensions, 'initial_cap': count}
+    for option in parts[2].split(',') if len(parts) > 2 else []:
+        name, value = option.split('=')
+        settings[name.lower()] = int(value)
+    return settings
+
+
+def make_vectors(count, dimensions, clusters, seed):
+    'Clustered unit vectors, closer to real embeddings than uniform noise'
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimensions))
+    vectors = centers[rng.integers(clusters, size=count)] + rng.normal(scale=0.5, size=(count, dimensions))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def load_vectors(client, pattern, dimensions):
+    'Read the float32 vectors stored in the hashes matching the pattern'
+    keys = list(client.scan_iter(match=pattern, count=1000))
+    pipeline = client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hget(key, 'content_vector')
+    vectors = [np.frombuffer(value, dtype=np.float32) for value in pipeline.execute() if value]
+    vectors = np.array([vector for vector in vectors if len(vector) == dimensions], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(client, name, settings, vectors, queries, truth, k):
+    'Build an index with the settings and measure it'
+    prefix = f"bench:{name}:"
+    client.ft(name).create_index(
+        fields=[create_vector_field('content_vector', settings)],
+        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH))
+    dtype = VECTOR_DTYPES[settings['vector_type']]
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(vectors), 1000):
+            pipeline = client.pipeline(transaction=False)
+            for j, vector in enumerate(vectors[i:i + 1000], start=i):
+                pipeline.hset(f"{prefix}{j}", mapping={'content_vector': vector.astype(dtype).tobytes()})
+            pipeline.execute()
+        while int(client.ft(name).info().get('indexing', 0)):
+            time.sleep(0.1)
+        load_time = time.perf_counter() - start
+
+        query = Query(knn_query(k, settings)).return_fields('vector_score').sort_by('vector_score')\
+            .paging(0, k).dialect(2)
+        latencies, recalls = [], []
+        for vector, expected in zip(queries, truth):
+            start = time.perf_counter()
+            results = client.ft(name).search(query, {'vector': vector.astype(dtype).tobytes()})
+            latencies.append((time.perf_counter() - start) * 1000)
+            found = {int(doc.id[len(prefix):]) for doc in results.docs}
+            recalls.append(len(found & set(expected.tolist())) / k)
+        info = client.ft(name).info()
+        return {'recall': np.mean(recalls), 'p50': np.percentile(latencies, 50),
+                'p95': np.percentile(latencies, 95), 'load_s': load_time,
+                'index_mb': float(info.get('vector_index_sz_mb', 0)),
+                'hash_mb': client.memory_usage(f"{prefix}0") * len(vectors) / 2 ** 20}
+    finally:
+        client.ft(name).dropindex(delete_documents=True)
+
+
+def main():
+    'Print a comparison of the index settings'
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default=os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    parser.add_argument('--vectors', type=int, default=20000, help='Number of synthetic vectors')
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--source-pattern', help='Benchmark the vectors of these keys instead, e.g. doc:embeddings:*')
+    parser.add_argument('settings', nargs='*', default=['FLAT:FLOAT32', 'HNSW:FLOAT32', 'HNSW:FLOAT16'],
+                        help='Index settings as ALGORITHM:TYPE[:m=16,ef_construction=200,ef_runtime=10]')
+    args = parser.parse_args()
+
+    client = redis.from_url(args.redis_url)
+    vectors = load_vectors(client, args.source_pattern, args.dimensions) if args.source_pattern \
+        else make_vectors(args.vectors, args.dimensions, clusters=max(args.vectors // 100, 1), seed=0)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+    # Exact neighbours, also the latency of an embedded brute force search
+    start = time.perf_counter()
+    scores = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ vectors.T
+    truth = np.argsort(-scores, axis=1)[:, :args.k]
+    brute_force_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries, k={args.k}")
+    print(f"{'settings':<48} {'recall':>7} {'p50 ms':>7} {'p95 ms':>7} {'load s':>7} {'index MB':>9} {'hash MB':>8}")
+    print(f"{'numpy brute force (in process)':<48} {1.0:>7.3f} {brute_force_ms:>7.2f} {'':>7} {'':>7} "
+          f"{vectors.nbytes / 2 ** 20:>9.1f} {'':>8}")
+    for i, spec in enumerate(args.settings):
+        settings = parse_settings(spec, vectors.shape[1], len(vectors))
+        result = benchmark(client, f"bench-index-{i}", settings, vectors, queries, truth, args.k)
+        print(f"{spec:<48} {result['recall']:>7.3f} {result['p50']:>7.2f} {result['p95']:>7.2f} "
+              f"{result['load_s']:>7.1f} {result['index_mb']:>9.1f} {result['hash_mb']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@
 import os
 import streamlit as st
 from streamlit_chat import message
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
+from utilities.chathistory import ChatHistory
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
@@ -16,6 +17,7 @@ def clear_chat_data():
     st.session_state['input'] = ""
     st.session_state['chat_history'] = []
     st.session_state['source_documents'] = []
+    st.session_state['compact_history'].clear()
 
 
 set_st_auth_vars()
@@ -30,18 +32,39 @@ if os.getenv('AAD_General_SG') in st.session_state["user_groups"] or \
     if 'source_documents' not in st.session_state:
         st.session_state['source_documents'] = []
 
-    llm_helper = LLMHelper()
+    llm_helper = get_llm_helper()
+
+    # History sent to the model, older turns are folded into a summary to bound the prompt size
+    if 'compact_history' not in st.session_state:
+        st.session_state['compact_history'] = ChatHistory(summarize=llm_helper.get_completion)
 
     # Chat
     st.text_input("You: ",
                   placeholder="type your question",
                   key="input", on_change=clear_text_input)
     clear_chat = st.button("Clear chat", key="clear_chat", on_click=clear_chat_data)
+    st.text_input("Tags", key="filter_tags", placeholder="hr, policies",
+                  help="Only answer from the documents with one of these comma separated tags")
+    # Only the documents readable by the groups of the user are retrieved
+    filters = {'groups': st.session_state['user_groups'], 'tags': st.session_state['filter_tags']}
 
     if st.session_state['question']:
-        question, result, _, sources = llm_helper.get_semantic_answer_lang_chain(
-            st.session_state['question'], st.session_state['chat_history'])
+        # Answer each submitted question once, other widgets like the tags also rerun the page
+        new_question, st.session_state['question'] = st.session_state['question'], None
+        # Show the answer token by token, it joins the chat history once complete
+        answer_placeholder = st.empty()
+        streamed_answer = ''
+        for event in llm_helper.stream_semantic_answer(new_question,
+                                                       st.session_state['compact_history'].get_turns(),
+                                                       filters=filters):
+            if event['type'] == 'token':
+                streamed_answer += event['token']
+                answer_placeholder.markdown(streamed_answer + '▌')
+            elif event['type'] == 'answer':
+                question, result, sources = event['question'], event['answer'], event['sources']
+        answer_placeholder.empty()
         st.session_state['chat_history'].append((question, result))
+        st.session_state['compact_history'].add_turn(question, result)
         st.session_state['source_documents'].append(sources)
 
     if st.session_state['chat_history']:
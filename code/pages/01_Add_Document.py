@@ -9,10 +9,13 @@ import chardet
 import requests
 import streamlit as st
 from redis.exceptions import ResponseError
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
+# Chunks listed on every rerun of the page
+MAX_DOCUMENTS_SHOWN = 1000
+
 
 def upload_text_and_embeddings():
     '''Upload text and embeddings to datastore.'''
@@ -20,7 +23,8 @@ def upload_text_and_embeddings():
     source_url = llm_helper.blob_client.upload_file(st.session_state['doc_text'],
                                                     file_name=file_name,
                                                     content_type='text/plain; charset=utf-8')
-    llm_helper.add_embeddings_lc(source_url)
+    llm_helper.add_embeddings_lc(source_url, tags=st.session_state['doc_tags'],
+                                 groups=st.session_state['doc_groups'])
     st.success('Embeddings added successfully.')
 
 
@@ -52,7 +56,8 @@ def add_urls():
     urls = st.session_state['urls'].split('\n')
     for url in urls:
         if url:
-            llm_helper.add_embeddings_lc(url)
+            llm_helper.add_embeddings_lc(url, tags=st.session_state['doc_tags'],
+                                         groups=st.session_state['doc_groups'])
             st.success(f'Embeddings added successfully for {url}')
 
 
@@ -70,6 +75,11 @@ def upload_file(bytes_data: bytes, file_name: str):
                                         st.session_state['filename'],
                                         content_type=content_type+charset
                                     )
+    # The batch processing reads the tags and groups of the file from its metadata
+    access = {name: st.session_state[f'doc_{name}'] for name in ('tags', 'groups')
+              if st.session_state[f'doc_{name}']}
+    if access:
+        llm_helper.blob_client.upsert_blob_metadata(file_name, access)
 
 # Set page layout to wide screen and menu item
 menu_items = {
@@ -85,7 +95,16 @@ set_st_auth_vars()
 
 if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
+
+        col1, col2 = st.columns([1,1])
+        with col1:
+            st.text_input('Tags', key='doc_tags', placeholder='hr, policies',
+                          help='Comma separated tags the questions can be filtered on.')
+        with col2:
+            st.text_input('Groups allowed to read', key='doc_groups', placeholder='AAD group object IDs',
+                          help='Comma separated AAD groups whose members get answers from the ' +
+                               'documents. Leave it empty to make the documents readable by everyone.')
 
         with st.expander("Add a single document to the knowledge base", expanded=True):
             st.write("For heavy or long PDF, please use the 'Add documents in batch' option below.")
@@ -102,14 +121,18 @@ if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
                     converted_filename = ''
                     if uploaded_file.name.endswith('.txt'):
                         # Add the text to the embeddings
-                        llm_helper.add_embeddings_lc(st.session_state['file_url'])
+                        llm_helper.add_embeddings_lc(st.session_state['file_url'],
+                                                     tags=st.session_state['doc_tags'],
+                                                     groups=st.session_state['doc_groups'])
 
                     else:
                         # Get OCR with Layout API and then add embeddigns
                         converted_filename = llm_helper.convert_file_and_add_embeddings(
                                                 st.session_state['file_url'],
                                                 st.session_state['filename'],
-                                                st.session_state['translate']
+                                                st.session_state['translate'],
+                                                tags=st.session_state['doc_tags'],
+                                                groups=st.session_state['doc_groups']
                                             )
 
                     llm_helper.blob_client.upsert_blob_metadata(
@@ -178,15 +201,19 @@ if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
                 st.button("Compute Embeddings", on_click=add_urls, key="add_url")
 
         with st.expander("View documents in the knowledge base", expanded=False):
-            # Query RediSearch to get all the embeddings
+            # List all the embeddings of the index
             WARN_MSG = 'No embeddings found. Copy paste your data in the text input' + \
                         ' and click on "Compute Embeddings" or drag-and-drop documents.'
             try:
-                data = llm_helper.get_all_documents(k=1000)
+                # The expander runs on every rerun even when collapsed, only list the first chunks
+                data = llm_helper.get_all_documents(k=MAX_DOCUMENTS_SHOWN)
                 if len(data) == 0:
                     st.warning(WARN_MSG)
                 else:
                     st.dataframe(data, use_container_width=True)
+                    if len(data) == MAX_DOCUMENTS_SHOWN:
+                        st.caption(f"Only the first {MAX_DOCUMENTS_SHOWN} embeddings are listed, " +
+                                   "the Index Management page lists every file.")
             #pylint: disable=broad-except
             except Exception as e:
                 if isinstance(e, ResponseError):
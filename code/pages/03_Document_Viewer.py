@@ -3,7 +3,7 @@
 import os
 import traceback
 import streamlit as st
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
@@ -28,7 +28,7 @@ if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
                     </style>
                     """
         st.markdown(HIDE_STREAMLIT_STYLE, unsafe_allow_html=True)
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
         col1, col2, col3 = st.columns([2,1,1])
         files_data = llm_helper.blob_client.get_all_files()
         st.dataframe(files_data, use_container_width=True)
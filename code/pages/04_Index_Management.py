@@ -3,25 +3,30 @@
 import os
 import traceback
 import streamlit as st
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
 def delete_embedding():
     'Function to delete an embedding'
-    llm_helper.vector_store.delete_keys([f"{st.session_state['embedding_to_drop']}"])
+    llm_helper.delete_keys([f"{st.session_state['embedding_to_drop']}"])
+    st.session_state.pop('embeddings_csv', None)
 
 def delete_file():
-    'Function to delete all the files'
-    embeddings_to_delete = data[data.filename == st.session_state['file_to_drop']].key.tolist()
-    embeddings_to_delete = list(map(lambda x: f"{x}", embeddings_to_delete))
-    llm_helper.vector_store.delete_keys(embeddings_to_delete)
+    'Function to delete all the embeddings of a file'
+    llm_helper.delete_file(st.session_state['file_to_drop'])
+    st.session_state.pop('embeddings_csv', None)
 
 def delete_all():
     'Function to delete all the embeddings'
-    embeddings_to_delete = data.key.tolist()
-    embeddings_to_delete = list(map(lambda x: f"{x}", embeddings_to_delete))
-    llm_helper.vector_store.delete_keys(embeddings_to_delete)
+    # Also deletes the chunks without a file name, which get_files does not list
+    llm_helper.delete_all()
+    st.session_state.pop('embeddings_csv', None)
+
+def export_embeddings():
+    'Function to prepare the download of all the embeddings'
+    st.session_state['embeddings_csv'] = llm_helper.get_all_documents().to_csv(
+                                            index=False).encode('utf-8')
 
 # Set page layout to wide screen and menu item
 menu_items = {
@@ -37,37 +42,42 @@ set_st_auth_vars()
 
 if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
 
-        # Query RediSearch to get all the embeddings
-        data = llm_helper.get_all_documents(k=1000)
+        # Files and chunk counts come from the per-file index, no chunk is loaded here
+        files = llm_helper.vector_store.get_files()
 
-        if len(data) == 0:
+        if len(files) == 0:
             st.warning("No embeddings found. Go to the 'Add Document' tab to insert your docs.")
         else:
-            st.dataframe(data, use_container_width=True)
+            st.dataframe([{'filename': filename, 'chunks': count}
+                          for filename, count in sorted(files.items())],
+                         use_container_width=True)
 
-            st.download_button("Download data",
-                               data.to_csv(index=False).encode('utf-8'),
-                               "embeddings.csv",
-                               "text/csv",
-                               key='download-embeddings')
+            if 'embeddings_csv' in st.session_state:
+                st.download_button("Download data",
+                                   st.session_state['embeddings_csv'],
+                                   "embeddings.csv",
+                                   "text/csv",
+                                   key='download-embeddings')
+            else:
+                st.button("Export embeddings", on_click=export_embeddings)
 
             st.text("")
             st.text("")
             col1, col2, col3, col4 = st.columns([3,2,2,1])
+            with col3:
+                st.selectbox("File name to delete",
+                             sorted(files),
+                             key="file_to_drop")
             with col1:
                 st.selectbox("Embedding id to delete",
-                             data.get('key',[]),
+                             llm_helper.vector_store.get_file_keys(st.session_state['file_to_drop']),
                              key="embedding_to_drop")
             with col2:
                 st.text("")
                 st.text("")
                 st.button("Delete embedding", on_click=delete_embedding)
-            with col3:
-                st.selectbox("File name to delete",
-                             set(data.get('filename',[])),
-                             key="file_to_drop")
             with col4:
                 st.text("")
                 st.text("")
@@ -77,6 +87,9 @@ if os.getenv('AAD_Admin_SG') in st.session_state["user_groups"]:
             st.text("")
             st.button("Delete all embeddings", on_click=delete_all, type="secondary")
 
+        with st.expander("Cache statistics", expanded=False):
+            st.json(llm_helper.get_cache_stats())
+
     # pylint: disable=broad-except
     except Exception:
         st.error(traceback.format_exc())
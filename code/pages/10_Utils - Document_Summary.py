@@ -3,7 +3,7 @@
 import os
 import traceback
 import streamlit as st
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
@@ -45,7 +45,7 @@ set_st_auth_vars()
 if os.getenv('AAD_General_SG') in st.session_state['user_groups'] or \
     os.getenv('AAD_Admin_SG') in st.session_state['user_groups']:
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
 
         st.markdown('## Summarization')
         # radio buttons for summary type
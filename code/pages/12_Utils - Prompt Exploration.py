@@ -3,10 +3,13 @@
 import os
 import traceback
 import streamlit as st
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.authenticate import set_st_auth_vars
 from utilities.pagehandler import delete_page, all_pages
 
+# Chunks listed on every rerun of the page, the tasks on documents read all their chunks
+MAX_DOCUMENTS_SHOWN = 1000
+
 def get_prompt():
     'Get prompt from the input'
     return f"{st.session_state['doc_text']}\n{st.session_state['input_prompt']}"
@@ -16,17 +19,22 @@ def customcompletion():
     response = llm_helper.get_completion(get_prompt())
     st.session_state['prompt_result']= response.encode().decode()
 
-def process_all(data):
-    'Process all the documents'
+def process_all():
+    'Process all the chunks of the selected documents'
     llm_helper.vector_store.delete_prompt_results('prompt*')
-    data_to_process = data[data.filename.isin(st.session_state['selected_docs'])]
-    for doc in data_to_process.to_dict('records'):
-        prompt = f"{doc['content']}\n{st.session_state['input_prompt']}\n\n"
-        response = llm_helper.get_completion(prompt)
-        llm_helper.vector_store.add_prompt_result(doc['key'],
-                                                  response.encode().decode(),
-                                                  doc['filename'],
-                                                  st.session_state['input_prompt'])
+    selected_docs = set(st.session_state['selected_docs'])
+    results = []
+    for documents in llm_helper.iter_documents():
+        for document in documents:
+            if document.metadata.get('filename') not in selected_docs:
+                continue
+            prompt = f"{document.page_content}\n{st.session_state['input_prompt']}\n\n"
+            response = llm_helper.get_completion(prompt)
+            results.append({'id': document.metadata['key'],
+                            'result': response.encode().decode(),
+                            'filename': document.metadata.get('filename'),
+                            'prompt': st.session_state['input_prompt']})
+    llm_helper.vector_store.add_prompt_results(results)
     st.session_state['data_processed'] = llm_helper.vector_store.get_prompt_results().to_csv(
                                             index=False)
 
@@ -48,15 +56,18 @@ if os.getenv('AAD_General_SG') in st.session_state['user_groups'] or \
         if 'data_processed' not in st.session_state:
             st.session_state['data_processed'] = None
 
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
 
-        # Query RediSearch to get all the embeddings
-        data = llm_helper.get_all_documents(k=1000)
+        # List the first embeddings of the index and every file from the per-file index
+        data = llm_helper.get_all_documents(k=MAX_DOCUMENTS_SHOWN)
+        files = llm_helper.vector_store.get_files()
 
         if len(data) == 0:
             st.warning("No embeddings found. Go to the 'Add Document' tab to insert your docs.")
         else:
             st.dataframe(data, use_container_width=True)
+            if len(data) == MAX_DOCUMENTS_SHOWN:
+                st.caption(f"Only the first {MAX_DOCUMENTS_SHOWN} embeddings are listed.")
 
             # displaying a box for a custom prompt
             st.text_area(label='Document', height=400, key='doc_text')
@@ -71,11 +82,11 @@ if os.getenv('AAD_General_SG') in st.session_state['user_groups'] or \
             cols = st.columns([1,1,1,2])
             with cols[1]:
                 st.multiselect('Select documents',
-                               sorted(set(data.filename.tolist())),
+                               sorted(files),
                                key='selected_docs')
             with cols[2]:
                 st.text('-')
-                st.button('Execute task on docs', on_click=process_all, args=(data,))
+                st.button('Execute task on docs', on_click=process_all)
             with cols[3]:
                 st.text('-')
                 DOWNLOAD_DATA = ''
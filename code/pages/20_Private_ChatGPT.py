@@ -3,9 +3,10 @@
 import os
 import traceback
 import logging
+from datetime import date, timedelta
 import streamlit as st
 from utilities.authenticate import set_st_auth_vars
-from utilities.helper import LLMHelper
+from utilities.helper import get_llm_helper
 from utilities.pagehandler import delete_page, all_pages
 from dotenv import load_dotenv
 
@@ -18,7 +19,7 @@ def check_deployment():
     # Check if the deployment is working
     #\ 1. Check if the llm is working
     try:
-        llm_helper_local = LLMHelper()
+        llm_helper_local = get_llm_helper()
         llm_helper_local.get_completion('Generate a joke!')
         st.success('LLM is working!')
     #pylint: disable=broad-except
@@ -38,7 +39,7 @@ Then restart your application.
         st.error(traceback.format_exc())
     #\ 2. Check if the embedding is working
     try:
-        llm_helper_local = LLMHelper()
+        llm_helper_local = get_llm_helper()
         llm_helper_local.embeddings.embed_documents(texts=['This is a test'])
         st.success('Embedding is working!')
     #pylint: disable=broad-except
@@ -53,7 +54,7 @@ Then restart your application.
         st.error(traceback.format_exc())
     #\ 3. Check if the translation is working
     try:
-        llm_helper_local = LLMHelper()
+        llm_helper_local = get_llm_helper()
         llm_helper_local.translator.translate('This is a test', 'nl')
         st.success('Translation is working!')
     #pylint: disable=broad-except
@@ -65,8 +66,11 @@ Then restart your application.
         st.error(traceback.format_exc())
     #\ 4. Check if the Redis is working with previous version of data
     try:
-        llm_helper_local = LLMHelper()
-        if llm_helper_local.vector_store_type != 'AzureSearch':
+        llm_helper_local = get_llm_helper()
+        if llm_helper_local.vector_store_type == 'Numpy':
+            llm_helper_local.vector_store.get_files()
+            st.success('Local vector store is working!')
+        elif llm_helper_local.vector_store_type != 'AzureSearch':
             if llm_helper_local.vector_store.check_existing_index('embeddings-index'):
                 error_msg = '''
 Seems like you're using a Redis with an old data structure.  
@@ -153,8 +157,8 @@ if os.getenv('AAD_Admin_SG') in st.session_state['user_groups']:
         if 'custom_temperature' not in st.session_state:
             st.session_state['custom_temperature'] = float(os.getenv('OPENAI_TEMPERATURE', '0.7'))
 
-        llm_helper = LLMHelper(custom_prompt=st.session_state.custom_prompt,
-                               temperature=st.session_state.custom_temperature)
+        llm_helper = get_llm_helper(custom_prompt=st.session_state.custom_prompt,
+                                    temperature=st.session_state.custom_temperature)
 
         # Get available languages for translation
         available_languages = get_languages()
@@ -198,16 +202,35 @@ Answer:'''
                 st.selectbox('Language',
                              [None] + list(available_languages.keys()),
                              key='translation_language')
+            with st.expander('Filters'):
+                # The documents are narrowed down before the similarity search
+                st.multiselect('Files', sorted(llm_helper.vector_store.get_files()), key='filter_filenames')
+                st.text_input('Tags', key='filter_tags', placeholder='hr, policies',
+                              help='Comma separated, documents with any of the tags match')
+                st.selectbox('Ingested in the last', [None, 7, 30, 90, 365], key='filter_days',
+                             format_func=lambda days: 'Any time' if days is None else f'{days} days')
 
         question = st.text_input('OpenAI Semantic Answer', DEFAULT_QUESTION)
 
         if question != '':
             st.session_state['question'] = question
-            st.session_state['question'],\
-            st.session_state['response'],\
-            st.session_state['context'],\
-            sources = llm_helper.get_semantic_answer_lang_chain(question, [])
-            st.markdown('Answer:' + st.session_state['response'])
+            # Show the answer token by token as it is generated
+            answer_placeholder = st.empty()
+            streamed_answer = ''
+            filters = {'filenames': st.session_state['filter_filenames'],
+                       'tags': st.session_state['filter_tags'],
+                       'ingested_after': date.today() - timedelta(days=st.session_state['filter_days'])
+                                         if st.session_state['filter_days'] else None}
+            for event in llm_helper.stream_semantic_answer(question, [], filters=filters):
+                if event['type'] == 'token':
+                    streamed_answer += event['token']
+                    answer_placeholder.markdown('Answer:' + streamed_answer + '▌')
+                elif event['type'] == 'answer':
+                    st.session_state['question'] = event['question']
+                    st.session_state['response'] = event['answer']
+                    st.session_state['context'] = event['context']
+                    sources = event['sources']
+            answer_placeholder.markdown('Answer:' + st.session_state['response'])
             st.markdown(f'\n\nSources: {sources}')
             with st.expander('Question and Answer Context'):
                 st.markdown(st.session_state['context'].replace('$', '\$'))
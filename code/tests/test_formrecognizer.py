@@ -0,0 +1,132 @@
+'''Tests of the page range splitting of the Form Recognizer layout analysis'''
+
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+formrecognizer = pytest.importorskip('utilities.formrecognizer')
+exceptions = pytest.importorskip('azure.core.exceptions')
+
+
+def service_error(status_code, code, message):
+    'HttpResponseError as raised by the service, with its status and error code'
+    exc = exceptions.HttpResponseError(message=message)
+    exc.status_code = status_code
+    exc.error = SimpleNamespace(code=code, message=message, innererror=None)
+    return exc
+
+
+class StubPoller:
+    'Poller of a layout analysis, slower for the first pages so that the ranges complete out of order'
+    def __init__(self, layout, delay):
+        self.layout = layout
+        self.delay = delay
+
+    def result(self):
+        'Wait for the analysis and return its layout'
+        time.sleep(self.delay)
+        if isinstance(self.layout, Exception):
+            raise self.layout
+        return self.layout
+
+
+class StubDocumentAnalysisClient:
+    'Document Analysis client analyzing a document with one paragraph per page and a table on page 3'
+    def __init__(self, page_count, failing_range=None, failing_status=500):
+        self.page_count = page_count
+        self.failing_range = failing_range
+        self.failing_status = failing_status
+        self.requested_ranges = []
+        self.lock = threading.Lock()
+
+    def begin_analyze_document_from_url(self, model_id, document_url, pages=None):
+        'Start the analysis of a page range, all pages if not set'
+        with self.lock:
+            self.requested_ranges.append(pages)
+        first, last = map(int, pages.split('-')) if pages else (1, self.page_count)
+        if pages == self.failing_range:
+            return StubPoller(service_error(self.failing_status, 'ServiceError', f"Failed to analyze {pages}"), 0)
+        # The service rejects a range starting after the last page
+        if first > self.page_count:
+            return StubPoller(service_error(400, 'InvalidArgument',
+                                            f"The page range {pages} exceeds the number of pages"), 0)
+        page_numbers = range(first, min(last, self.page_count) + 1)
+        region = lambda page_number: [SimpleNamespace(page_number=page_number)]
+        layout = SimpleNamespace(
+            pages=[SimpleNamespace(page_number=page_number) for page_number in page_numbers],
+            paragraphs=[SimpleNamespace(bounding_regions=region(page_number), role=None,
+                                        content=f"Paragraph of page {page_number}")
+                        for page_number in page_numbers],
+            tables=[SimpleNamespace(bounding_regions=region(page_number),
+                                    cells=[SimpleNamespace(row_index=0, content=f"Cell of page {page_number}")])
+                    for page_number in page_numbers if page_number == 3])
+        return StubPoller(layout, 0.05 / first)
+
+
+def analyze(page_count, pages_per_request, max_parallelism=2, failing_range=None, failing_status=500):
+    'Analyze a stub document split in page ranges, return the layout and the requested ranges'
+    client = StubDocumentAnalysisClient(page_count, failing_range, failing_status)
+    form_recognizer = formrecognizer.AzureFormRecognizerClient(document_analysis_client=client)
+    form_recognizer.pages_per_request = pages_per_request
+    form_recognizer.max_parallelism = max_parallelism
+    return form_recognizer.analyze_layout('https://storage/document.pdf'), client.requested_ranges
+
+
+def paragraph_pages(layout):
+    'Page numbers of the paragraphs of a layout, in order'
+    return [page_number for page_number, _, _ in layout['paragraphs']]
+
+
+def test_whole_document_without_ranges():
+    'A single request without page range when the splitting is disabled'
+    layout, requested_ranges = analyze(page_count=5, pages_per_request=0)
+    assert requested_ranges == [None]
+    assert layout['page_count'] == 5
+    assert paragraph_pages(layout) == [1, 2, 3, 4, 5]
+
+
+def test_ranges_are_merged_in_page_order():
+    'The ranges complete out of order but the merged layout follows the pages'
+    layout, requested_ranges = analyze(page_count=7, pages_per_request=2)
+    # The ranges are requested max_parallelism at a time until one is incomplete
+    assert sorted(requested_ranges, key=lambda pages: int(pages.split('-')[0])) == \
+        ['1-2', '3-4', '5-6', '7-8', '9-10']
+    assert layout['page_count'] == 7
+    assert paragraph_pages(layout) == [1, 2, 3, 4, 5, 6, 7]
+    assert layout['tables'] == [[3, [[0, 'Cell of page 3']]]]
+
+
+def test_ranges_past_the_last_page_are_ignored():
+    'A document ending on a range boundary stops at the first rejected range'
+    layout, requested_ranges = analyze(page_count=4, pages_per_request=2, max_parallelism=3)
+    assert sorted(requested_ranges) == ['1-2', '3-4', '5-6', '7-8']
+    assert layout['page_count'] == 4
+    assert paragraph_pages(layout) == [1, 2, 3, 4]
+
+
+def test_failed_range_before_the_last_page_is_raised():
+    'A failure followed by analyzed pages is a real error, not the end of the document'
+    with pytest.raises(exceptions.HttpResponseError):
+        analyze(page_count=6, pages_per_request=2, failing_range='3-4')
+
+
+def test_failed_first_range_is_raised():
+    'The first range always has pages, its failure is raised'
+    with pytest.raises(exceptions.HttpResponseError):
+        analyze(page_count=6, pages_per_request=2, failing_range='1-2')
+
+
+def test_throttled_range_is_raised():
+    'A 429 on a range of the document is raised instead of being taken for its end'
+    with pytest.raises(exceptions.HttpResponseError) as exc_info:
+        analyze(page_count=6, pages_per_request=2, failing_range='3-4', failing_status=429)
+    assert exc_info.value.status_code == 429
+
+
+def test_throttled_last_range_is_raised():
+    'A 429 on the last range, followed by ranges past the end only, does not truncate the document'
+    with pytest.raises(exceptions.HttpResponseError) as exc_info:
+        analyze(page_count=5, pages_per_request=2, failing_range='5-6', failing_status=429)
+    assert exc_info.value.status_code == 429
@@ -0,0 +1,75 @@
+'''Tests of the metadata filters applied by the retrieval of the QnA'''
+
+from types import SimpleNamespace
+
+import pytest
+
+helper = pytest.importorskip('utilities.helper')
+numpystore = pytest.importorskip('utilities.numpystore')
+redisstore = pytest.importorskip('utilities.redis')
+
+QUESTION = 'What is the salary grid?'
+
+
+def embed(text):
+    'Same direction for every text, only the filters tell the chunks apart'
+    return [1.0, 0.0, 0.0]
+
+
+def retrieve(vector_store, filters, k=4):
+    'Run LLMHelper.retrieve, the synchronous retrieval of the QnA, on a vector store'
+    return helper.LLMHelper.retrieve(SimpleNamespace(vector_store=vector_store, k=k), QUESTION, filters)
+
+
+@pytest.fixture(name='store')
+def fixture_store(tmp_path):
+    'NumPy store holding a public chunk and a chunk restricted to the hr-group'
+    store = numpystore.NumpyVectorStore(str(tmp_path), 'test-index', embed)
+    store.add_texts(
+        ['Holiday policy of the company', 'Salary grid of the company'],
+        metadatas=[{'source': 'holidays.txt', 'filename': 'holidays.txt', 'tags': [], 'groups': []},
+                   {'source': 'salaries.txt', 'filename': 'salaries.txt', 'tags': ['hr'],
+                    'groups': ['hr-group']}],
+        embeddings=[embed(''), embed('')])
+    return store
+
+
+def test_restricted_chunk_is_excluded(store):
+    'A user in no group only gets the public chunks, even when a restricted one is as similar'
+    documents = retrieve(store, {'groups': []})
+    assert [document.metadata['filename'] for document in documents] == ['holidays.txt']
+
+
+def test_restricted_chunk_is_returned_to_its_group(store):
+    'The members of a group get its chunks along with the public ones'
+    documents = retrieve(store, {'groups': ['hr-group']})
+    assert sorted(document.metadata['filename'] for document in documents) == ['holidays.txt', 'salaries.txt']
+
+
+def test_retrieval_honours_k(store):
+    'The number of chunks configured with RETRIEVAL_K reaches the store'
+    assert len(retrieve(store, None, k=1)) == 1
+
+
+def test_redis_search_is_pre_filtered():
+    'The KNN query sent to Redis carries the group filter and k instead of searching every chunk'
+    queries = []
+
+    class FakeIndex:
+        'Records the queries sent to the search index'
+        def search(self, query, query_params=None):
+            'Record the query and find nothing'
+            queries.append(query.query_string())
+            return SimpleNamespace(docs=[])
+
+    # Only the attributes the search reads, no Redis server is needed
+    store = object.__new__(redisstore.RedisExtended)
+    store.index_name = 'embeddings'
+    store.index_settings = redisstore.get_vector_index_settings()
+    store.vector_dtype = redisstore.VECTOR_DTYPES[store.index_settings['vector_type']]
+    store.embedding_function = embed
+    store.client = SimpleNamespace(ft=lambda index_name: FakeIndex())
+
+    assert retrieve(store, {'groups': []}, k=2) == []
+    assert len(queries) == 1
+    assert queries[0].startswith(f"(@groups:{{{redisstore.PUBLIC_GROUP}}})=>[KNN 2 @content_vector")
@@ -0,0 +1,36 @@
+'''Tests of the batching of the Translator requests'''
+
+import pytest
+
+translator = pytest.importorskip('utilities.translator')
+
+
+class StubTranslatorClient(translator.AzureTranslatorClient):
+    'Translator client upper-casing the texts instead of calling the service, recording the requests'
+    def __init__(self):
+        self.requests = []
+
+    def post_translate(self, texts, language, source_language=None):
+        'Translate a batch of texts, failing like the service when over the character limit'
+        assert len(texts) <= translator.MAX_ELEMENTS_PER_REQUEST
+        assert sum(len(text) for text in texts) <= translator.MAX_CHARACTERS_PER_REQUEST
+        self.requests.append(texts)
+        return [text.upper() for text in texts]
+
+
+def test_split_text_keeps_the_separators():
+    text = 'First sentence. Second one!\n\nAnother paragraph here.'
+    pieces = translator.split_text(text, limit=20)
+    assert all(len(piece) <= 20 for piece, _ in pieces)
+    assert ''.join(piece + separator for piece, separator in pieces) == text
+    assert pieces[0] == ('First sentence.', ' ')
+
+
+def test_oversize_text_is_translated_in_pieces():
+    paragraph = 'This is a sentence of the document. ' * 400
+    text = '\n\n'.join([paragraph.strip()] * 6)
+    assert len(text) > translator.MAX_CHARACTERS_PER_REQUEST
+    client = StubTranslatorClient()
+    short = 'A short text of the oversize test'
+    assert client.translate_batch([short, text], language='fr') == [short.upper(), text.upper()]
+    assert len(client.requests) == 2
@@ -0,0 +1,273 @@
+'''Helper functions to cache the answers of the QnA chain'''
+
+import os
+import re
+import json
+import hashlib
+import logging
+from typing import List, Tuple
+
+import numpy as np
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+from redis.commands.search.query import Query
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.field import NumericField, TagField, TextField
+from utilities.redis import VECTOR_DTYPES, create_vector_field, get_vector_index_settings, knn_query
+
+logger = logging.getLogger()
+
+
+def normalize_text(text: str) -> str:
+    'Collapse the whitespace and the case of a text so that trivial variations share a cache entry'
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class AnswerCache:
+    'Cache of the answers in Redis, invalidated whenever the content of the index changes'
+    def __init__(self, redis_url: str = None, client: redis.Redis = None, index_name: str = 'embeddings',
+                 ttl: int = None, prefix: str = 'answer'):
+        load_dotenv()
+
+        self.client = client if client is not None else redis.from_url(redis_url)
+        # Used by the async path, the connections are only opened on the first request
+        self.async_client = redis.asyncio.from_url(redis_url) if redis_url else None
+        self.index_name = index_name
+        self.ttl: int = int(os.getenv('ANSWER_CACHE_TTL', 3600)) if ttl is None else ttl
+        self.prefix = prefix
+
+    def index_version_name(self) -> str:
+        'Name of the counter of the changes made to the index'
+        return f"indexversion:{self.index_name}"
+
+    def get_index_version(self):
+        'Get the current version of the index, 0 when it never changed and None when unknown'
+        try:
+            return int(self.client.get(self.index_version_name()) or 0)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+            return None
+
+    async def aget_index_version(self):
+        'Get the current version of the index without blocking the event loop'
+        try:
+            return int(await self.async_client.get(self.index_version_name()) or 0)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+            return None
+
+    def bump_index_version(self) -> None:
+        'Invalidate all the cached answers after a change of the index'
+        try:
+            self.client.incr(self.index_version_name())
+        except redis.exceptions.RedisError as exc:
+            logger.error('Could not invalidate the answer cache: %s', exc)
+
+    def make_settings(self, chat_history: List[Tuple[str, str]], prompt: str,
+                      temperature: float, deployment_name: str, filters: dict = None) -> str:
+        'Hash of the conversation, settings and filters an answer depends on, besides the question'
+        settings = json.dumps([[[normalize_text(q), normalize_text(a)] for q, a in chat_history],
+                               hashlib.sha1(prompt.encode('utf-8')).hexdigest(),
+                               temperature, deployment_name] + ([filters] if filters else []),
+                              sort_keys=True)
+        return hashlib.sha1(settings.encode('utf-8')).hexdigest()
+
+    def make_key(self, question: str, settings: str, index_version: int) -> str:
+        'Key of the answer of a question for the given settings and index version'
+        key = json.dumps([normalize_text(question), settings, index_version])
+        return f"{self.prefix}:{self.index_name}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def count(self, field: str, amount: int = 1) -> None:
+        'Increment a counter of the cache statistics shared by all the processes'
+        try:
+            self.client.hincrby(f"{self.prefix}:stats:{self.index_name}", field, amount)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+
+    async def acount(self, field: str, amount: int = 1) -> None:
+        'Increment a counter of the cache statistics without blocking the event loop'
+        try:
+            await self.async_client.hincrby(f"{self.prefix}:stats:{self.index_name}", field, amount)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+
+    def stats(self) -> dict:
+        'Get the counters of the cache statistics'
+        stats = self.client.hgetall(f"{self.prefix}:stats:{self.index_name}")
+        return {key.decode('utf-8'): int(value) for key, value in sorted(stats.items())}
+
+    def get(self, key: str):
+        'Get a cached answer, None when missing'
+        try:
+            value = self.client.get(key)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def aget(self, key: str):
+        'Get a cached answer without blocking the event loop, None when missing'
+        try:
+            value = await self.async_client.get(key)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, answer: dict) -> None:
+        'Store an answer with the cache TTL'
+        try:
+            self.client.set(key, json.dumps(answer), ex=self.ttl)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+
+    async def aset(self, key: str, answer: dict) -> None:
+        'Store an answer with the cache TTL without blocking the event loop'
+        try:
+            await self.async_client.set(key, json.dumps(answer), ex=self.ttl)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Answer cache unavailable: %s', exc)
+
+
+class SemanticAnswerCache:
+    'Cache of the answers of similar questions in a Redis vector index'
+    def __init__(self, answer_cache: AnswerCache, threshold: float = None, index_settings: dict = None,
+                 index_name: str = 'semantic-cache-index', prefix: str = 'semcache'):
+        load_dotenv()
+
+        self.answer_cache = answer_cache
+        self.client = answer_cache.client
+        self.async_client = answer_cache.async_client
+        # Cosine similarity above which two questions share their answer
+        self.threshold: float = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.97)) if threshold is None else threshold
+        # Same algorithm, vector type and dimensions as the index of the documents
+        self.index_settings = get_vector_index_settings() if index_settings is None else index_settings
+        self.vector_dtype = VECTOR_DTYPES[self.index_settings["vector_type"]]
+        self.index_name = index_name
+        self.prefix = f"{prefix}:{answer_cache.index_name}"
+        self.available = None
+
+    def check_index(self) -> bool:
+        'Create the vector index of the questions if needed, False when Redis has no search module'
+        if self.available is None:
+            try:
+                try:
+                    self.client.ft(self.index_name).info()
+                except redis.exceptions.ResponseError:
+                    self.create_index()
+                self.available = True
+            except redis.exceptions.RedisError as exc:
+                logger.warning('Semantic answer cache disabled: %s', exc)
+                self.available = False
+        return self.available
+
+    async def acheck_index(self) -> bool:
+        'Create the vector index of the questions if needed without blocking the event loop'
+        if self.available is None:
+            try:
+                try:
+                    await self.async_client.ft(self.index_name).info()
+                except redis.exceptions.ResponseError:
+                    await self.async_client.ft(self.index_name).create_index(**self.index_definition())
+                self.available = True
+            except redis.exceptions.RedisError as exc:
+                logger.warning('Semantic answer cache disabled: %s', exc)
+                self.available = False
+        return self.available
+
+    def index_definition(self) -> dict:
+        'Fields and definition of the Redis index of the cached questions'
+        question = TextField(name="question")
+        settings = TagField(name="settings")
+        index_version = NumericField(name="index_version")
+        question_vector = create_vector_field("question_vector", self.index_settings)
+        return {
+            'fields': [question, settings, index_version, question_vector],
+            'definition': IndexDefinition(prefix=[self.prefix], index_type=IndexType.HASH),
+        }
+
+    def create_index(self) -> None:
+        'Create the Redis index of the cached questions'
+        self.client.ft(self.index_name).create_index(**self.index_definition())
+
+    def query(self, settings: str, index_version: int) -> Query:
+        'KNN query of the most similar question asked with the same settings on the same index version'
+        return Query(knn_query(1, self.index_settings, "question_vector",
+                               f"(@settings:{{{settings}}} @index_version:[{index_version} {index_version}])"))\
+            .sort_by("vector_score")\
+            .return_fields("answer", "vector_score")\
+            .dialect(2)
+
+    def read_results(self, results):
+        'Answer of the closest question when similar enough, its similarity and the similarity bucket'
+        if not results.docs:
+            return None, 0.0, None
+        similarity = 1 - float(results.docs[0].vector_score)
+        # Similarity distribution of the closest cached questions, in buckets of 0.05
+        bucket = f"similarity:{min(int(similarity * 20), 19) / 20:.2f}"
+        if similarity < self.threshold:
+            return None, similarity, bucket
+        return json.loads(results.docs[0].answer), similarity, bucket
+
+    def get(self, embedding: List[float], settings: str, index_version: int):
+        'Get the answer of the most similar question asked with the same settings and its similarity'
+        try:
+            results = self.client.ft(self.index_name).search(
+                self.query(settings, index_version), {"vector": np.array(embedding, dtype=self.vector_dtype).tobytes()})
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Semantic answer cache unavailable: %s', exc)
+            return None, 0.0
+        answer, similarity, bucket = self.read_results(results)
+        if bucket:
+            self.answer_cache.count(bucket)
+        return answer, similarity
+
+    async def aget(self, embedding: List[float], settings: str, index_version: int):
+        'Get the answer of the most similar question and its similarity without blocking the event loop'
+        try:
+            results = await self.async_client.ft(self.index_name).search(
+                self.query(settings, index_version), {"vector": np.array(embedding, dtype=self.vector_dtype).tobytes()})
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Semantic answer cache unavailable: %s', exc)
+            return None, 0.0
+        answer, similarity, bucket = self.read_results(results)
+        if bucket:
+            await self.answer_cache.acount(bucket)
+        return answer, similarity
+
+    def make_entry(self, question: str, embedding: List[float], settings: str, index_version: int,
+                   answer: dict) -> Tuple[str, dict]:
+        'Key and fields of the cached answer of a question'
+        key = f"{self.prefix}:{hashlib.sha1(f'{settings}:{index_version}:{question}'.encode('utf-8')).hexdigest()}"
+        return key, {
+            "question": question,
+            "settings": settings,
+            "index_version": index_version,
+            "question_vector": np.array(embedding, dtype=self.vector_dtype).tobytes(),
+            "answer": json.dumps(answer),
+        }
+
+    def set(self, question: str, embedding: List[float], settings: str, index_version: int,
+            answer: dict) -> None:
+        'Store the answer of a question with the cache TTL'
+        key, mapping = self.make_entry(question, embedding, settings, index_version, answer)
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.hset(key, mapping=mapping)
+            pipeline.expire(key, self.answer_cache.ttl)
+            pipeline.execute()
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Semantic answer cache unavailable: %s', exc)
+
+    async def aset(self, question: str, embedding: List[float], settings: str, index_version: int,
+                   answer: dict) -> None:
+        'Store the answer of a question with the cache TTL without blocking the event loop'
+        key, mapping = self.make_entry(question, embedding, settings, index_version, answer)
+        try:
+            pipeline = self.async_client.pipeline(transaction=False)
+            pipeline.hset(key, mapping=mapping)
+            pipeline.expire(key, self.answer_cache.ttl)
+            await pipeline.execute()
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Semantic answer cache unavailable: %s', exc)
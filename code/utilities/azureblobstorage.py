@@ -1,11 +1,13 @@
 '''Helper function to handle Azure Blob Storage operations'''
 
 import os
+import hashlib
 from datetime import datetime, timedelta
 from azure.storage.blob import BlobServiceClient, \
                                 generate_blob_sas, \
                                 generate_container_sas, \
                                 ContentSettings
+from azure.core.exceptions import ResourceNotFoundError
 from dotenv import load_dotenv
 
 class AzureBlobStorageClient:
@@ -34,10 +36,13 @@ class AzureBlobStorageClient:
         'Create a blob client using the local file name as the name for the blob'
         blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
                                                                blob=file_name)
+        # Store the MD5 ourselves, the service only computes it for small single-shot uploads
+        content_md5 = hashlib.md5(bytes_data).digest() if isinstance(bytes_data, bytes) else None
         # Upload the created file
         blob_client.upload_blob(bytes_data,
                                 overwrite=True,
-                                content_settings=ContentSettings(content_type=content_type))
+                                content_settings=ContentSettings(content_type=content_type,
+                                                                 content_md5=content_md5))
         # Generate a SAS URL to the blob and return it
         return blob_client.url + '?' + \
             generate_blob_sas(self.account_name,
@@ -100,6 +105,28 @@ class AzureBlobStorageClient:
         # Add metadata to the blob
         blob_client.set_blob_metadata(metadata= blob_metadata)
 
+    def get_blob_metadata(self, file_name):
+        'Get the metadata of a blob'
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
+                                                               blob=file_name)
+        return blob_client.get_blob_properties().metadata or {}
+
+    def get_blob_md5(self, file_name):
+        'Get the hex MD5 of the blob content, None when the service did not store it'
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
+                                                               blob=file_name)
+        content_md5 = blob_client.get_blob_properties().content_settings.content_md5
+        return bytes(content_md5).hex() if content_md5 else None
+
+    def download_file(self, file_name):
+        'Download the blob content, None when the blob does not exist'
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
+                                                               blob=file_name)
+        try:
+            return blob_client.download_blob().readall()
+        except ResourceNotFoundError:
+            return None
+
     def get_container_sas(self):
         'Generate a SAS URL to the container and return it'
         return "?" + \
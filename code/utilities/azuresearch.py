@@ -3,15 +3,18 @@ from __future__ import annotations
 
 import os
 import json
+import asyncio
 import logging
 import uuid
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
 from pydantic import BaseModel
 from azure.identity import DefaultAzureCredential
 import numpy as np
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.models import Vector
 from azure.search.documents.indexes.models import (
@@ -34,6 +37,7 @@ from langchain.docstore.document import Document
 from langchain.embeddings.base import Embeddings
 from langchain.schema import BaseRetriever
 from langchain.vectorstores.base import VectorStore
+from utilities.filters import normalize_filters
 
 logger = logging.getLogger()
 
@@ -48,9 +52,15 @@ FIELDS_CONTENT_VECTOR = os.environ.get(
     'AZURESEARCH_FIELDS_CONTENT_VECTOR', 'content_vector')
 FIELDS_TAG = os.environ.get('AZURESEARCH_FIELDS_TAG', 'tag')
 FIELDS_METADATA = os.environ.get('AZURESEARCH_FIELDS_TAG', 'metadata')
+FIELDS_FILENAME = os.environ.get('AZURESEARCH_FIELDS_FILENAME', 'filename')
+FIELDS_CONTENT_HASH = os.environ.get('AZURESEARCH_FIELDS_CONTENT_HASH', 'content_hash')
+FIELDS_TAGS = os.environ.get('AZURESEARCH_FIELDS_TAGS', 'tags')
+FIELDS_GROUPS = os.environ.get('AZURESEARCH_FIELDS_GROUPS', 'groups')
+FIELDS_INGEST_DATE = os.environ.get('AZURESEARCH_FIELDS_INGEST_DATE', 'ingest_date')
 
 MAX_UPLOAD_BATCH_SIZE = 1000
 MAX_DELETE_BATCH_SIZE = 1000
+MAX_FACET_COUNT = 100000
 
 def get_search_client(endpoint: str,
                       key: str,
@@ -63,24 +73,40 @@ def get_search_client(endpoint: str,
         credential = AzureKeyCredential(key)
     index_client: SearchIndexClient = SearchIndexClient(
         endpoint=endpoint, credential=credential)
+    # Fields configuration
+    fields = [
+        SimpleField(name=FIELDS_ID, type=SearchFieldDataType.String,
+                    key=True, filterable=True, sortable=True),
+        SearchableField(name=FIELDS_TITLE, type=SearchFieldDataType.String,
+                        searchable=True, retrievable=True),
+        SearchableField(name=FIELDS_CONTENT, type=SearchFieldDataType.String,
+                        searchable=True, retrievable=True),
+        SearchField(name=FIELDS_CONTENT_VECTOR, type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                    searchable=True, dimensions=AZURESEARCH_DIMENSIONS, vector_search_configuration='default'),
+        SearchableField(name=FIELDS_TAG, type=SearchFieldDataType.String,
+                        filterable=True, searchable=True, retrievable=True),
+        SearchableField(name=FIELDS_METADATA, type=SearchFieldDataType.String,
+                        searchable=True, retrievable=True),
+        SimpleField(name=FIELDS_FILENAME, type=SearchFieldDataType.String,
+                    filterable=True, facetable=True, retrievable=True),
+        SimpleField(name=FIELDS_CONTENT_HASH, type=SearchFieldDataType.String,
+                    retrievable=True),
+        SimpleField(name=FIELDS_TAGS, type=SearchFieldDataType.Collection(SearchFieldDataType.String),
+                    filterable=True, facetable=True, retrievable=True),
+        SimpleField(name=FIELDS_GROUPS, type=SearchFieldDataType.Collection(SearchFieldDataType.String),
+                    filterable=True, retrievable=True),
+        SimpleField(name=FIELDS_INGEST_DATE, type=SearchFieldDataType.Int64,
+                    filterable=True, sortable=True, retrievable=True)
+    ]
     try:
-        index_client.get_index(name=index_name)
+        index = index_client.get_index(name=index_name)
+        # Add the fields introduced after the index was created
+        existing_fields = [field.name for field in index.fields]
+        new_fields = [field for field in fields if field.name not in existing_fields]
+        if new_fields:
+            index.fields.extend(new_fields)
+            index_client.create_or_update_index(index)
     except ResourceNotFoundError as ex:
-        # Fields configuration
-        fields = [
-            SimpleField(name=FIELDS_ID, type=SearchFieldDataType.String,
-                        key=True, filterable=True),
-            SearchableField(name=FIELDS_TITLE, type=SearchFieldDataType.String,
-                            searchable=True, retrievable=True),
-            SearchableField(name=FIELDS_CONTENT, type=SearchFieldDataType.String,
-                            searchable=True, retrievable=True),
-            SearchField(name=FIELDS_CONTENT_VECTOR, type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                        searchable=True, dimensions=AZURESEARCH_DIMENSIONS, vector_search_configuration='default'),
-            SearchableField(name=FIELDS_TAG, type=SearchFieldDataType.String,
-                            filterable=True, searchable=True, retrievable=True),
-            SearchableField(name=FIELDS_METADATA, type=SearchFieldDataType.String,
-                            searchable=True, retrievable=True)
-        ]
         # Vector search configuration
         vector_search = VectorSearch(
             algorithm_configurations=[
@@ -118,6 +144,31 @@ def get_search_client(endpoint: str,
     return SearchClient(endpoint=endpoint, index_name=index_name, credential=AzureKeyCredential(key))
 
 
+def escape_value(value: str) -> str:
+    'Escape a string literal of a filter'
+    return value.replace("'", "''")
+
+
+def filter_expression(filters: dict) -> Optional[str]:
+    'OData filter matching the filters, None when there is nothing to filter'
+    filters = normalize_filters(filters)
+    clauses = []
+    if 'filenames' in filters:
+        clauses.append(f"search.in({FIELDS_FILENAME}, '{escape_value('|'.join(filters['filenames']))}', '|')")
+    if 'tags' in filters:
+        clauses.append(f"{FIELDS_TAGS}/any(t: search.in(t, '{escape_value('|'.join(filters['tags']))}', '|'))")
+    if 'groups' in filters:
+        # The chunks without any group are readable by everyone
+        public = f"not {FIELDS_GROUPS}/any()"
+        clauses.append(f"({FIELDS_GROUPS}/any(g: search.in(g, '{escape_value('|'.join(filters['groups']))}', '|'))"
+                       f" or {public})" if filters['groups'] else public)
+    if 'ingested_after' in filters:
+        clauses.append(f"{FIELDS_INGEST_DATE} ge {filters['ingested_after']}")
+    if 'ingested_before' in filters:
+        clauses.append(f"{FIELDS_INGEST_DATE} le {filters['ingested_before']}")
+    return ' and '.join(clauses) if clauses else None
+
+
 class AzureSearch(VectorStore):
     'Helper Class to support Azure Search vector store.'
     def __init__(
@@ -128,6 +179,7 @@ class AzureSearch(VectorStore):
         embedding_function: Callable,
         semantic_configuration_name: str = '',
         semantic_query_language: str = 'en-us',
+        aembedding_function: Callable = None,
         **kwargs: Any,
     ):
         'Initialize with necessary components.'
@@ -142,6 +194,7 @@ class AzureSearch(VectorStore):
             )
         # Initialize base class
         self.embedding_function = embedding_function
+        self.aembedding_function = aembedding_function
         self.azure_cognitive_search_name = azure_cognitive_search_name
         self.azure_cognitive_search_key = azure_cognitive_search_key
         self.index_name = index_name
@@ -152,6 +205,23 @@ class AzureSearch(VectorStore):
             self.azure_cognitive_search_key,
             self.index_name,
             self.semantic_configuration_name)
+        # Created on the first async search, in the event loop using it
+        self.async_client: AsyncSearchClient = None
+
+    def get_async_client(self) -> AsyncSearchClient:
+        'Get the client of the async searches'
+        if self.async_client is None:
+            credential = AzureKeyCredential(self.azure_cognitive_search_key) \
+                if self.azure_cognitive_search_key else AsyncDefaultAzureCredential()
+            self.async_client = AsyncSearchClient(endpoint=self.azure_cognitive_search_name,
+                                                  index_name=self.index_name, credential=credential)
+        return self.async_client
+
+    async def aembed_query(self, query: str) -> List[float]:
+        'Embed the query without blocking the event loop'
+        if self.aembedding_function is not None:
+            return await self.aembedding_function(query)
+        return await asyncio.to_thread(self.embedding_function, query)
 
     def add_texts(
         self,
@@ -161,6 +231,7 @@ class AzureSearch(VectorStore):
     ) -> List[str]:
         'Add texts data to an existing index.'
         keys = kwargs.get('keys')
+        embeddings = kwargs.get('embeddings')
         keys = list(map(lambda x: x.replace(':','_'), keys)) if keys else None
         ids = []
         # Write data to index
@@ -176,12 +247,18 @@ class AzureSearch(VectorStore):
                 FIELDS_TITLE : metadata.get(FIELDS_TITLE,
                                             metadata.get('source',
                                                          '[]').split('[')[1].split(']')[0]),
-                FIELDS_TAG: metadata.get(FIELDS_TAG, ''),
+                FIELDS_TAG: metadata.get(FIELDS_TAG, ', '.join(metadata.get('tags', []))),
                 FIELDS_CONTENT: text,
                 FIELDS_CONTENT_VECTOR: np.array(
-                    self.embedding_function(text), dtype=np.float32
+                    embeddings[i] if embeddings else self.embedding_function(text),
+                    dtype=np.float32
                 ).tolist(),
-                FIELDS_METADATA: json.dumps(metadata)
+                FIELDS_METADATA: json.dumps(metadata),
+                FIELDS_FILENAME: metadata.get('filename', ''),
+                FIELDS_CONTENT_HASH: metadata.get('content_hash', ''),
+                FIELDS_TAGS: metadata.get('tags', []),
+                FIELDS_GROUPS: metadata.get('groups', []),
+                FIELDS_INGEST_DATE: metadata.get('ingest_date')
             })
             ids.append(key)
             # Upload data in batches
@@ -202,6 +279,10 @@ class AzureSearch(VectorStore):
             #pylint: disable=broad-exception-raised
             raise Exception(response)
 
+    def build_filter(self, filters: dict) -> Optional[str]:
+        'OData filter of the searches matching the filters'
+        return filter_expression(filters)
+
     def similarity_search(
         self, query: str, k: int = 4, **kwargs: Any
     ) -> List[Document]:
@@ -251,6 +332,44 @@ class AzureSearch(VectorStore):
         ]
         return docs
 
+    async def asimilarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, filters: str = None, query: str = None
+    ) -> List[Document]:
+        '''Return the documents most similar to the embedding with the async client.
+
+        Args:
+            embedding: Embedding to look up documents similar to.
+            k: Number of Documents to return. Defaults to 4.
+            filters: OData filter applied before the vector search.
+            query: Text of the query, the search is hybrid when it is given.
+
+        Returns:
+            List of Documents most similar to the embedding
+        '''
+        results = await self.get_async_client().search(
+            search_text=query or '',
+            vector=Vector(value=np.array(embedding, dtype=np.float32).tolist(), k=k, fields=FIELDS_CONTENT_VECTOR),
+            select=[f'{FIELDS_TITLE},{FIELDS_CONTENT},{FIELDS_METADATA}'],
+            filter=filters,
+            top=k
+        )
+        return [Document(page_content=result[FIELDS_CONTENT], metadata=json.loads(result[FIELDS_METADATA]))
+                async for result in results]
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        'Return the documents most similar to the query without blocking the event loop'
+        return await self.asimilarity_search_by_vector(
+            await self.aembed_query(query), k=k, filters=kwargs.get('filters', None))
+
+    async def ahybrid_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        'Return the most similar documents to the query with an hybrid query without blocking the event loop'
+        return await self.asimilarity_search_by_vector(
+            await self.aembed_query(query), k=k, filters=kwargs.get('filters', None), query=query)
+
     def hybrid_search(
         self, query: str, k: int = 4, **kwargs: Any
     ) -> List[Document]:
@@ -402,6 +521,95 @@ class AzureSearch(VectorStore):
         return index_client.get_index(name=self.index_name)
 
 
+    def get_chunk_hashes(self, filename: str) -> Dict[str, str]:
+        'Get the content hash of every chunk stored for a file'
+        escaped_filename = filename.replace("'", "''")
+        results = self.client.search(
+            search_text='*',
+            filter=f"{FIELDS_FILENAME} eq '{escaped_filename}'",
+            select=[FIELDS_METADATA]
+        )
+        hashes = {}
+        for result in results:
+            metadata = json.loads(result[FIELDS_METADATA])
+            hashes[metadata['key']] = metadata.get('content_hash', '')
+        return hashes
+
+    def get_files(self) -> Dict[str, int]:
+        'Get the number of chunks of every file of the index'
+        results = self.client.search(search_text='*', top=0,
+                                     facets=[f"{FIELDS_FILENAME},count:{MAX_FACET_COUNT}"])
+        return {facet['value']: facet['count']
+                for facet in (results.get_facets() or {}).get(FIELDS_FILENAME, [])}
+
+    def get_file_keys(self, filename: str) -> List[str]:
+        'Get the keys of the chunks of a file'
+        escaped_filename = filename.replace("'", "''")
+        results = self.client.search(
+            search_text='*',
+            filter=f"{FIELDS_FILENAME} eq '{escaped_filename}'",
+            select=[FIELDS_METADATA]
+        )
+        return sorted(json.loads(result[FIELDS_METADATA])['key'] for result in results)
+
+    def delete_file(self, filename: str) -> int:
+        'Delete all the chunks of a file, return the number of chunks deleted'
+        # Azure Search has no delete by query, the keys are found with the filename filter
+        keys = self.get_file_keys(filename)
+        if keys:
+            self.delete_keys(keys)
+        return len(keys)
+
+    def delete_all(self) -> None:
+        'Delete every chunk of the index, also the ones of no file'
+        # Collect the keys first, deleting while paging would shift the pages
+        keys = [document.metadata['key'] for documents in self.iter_documents(include_content=False)
+                for document in documents]
+        if keys:
+            self.delete_keys(keys)
+
+    def iter_documents(self, page_size: int = 1000,
+                       include_content: bool = True) -> Iterator[List[Document]]:
+        'Yield all the documents of the index in pages, without any embedding call'
+        select = [FIELDS_ID, FIELDS_METADATA, FIELDS_CONTENT] if include_content else [FIELDS_ID, FIELDS_METADATA]
+        # The service caps $top at 1000 and $skip at 100000, so page on the key instead of skipping
+        top = min(page_size, 1000)
+        last_id = None
+        while True:
+            page_filter = f"{FIELDS_ID} gt '{last_id.replace(chr(39), chr(39) * 2)}'" \
+                if last_id is not None else None
+            try:
+                results = list(self.client.search(search_text='*', select=select, top=top,
+                                                  filter=page_filter, order_by=[FIELDS_ID]))
+            except HttpResponseError:
+                if last_id is not None:
+                    raise
+                # Indexes created before the key was sortable can only be read up to the $skip cap
+                logger.warning('The key of index %s is not sortable, only the first 100000 documents are listed',
+                               self.index_name)
+                yield from self.iter_documents_skip(select, top)
+                return
+            if results:
+                yield [Document(page_content=result.get(FIELDS_CONTENT) or '',
+                                metadata=json.loads(result[FIELDS_METADATA]))
+                       for result in results]
+            if len(results) < top:
+                return
+            last_id = results[-1][FIELDS_ID]
+
+    def iter_documents_skip(self, select: List[str], top: int) -> Iterator[List[Document]]:
+        'Yield the documents of the index in pages, up to the $skip cap of the service'
+        skip = 0
+        while skip <= 100000:
+            results = list(self.client.search(search_text='*', select=select, top=top, skip=skip))
+            if results:
+                yield [Document(page_content=result.get(FIELDS_CONTENT) or '',
+                                metadata=json.loads(result[FIELDS_METADATA]))
+                       for result in results]
+            if len(results) < top:
+                return
+            skip += len(results)
+
     def delete_keys(self, keys: List[str]):
         'Delete keys from the index'
         documents = []
@@ -426,6 +634,7 @@ class AzureSearchVectorStoreRetriever(BaseRetriever, BaseModel):
     search_type: str = 'similarity'
     k: int = 4
     score_threshold: float = 0.4
+    filters: Optional[str] = None
 
     class Config:
         'Configuration for this pydantic object.'
@@ -442,15 +651,25 @@ class AzureSearchVectorStoreRetriever(BaseRetriever, BaseModel):
     def get_relevant_documents(self, query: str) -> List[Document]:
         'Get relevant documents from Azure Search.'
         if self.search_type == 'similarity':
-            docs = self.vectorstore.similarity_search(query, k=self.k)
+            docs = self.vectorstore.similarity_search(query, k=self.k, filters=self.filters)
         elif self.search_type == 'hybrid':
-            docs = self.vectorstore.hybrid_search(query, k=self.k)
+            docs = self.vectorstore.hybrid_search(query, k=self.k, filters=self.filters)
         elif self.search_type == 'semantic_hybrid':
-            docs = self.vectorstore.semantic_hybrid_search(query, k=self.k)
+            docs = self.vectorstore.semantic_hybrid_search(query, k=self.k, filters=self.filters)
         else:
             raise ValueError(f'search_type of {self.search_type} not allowed.')
         return docs
 
     async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError(
-            'AzureSearchVectorStoreRetriever does not support async')
+        'Get relevant documents from Azure Search with the async client.'
+        if self.search_type == 'similarity':
+            docs = await self.vectorstore.asimilarity_search(query, k=self.k, filters=self.filters)
+        elif self.search_type == 'hybrid':
+            docs = await self.vectorstore.ahybrid_search(query, k=self.k, filters=self.filters)
+        elif self.search_type == 'semantic_hybrid':
+            # The semantic answers and captions are only read with the sync client
+            docs = await asyncio.to_thread(self.vectorstore.semantic_hybrid_search,
+                                           query, k=self.k, filters=self.filters)
+        else:
+            raise ValueError(f'search_type of {self.search_type} not allowed.')
+        return docs
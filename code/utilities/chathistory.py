@@ -0,0 +1,63 @@
+'''Helper functions to keep the chat history within a token budget'''
+
+import os
+from typing import Callable, List, Tuple
+
+import tiktoken
+from dotenv import load_dotenv
+
+SUMMARY_QUESTION = 'What did we discuss so far?'
+
+SUMMARY_PROMPT = """Progressively summarize the conversation below, adding onto the previous summary.
+Keep the names, numbers and facts the user may refer to later. Reply with the new summary only.
+
+Previous summary:
+{summary}
+
+New lines of the conversation:
+{lines}
+
+New summary:"""
+
+
+class ChatHistory:
+    'Chat history keeping the latest turns verbatim and the older ones in a rolling summary'
+    def __init__(self, summarize: Callable[[str], str], max_tokens: int = None,
+                 summary_max_tokens: int = None, encoding_name: str = 'cl100k_base'):
+        load_dotenv()
+
+        self.summarize = summarize
+        self.max_tokens: int = int(os.getenv('CHAT_HISTORY_MAX_TOKENS', 1000)) if max_tokens is None else max_tokens
+        self.summary_max_tokens: int = int(os.getenv('CHAT_HISTORY_SUMMARY_MAX_TOKENS', 300)) \
+            if summary_max_tokens is None else summary_max_tokens
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.summary = ''
+        self.turns: List[Tuple[str, str]] = []
+        self.turn_tokens: List[int] = []
+
+    def add_turn(self, question: str, answer: str) -> None:
+        'Add a turn, folding the oldest turns into the summary once over the token budget'
+        self.turns.append((question, answer))
+        self.turn_tokens.append(len(self.encoding.encode(f"{question}\n{answer}")))
+        evicted = []
+        # The latest turn is always kept verbatim
+        while len(self.turns) > 1 and sum(self.turn_tokens) > self.max_tokens:
+            evicted.append(self.turns.pop(0))
+            self.turn_tokens.pop(0)
+        if evicted:
+            # Only the evicted turns are summarized, the cost of a turn does not grow with the session
+            lines = "\n".join(f"Human: {human}\nAssistant: {ai}" for human, ai in evicted)
+            summary = self.summarize(SUMMARY_PROMPT.format(summary=self.summary or 'None', lines=lines))
+            self.summary = self.encoding.decode(self.encoding.encode(summary.strip())[:self.summary_max_tokens])
+
+    def get_turns(self) -> List[Tuple[str, str]]:
+        'Get the history to send with a question, the summary first'
+        if self.summary:
+            return [(SUMMARY_QUESTION, self.summary)] + self.turns
+        return list(self.turns)
+
+    def clear(self) -> None:
+        'Forget the conversation'
+        self.summary = ''
+        self.turns = []
+        self.turn_tokens = []
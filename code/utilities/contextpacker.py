@@ -0,0 +1,116 @@
+'''Helper functions to pack the retrieved chunks in the prompt'''
+
+import os
+import logging
+from typing import Dict, List, Tuple
+
+import tiktoken
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+logger = logging.getLogger()
+
+# Shortest common text considered as the overlap of two adjacent chunks
+MIN_OVERLAP_CHARACTERS = 16
+# Smallest remainder of the budget worth filling with a trimmed chunk
+MIN_TRIMMED_TOKENS = 50
+
+
+def merge_overlapping(first: str, second: str) -> str:
+    'Join two adjacent chunks, keeping their overlapping text once'
+    for size in range(min(len(first), len(second)), MIN_OVERLAP_CHARACTERS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first}\n{second}"
+
+
+def get_encoding(model: str = None) -> tiktoken.Encoding:
+    'Tokenizer of a model, cl100k_base when the model is unknown to tiktoken'
+    if model:
+        try:
+            # Azure names the GPT-3.5 models gpt-35-*
+            return tiktoken.encoding_for_model(model.replace('gpt-35', 'gpt-3.5'))
+        except KeyError:
+            logger.info('No tokenizer known for the model %s, counting the tokens with cl100k_base', model)
+    return tiktoken.get_encoding('cl100k_base')
+
+
+class ContextPacker:
+    'Deduplicate the retrieved chunks and fit them in a token budget, in relevance order'
+    def __init__(self, max_tokens: int = None, model: str = None):
+        load_dotenv()
+
+        self.max_tokens: int = int(os.getenv('CONTEXT_MAX_TOKENS', 2500)) if max_tokens is None else max_tokens
+        # Count the tokens like the completion model of the deployment
+        model = os.getenv("OPENAI_ENGINE", os.getenv("OPENAI_ENGINES", "text-davinci-003")) if model is None else model
+        self.encoding = get_encoding(model)
+
+    def count_tokens(self, document: Document) -> int:
+        'Number of tokens of a chunk as formatted by the stuff chain'
+        return len(self.encoding.encode(
+            f"Content: {document.page_content}\nSource: {document.metadata.get('source', '')}"))
+
+    def merge_adjacent(self, documents: List[Document]) -> List[Document]:
+        'Merge the chunks which follow each other in the same file, at the rank of the most relevant one'
+        ranks = {}
+        for rank, document in enumerate(documents):
+            chunk = document.metadata.get('chunk')
+            if chunk is not None:
+                ranks[(document.metadata.get('source'), chunk)] = rank
+        merged = []
+        absorbed = set()
+        for rank, document in enumerate(documents):
+            if rank in absorbed:
+                continue
+            source, chunk = document.metadata.get('source'), document.metadata.get('chunk')
+            if chunk is None:
+                merged.append(document)
+                continue
+            # Walk back to the first chunk of the run, then forward to its last one
+            first = chunk
+            while (source, first - 1) in ranks and ranks[(source, first - 1)] not in absorbed:
+                first -= 1
+            text, last = None, first
+            while (source, last) in ranks and ranks[(source, last)] not in absorbed:
+                part = documents[ranks[(source, last)]].page_content
+                text = part if text is None else merge_overlapping(text, part)
+                absorbed.add(ranks[(source, last)])
+                last += 1
+            merged.append(Document(page_content=text,
+                                   metadata={**documents[ranks[(source, first)]].metadata,
+                                             'chunks': list(range(first, last))}))
+        return merged
+
+    def pack(self, documents: List[Document]) -> Tuple[List[Document], Dict[str, int]]:
+        'Select the chunks to put in the prompt and the tokens saved by packing them'
+        tokens_before = sum(self.count_tokens(document) for document in documents)
+        unique = []
+        seen = set()
+        for document in documents:
+            if document.page_content not in seen:
+                seen.add(document.page_content)
+                unique.append(document)
+
+        packed = []
+        budget = self.max_tokens
+        for document in self.merge_adjacent(unique):
+            tokens = self.count_tokens(document)
+            if tokens <= budget:
+                packed.append(document)
+                budget -= tokens
+                continue
+            if budget >= MIN_TRIMMED_TOKENS:
+                # Trim the chunk to the remaining budget, keeping room for the source line
+                overhead = tokens - len(self.encoding.encode(document.page_content))
+                content = self.encoding.encode(document.page_content)[:max(budget - overhead, 0)]
+                if content:
+                    packed.append(Document(page_content=self.encoding.decode(content),
+                                           metadata=document.metadata))
+            break
+
+        tokens_after = sum(self.count_tokens(document) for document in packed)
+        stats = {'chunks': len(documents), 'packed_chunks': len(packed),
+                 'tokens_before': tokens_before, 'tokens_after': tokens_after,
+                 'tokens_saved': tokens_before - tokens_after}
+        logger.info('Context packed from %d to %d tokens', tokens_before, tokens_after)
+        return packed, stats
@@ -0,0 +1,354 @@
+'''Helper functions for batched embedding generation'''
+
+import os
+import re
+import asyncio
+import logging
+import hashlib
+import sqlite3
+import time
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List
+
+import numpy as np
+import openai
+import redis
+import redis.asyncio
+import tiktoken
+from dotenv import load_dotenv
+
+from utilities.ratelimiter import call_with_backoff, call_with_retry, get_rate_limiter
+
+logger = logging.getLogger()
+
+# Encoding used by the ada-002 family of embedding models
+EMBEDDINGS_ENCODING = 'cl100k_base'
+
+
+def iter_batches(texts: List[str], batch_size: int, max_tokens: int,
+                 encoding: tiktoken.Encoding) -> Iterator[List[int]]:
+    'Yield lists of indexes of texts so that every batch respects the size and token caps'
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = len(encoding.encode(text))
+        if batch and (len(batch) == batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def embedding_cache_key(engine: str, text: str) -> str:
+    'Content address of a text for a given embedding deployment'
+    normalized = re.sub(r'\s+', ' ', text).strip()
+    return hashlib.sha1(f"{engine}\n{normalized}".encode('utf-8')).hexdigest()
+
+
+class RedisEmbeddingsCache:
+    'Embeddings cache stored in Redis'
+    def __init__(self, redis_url: str = None, client: redis.Redis = None, prefix: str = 'embedding',
+                 ttl: int = None):
+        self.client = client if client is not None else redis.from_url(redis_url)
+        self.prefix = prefix
+        # Seconds an embedding stays cached, 0 keeps it until Redis evicts it
+        self.ttl: int = int(os.getenv('EMBEDDINGS_CACHE_TTL', 2592000)) if ttl is None else ttl
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        'Get the cached embeddings for the keys, missing keys are left out'
+        if not keys:
+            return {}
+        try:
+            values = self.client.mget([f"{self.prefix}:{key}" for key in keys])
+        except redis.RedisError as exc:
+            # The cache is an optimization, embed everything when it is unavailable
+            logger.warning('Embeddings cache unavailable, computing all the embeddings: %s', exc)
+            return {}
+        return {key: np.frombuffer(value, dtype=np.float32).tolist()
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items: Dict[str, List[float]]) -> None:
+        'Store the embeddings in the cache'
+        pipeline = self.client.pipeline(transaction=False)
+        for key, embedding in items.items():
+            pipeline.set(f"{self.prefix}:{key}", np.array(embedding, dtype=np.float32).tobytes(),
+                         ex=self.ttl or None)
+        try:
+            pipeline.execute()
+        except redis.RedisError as exc:
+            logger.warning('Embeddings cache unavailable, %d embeddings not cached: %s', len(items), exc)
+
+
+class LocalEmbeddingsCache:
+    'Embeddings cache stored in a local SQLite file'
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        'Open the file on first use, so processes that only answer questions never create it'
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        'Get the cached embeddings for the keys, missing keys are left out'
+        results = {}
+        with self.lock:
+            # Stay below the SQLite limit of bound parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch).fetchall()
+                results.update({key: np.frombuffer(value, dtype=np.float32).tolist()
+                                for key, value in rows})
+        return results
+
+    def set_many(self, items: Dict[str, List[float]]) -> None:
+        'Store the embeddings in the cache'
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)',
+                [(key, np.array(embedding, dtype=np.float32).tobytes())
+                 for key, embedding in items.items()])
+            self.connection.commit()
+
+
+def get_embeddings_cache(redis_url: str = None):
+    'Create the embeddings cache configured with EMBEDDINGS_CACHE_TYPE, the local file is opt-in'
+    cache_type = os.getenv('EMBEDDINGS_CACHE_TYPE', 'redis' if redis_url else 'none')
+    if cache_type == 'redis' and redis_url:
+        return RedisEmbeddingsCache(redis_url)
+    if cache_type == 'local':
+        return LocalEmbeddingsCache(os.getenv('EMBEDDINGS_CACHE_PATH',
+                                              os.path.join('.cache', 'embeddings.db')))
+    return None
+
+
+class BatchEmbeddings:
+    'Helper class to embed many texts per Azure OpenAI request'
+    def __init__(self, engine: str = None, batch_size: int = None, max_tokens: int = None,
+                 cache=None):
+        load_dotenv()
+
+        self.engine: str = engine if engine else \
+            os.getenv('OPENAI_EMBEDDINGS_ENGINE_DOC', 'text-embedding-ada-002')
+        self.batch_size: int = batch_size if batch_size else \
+            int(os.getenv('EMBEDDINGS_BATCH_SIZE', 16))
+        self.max_tokens: int = max_tokens if max_tokens else \
+            int(os.getenv('EMBEDDINGS_BATCH_MAX_TOKENS', 32000))
+        self.encoding = tiktoken.get_encoding(EMBEDDINGS_ENCODING)
+        self.cache = cache
+
+    def batches(self, texts: List[str]) -> Iterator[List[int]]:
+        'Split the texts into request sized batches of indexes'
+        return iter_batches(texts, self.batch_size, self.max_tokens, self.encoding)
+
+    def embed_batch(self, texts: Iterable[str]) -> List[List[float]]:
+        'Embed a single batch of texts with one request'
+        texts = list(texts)
+        response = call_with_retry(lambda: openai.Embedding.create(input=texts, engine=self.engine))
+        # The service does not guarantee the order of the returned embeddings
+        data = sorted(response['data'], key=lambda x: x['index'])
+        return [x['embedding'] for x in data]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        'Embed a list of texts, sending as many texts per request as allowed'
+        embeddings = [None] * len(texts)
+        # Reuse the embeddings already computed for identical texts
+        cache_keys = [embedding_cache_key(self.engine, text) for text in texts]
+        cached = self.cache.get_many(list(set(cache_keys))) if self.cache else {}
+        missing = [i for i, key in enumerate(cache_keys) if key not in cached]
+        for i, key in enumerate(cache_keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+        computed = {}
+        for batch in self.batches([texts[i] for i in missing]):
+            batch = [missing[i] for i in batch]
+            for i, embedding in zip(batch, self.embed_batch([texts[i] for i in batch])):
+                embeddings[i] = embedding
+                computed[cache_keys[i]] = embedding
+        if self.cache and computed:
+            self.cache.set_many(computed)
+        logger.info('Embedded %d texts with engine %s, %d served from cache',
+                    len(texts), self.engine, len(texts) - len(missing))
+        return embeddings
+
+    async def aembed_batch(self, texts: List[str], purpose: str = 'documents') -> List[List[float]]:
+        'Embed a single batch of texts with one request rate limited on the budget of the purpose'
+        tokens = sum(len(self.encoding.encode(text)) for text in texts)
+        response = await call_with_backoff(
+            get_rate_limiter(self.engine, purpose),
+            lambda: openai.Embedding.acreate(input=texts, engine=self.engine),
+            tokens)
+        data = sorted(response['data'], key=lambda x: x['index'])
+        return [x['embedding'] for x in data]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        'Asynchronously embed a batch of texts that fits in a single request'
+        cache_keys = [embedding_cache_key(self.engine, text) for text in texts]
+        cached = await asyncio.to_thread(self.cache.get_many, list(set(cache_keys))) \
+            if self.cache else {}
+        missing = [i for i, key in enumerate(cache_keys) if key not in cached]
+        embeddings = [cached.get(key) for key in cache_keys]
+        if missing:
+            computed = await self.aembed_batch([texts[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+            if self.cache:
+                await asyncio.to_thread(self.cache.set_many,
+                                        {cache_keys[i]: embeddings[i] for i in missing})
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        'Embed a single text'
+        return self.embed_batch([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        'Asynchronously embed a single text'
+        return (await self.aembed_batch([text], purpose='query'))[0]
+
+
+class QueryEmbeddingCache:
+    'In-process LRU in front of a shared Redis cache of query embeddings'
+    def __init__(self, embed_query: Callable[[str], List[float]], engine: str,
+                 redis_url: str = None, client: redis.Redis = None,
+                 max_size: int = None, ttl: int = None, prefix: str = 'query-embedding',
+                 aembed_query: Callable[[str], Awaitable[List[float]]] = None):
+        load_dotenv()
+
+        self.embed_query_function = embed_query
+        self.aembed_query_function = aembed_query
+        self.engine = engine
+        self.max_size: int = int(os.getenv('QUERY_EMBEDDINGS_CACHE_SIZE', 1024)) if max_size is None else max_size
+        self.ttl: int = int(os.getenv('QUERY_EMBEDDINGS_CACHE_TTL', 86400)) if ttl is None else ttl
+        self.prefix = prefix
+        self.client = client if client is not None else redis.from_url(redis_url) if redis_url else None
+        # Used by the async path, the connections are only opened on the first request
+        self.async_client = redis.asyncio.from_url(redis_url) if redis_url else None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def get_local(self, key: str):
+        'Get an embedding from the process cache, None when missing or expired'
+        with self.lock:
+            if key not in self.items:
+                return None
+            expires, embedding = self.items[key]
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return embedding
+
+    def set_local(self, key: str, embedding: List[float]) -> None:
+        'Add an embedding to the process cache, evicting the least recently used ones'
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, embedding)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get_shared(self, key: str):
+        'Get an embedding from Redis, the cache is skipped when Redis is unavailable'
+        try:
+            value = self.client.get(f"{self.prefix}:{key}")
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Query embeddings cache unavailable: %s', exc)
+            return None
+        return np.frombuffer(value, dtype=np.float32).tolist() if value is not None else None
+
+    async def aget_shared(self, key: str):
+        'Get an embedding from Redis without blocking the event loop'
+        try:
+            value = await self.async_client.get(f"{self.prefix}:{key}")
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Query embeddings cache unavailable: %s', exc)
+            return None
+        return np.frombuffer(value, dtype=np.float32).tolist() if value is not None else None
+
+    async def aset_shared(self, key: str, embedding: List[float]) -> None:
+        'Store an embedding in Redis with the cache TTL without blocking the event loop'
+        try:
+            await self.async_client.set(f"{self.prefix}:{key}", np.array(embedding, dtype=np.float32).tobytes(),
+                                        ex=self.ttl)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Query embeddings cache unavailable: %s', exc)
+
+    def set_shared(self, key: str, embedding: List[float]) -> None:
+        'Store an embedding in Redis with the cache TTL'
+        try:
+            self.client.set(f"{self.prefix}:{key}", np.array(embedding, dtype=np.float32).tobytes(),
+                            ex=self.ttl)
+        except redis.exceptions.RedisError as exc:
+            logger.warning('Query embeddings cache unavailable: %s', exc)
+
+    def count(self, counter: str) -> None:
+        'Increment a hit or miss counter'
+        with self.lock:
+            self.counters[counter] += 1
+
+    def embed_query(self, text: str) -> List[float]:
+        'Embed a query, skipping the Azure OpenAI request when it was embedded recently'
+        key = embedding_cache_key(self.engine, text)
+        embedding = self.get_local(key)
+        if embedding is not None:
+            self.count('local_hits')
+            return embedding
+        embedding = self.get_shared(key) if self.client is not None else None
+        if embedding is not None:
+            self.count('shared_hits')
+        else:
+            self.count('misses')
+            embedding = self.embed_query_function(text)
+            if self.client is not None:
+                self.set_shared(key, embedding)
+        if self.max_size > 0:
+            self.set_local(key, embedding)
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        'Embed a query with async Redis and Azure OpenAI requests'
+        key = embedding_cache_key(self.engine, text)
+        embedding = self.get_local(key)
+        if embedding is not None:
+            self.count('local_hits')
+            return embedding
+        if self.async_client is not None:
+            embedding = await self.aget_shared(key)
+        else:
+            embedding = await asyncio.to_thread(self.get_shared, key) if self.client is not None else None
+        if embedding is not None:
+            self.count('shared_hits')
+        else:
+            self.count('misses')
+            embedding = await self.aembed_query_function(text) if self.aembed_query_function is not None \
+                else await asyncio.to_thread(self.embed_query_function, text)
+            if self.async_client is not None:
+                await self.aset_shared(key, embedding)
+            elif self.client is not None:
+                await asyncio.to_thread(self.set_shared, key, embedding)
+        if self.max_size > 0:
+            self.set_local(key, embedding)
+        return embedding
+
+    def stats(self) -> Dict[str, float]:
+        'Hit and miss counters of the cache'
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.items)
+        total = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['local_hits'] + stats['shared_hits']) / total if total else 0.0
+        return stats
@@ -0,0 +1,55 @@
+'''Helper functions for the metadata filters of the retrieval'''
+
+from datetime import date, datetime, time, timezone
+from typing import Any, Dict, List, Optional, Union
+
+FILTER_FIELDS = ('filenames', 'tags', 'groups', 'ingested_after', 'ingested_before')
+
+
+def split_values(values: Union[str, List[str], None]) -> List[str]:
+    'List of values from a list or a comma separated string, without blanks and duplicates'
+    if values is None:
+        return []
+    if isinstance(values, str):
+        values = values.split(',')
+    return list(dict.fromkeys(str(value).strip() for value in values if str(value).strip()))
+
+
+def to_timestamp(value: Union[str, int, float, date, datetime]) -> int:
+    'Seconds since the epoch of a timestamp, a date or an ISO 8601 string, UTC when naive'
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip())
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Validate the filters of a request.
+
+    Filenames, tags and groups are lists or comma separated strings, a chunk matches when it has
+    one of the values. Chunks without any group are readable by everyone, an empty list of groups
+    only matches them. The ingestion dates are timestamps, dates or ISO 8601 strings.
+    '''
+    if not filters:
+        return {}
+    if not isinstance(filters, dict):
+        raise TypeError(f"Filters must be an object with the fields {list(FILTER_FIELDS)}")
+    unknown = set(filters) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filters {sorted(unknown)}, use {list(FILTER_FIELDS)}")
+    normalized = {}
+    for field in ('filenames', 'tags'):
+        values = split_values(filters.get(field))
+        if values:
+            normalized[field] = values
+    if filters.get('groups') is not None:
+        normalized['groups'] = split_values(filters['groups'])
+    for field in ('ingested_after', 'ingested_before'):
+        if filters.get(field) not in (None, ''):
+            normalized[field] = to_timestamp(filters[field])
+    return normalized
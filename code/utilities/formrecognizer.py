@@ -1,63 +1,180 @@
 '''Helper functions for Azure Form Recognizer'''
 
 import os
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
+# Error codes of the service for a page range starting after the last page of the document
+INVALID_PAGE_RANGE_CODES = ('InvalidArgument', 'InvalidParameter')
+
+
+def is_invalid_page_range(exc: HttpResponseError) -> bool:
+    'Whether the service rejected the requested page range, any other failure is a real error'
+    error = getattr(exc, 'error', None)
+    codes = {getattr(error, 'code', None), (getattr(error, 'innererror', None) or {}).get('code')}
+    return exc.status_code == 400 and bool(codes & set(INVALID_PAGE_RANGE_CODES)) and \
+        'page' in str(exc).lower()
+
+
 class AzureFormRecognizerClient:
     'Helper functions for Azure Form Recognizer'
-    def __init__(self, form_recognizer_endpoint: str = '', form_recognizer_key: str = ''):
+    def __init__(self, form_recognizer_endpoint: str = '', form_recognizer_key: str = '',
+                 document_analysis_client: DocumentAnalysisClient = None):
         'Initialize the class'
         load_dotenv()
 
         self.pages_per_embeddings = int(os.getenv('PAGES_PER_EMBEDDINGS', 2))
         self.section_to_exclude = ['footnote', 'pageHeader', 'pageFooter', 'pageNumber']
+        # Split the analysis in page ranges analyzed concurrently, 0 analyzes the whole document at once
+        self.pages_per_request = int(os.getenv('FORM_RECOGNIZER_PAGES_PER_REQUEST', 0))
+        self.max_parallelism = int(os.getenv('FORM_RECOGNIZER_MAX_PARALLELISM', 4))
 
         #pylint: disable=line-too-long
         self.form_recognizer_endpoint : str = form_recognizer_endpoint if form_recognizer_endpoint else os.getenv('FORM_RECOGNIZER_ENDPOINT')
         #pylint: disable=line-too-long
         self.form_recognizer_key : str = form_recognizer_key if form_recognizer_key else os.getenv('FORM_RECOGNIZER_KEY')
+        self.document_analysis_client = document_analysis_client
 
-    def analyze_read(self, form_url):
-        'Analyze the document and return the text'
-        document_analysis_client = DocumentAnalysisClient(
-            endpoint=self.form_recognizer_endpoint,
-            credential=AzureKeyCredential(self.form_recognizer_key)
-        )
+    def get_document_analysis_client(self):
+        'Get the Document Analysis client'
+        if self.document_analysis_client is None:
+            self.document_analysis_client = DocumentAnalysisClient(
+                endpoint=self.form_recognizer_endpoint,
+                credential=AzureKeyCredential(self.form_recognizer_key)
+            )
+        return self.document_analysis_client
 
-        poller = document_analysis_client.begin_analyze_document_from_url(
-                "prebuilt-layout", form_url)
+    def analyze_pages(self, form_url, pages=None):
+        'Analyze the layout of a page range, all pages if not set'
+        kwargs = {'pages': pages} if pages else {}
+        poller = self.get_document_analysis_client().begin_analyze_document_from_url(
+                "prebuilt-layout", form_url, **kwargs)
         layout = poller.result()
+        # Keep only what is needed to build the text
+        return {
+            'page_count': len(layout.pages),
+            'paragraphs': [[doc_p.bounding_regions[0].page_number, doc_p.role, doc_p.content]
+                           for doc_p in layout.paragraphs],
+            'tables': [[doc_t.bounding_regions[0].page_number,
+                        [[doc_c.row_index, doc_c.content] for doc_c in doc_t.cells]]
+                       for doc_t in layout.tables]
+        }
+
+    def analyze_layout(self, form_url):
+        'Analyze the layout of the document, in concurrent page ranges when configured'
+        if self.pages_per_request <= 0:
+            return self.analyze_pages(form_url)
+
+        def page_range(index):
+            first_page = index * self.pages_per_request + 1
+            return f"{first_page}-{first_page + self.pages_per_request - 1}"
+
+        def analyze_range(index):
+            try:
+                return self.analyze_pages(form_url, page_range(index))
+            except HttpResponseError as exc:
+                # Only a range past the end of the document marks its end, throttling and
+                # service errors must not truncate the layout stored in the layout cache
+                if is_invalid_page_range(exc):
+                    return exc
+                raise
 
+        # The page count is unknown until the end of the document is reached
+        results = [analyze_range(0)]
+        with ThreadPoolExecutor(max_workers=self.max_parallelism) as executor:
+            while not isinstance(results[-1], Exception) and \
+                    results[-1]['page_count'] == self.pages_per_request:
+                start = len(results)
+                results.extend(executor.map(analyze_range, range(start, start + self.max_parallelism)))
+                # Keep the ranges up to the first incomplete one
+                for i in range(start, len(results)):
+                    if isinstance(results[i], Exception) or \
+                            results[i]['page_count'] < self.pages_per_request:
+                        # A range past the end fails, a failure followed by pages is a real error
+                        if isinstance(results[i], Exception) and \
+                                any(not isinstance(r, Exception) and r['page_count'] for r in results[i + 1:]):
+                            raise results[i]
+                        results = results[:i + 1]
+                        break
+        if isinstance(results[0], Exception):
+            raise results[0]
+        results = [result for result in results if not isinstance(result, Exception)]
+        return {
+            'page_count': sum(result['page_count'] for result in results),
+            'paragraphs': [paragraph for result in results for paragraph in result['paragraphs']],
+            'tables': [table for result in results for table in result['tables']]
+        }
+
+    def layout_to_text(self, layout):
+        'Group the paragraphs and tables of the layout in pages_per_embeddings sections'
         results = []
         # page_result = ''
-        for doc_p in layout.paragraphs:
-            page_number = doc_p.bounding_regions[0].page_number
+        for page_number, role, content in layout['paragraphs']:
             output_file_id = int((page_number - 1 ) / self.pages_per_embeddings)
 
-            if len(results) < output_file_id + 1:
+            while len(results) < output_file_id + 1:
                 results.append('')
 
-            if doc_p.role not in self.section_to_exclude:
-                results[output_file_id] += f"{doc_p.content}\n"
+            if role not in self.section_to_exclude:
+                results[output_file_id] += f"{content}\n"
 
-        for doc_t in layout.tables:
-            page_number = doc_t.bounding_regions[0].page_number
+        for page_number, cells in layout['tables']:
             output_file_id = int((page_number - 1 ) / self.pages_per_embeddings)
 
-            if len(results) < output_file_id + 1:
+            while len(results) < output_file_id + 1:
                 results.append('')
             previous_cell_row=0
             rowcontent='| '
             tablecontent = ''
-            for doc_c in doc_t.cells:
-                if doc_c.row_index == previous_cell_row:
-                    rowcontent += doc_c.content + " | "
+            for row_index, content in cells:
+                if row_index == previous_cell_row:
+                    rowcontent += content + " | "
                 else:
                     tablecontent += rowcontent + "\n"
                     rowcontent='|'
-                    rowcontent += doc_c.content + " | "
+                    rowcontent += content + " | "
                     previous_cell_row += 1
             results[output_file_id] += f"{tablecontent}|"
         return results
+
+    def analyze_read(self, form_url):
+        'Analyze the document and return the text'
+        return self.layout_to_text(self.analyze_layout(form_url))
+
+
+class LayoutCache:
+    'Cache of the layout analysis keyed by the MD5 of the analyzed file'
+    def __init__(self, blob_client=None, directory: str = None, prefix: str = 'converted/layout'):
+        self.blob_client = blob_client
+        self.directory = directory
+        self.prefix = prefix
+
+    def get(self, content_md5):
+        'Get the cached layout, None when the file was never analyzed'
+        if self.directory:
+            path = os.path.join(self.directory, f"{content_md5}.json.gz")
+            if not os.path.exists(path):
+                return None
+            with open(path, 'rb') as file:
+                data = file.read()
+        else:
+            data = self.blob_client.download_file(f"{self.prefix}/{content_md5}.json.gz")
+            if data is None:
+                return None
+        return json.loads(gzip.decompress(data))
+
+    def set(self, content_md5, layout):
+        'Store the layout of a file'
+        data = gzip.compress(json.dumps(layout, separators=(',', ':')).encode('utf-8'))
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, f"{content_md5}.json.gz"), 'wb') as file:
+                file.write(data)
+        else:
+            self.blob_client.upload_file(data, f"{self.prefix}/{content_md5}.json.gz",
+                                         content_type='application/gzip')
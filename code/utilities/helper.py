@@ -1,38 +1,52 @@
 '''Main Helper class for the Azure OpenAI Embeddings QnA project'''
 
+from __future__ import annotations
+
 import os
+import copy
+import asyncio
 import logging
+import queue
+import threading
 import re
+import time
 import hashlib
+import itertools
 import urllib
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+import numpy as np
 import openai
+import requests
 from dotenv import load_dotenv
 
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.llms import AzureOpenAI
 from langchain.vectorstores.base import VectorStore
-# from langchain.chains import ChatVectorDBChain
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.chains.llm import LLMChain
-from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
 from langchain.prompts import PromptTemplate
-from langchain.document_loaders.base import BaseLoader
-from langchain.document_loaders import WebBaseLoader
 from langchain.text_splitter import TokenTextSplitter, TextSplitter
-# from langchain.document_loaders.base import BaseLoader
-# from langchain.document_loaders import TextLoader
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage
+from langchain.docstore.document import Document
 
-from utilities.formrecognizer import AzureFormRecognizerClient
+from utilities.contextpacker import ContextPacker
+from utilities.answercache import AnswerCache, SemanticAnswerCache
+from utilities.embeddings import BatchEmbeddings, QueryEmbeddingCache, get_embeddings_cache
 from utilities.azureblobstorage import AzureBlobStorageClient
-from utilities.translator import AzureTranslatorClient
 from utilities.customprompt import PROMPT
-from utilities.redis import RedisExtended
-from utilities.azuresearch import AzureSearch
-import pandas as pd
-from fake_useragent import UserAgent
+from utilities.filters import normalize_filters, split_values
+from utilities.streaming import AnswerStreamer, AsyncQueueCallbackHandler, QueueCallbackHandler, strip_sources
+
+# Heavy modules are imported on first use to keep the cold start of the Function Apps short
+if TYPE_CHECKING:
+    from langchain.document_loaders.base import BaseLoader
+    from utilities.formrecognizer import AzureFormRecognizerClient, LayoutCache
+    from utilities.translator import AzureTranslatorClient
+
+# The .env file is read once per process, get_llm_helper only compares the settings
+load_dotenv()
+
+MAX_HELPER_VARIANTS = 32
 
 class LLMHelper:
     'Helper class for the LLMChain class'
@@ -40,6 +54,7 @@ class LLMHelper:
         document_loaders : BaseLoader = None, 
         text_splitter: TextSplitter = None,
         embeddings: OpenAIEmbeddings = None,
+        batch_embeddings: BatchEmbeddings = None,
         llm: AzureOpenAI = None,
         temperature: float = None,
         max_tokens: int = None,
@@ -74,6 +89,10 @@ class LLMHelper:
             self.vector_store_address: str = os.getenv('AZURE_SEARCH_SERVICE_NAME')
             self.vector_store_password: str = os.getenv('AZURE_SEARCH_ADMIN_KEY')
 
+        elif self.vector_store_type == "Numpy":
+            # Embedded store, the path of the directory holding its files
+            self.vector_store_address: str = os.getenv('NUMPY_STORE_PATH', os.path.join('.cache', 'vectorstore'))
+
         else:
             # Vector store settings
             self.vector_store_address: str = os.getenv('REDIS_ADDRESS', "localhost")
@@ -86,131 +105,721 @@ class LLMHelper:
             else:
                 self.vector_store_full_address = f"{self.vector_store_protocol}{self.vector_store_address}:{self.vector_store_port}"
 
+        # Redis used for caching, defaults to the Redis vector store when there is one
+        self.cache_redis_url: str = os.getenv('CACHE_REDIS_URL', '' if self.vector_store_type in ("AzureSearch", "Numpy") else self.vector_store_full_address)
+
         self.chunk_size = int(os.getenv('CHUNK_SIZE', 500))
         self.chunk_overlap = int(os.getenv('CHUNK_OVERLAP', 100))
-        self.document_loaders: BaseLoader = WebBaseLoader if document_loaders is None else document_loaders
+        self.streaming_section_size: int = int(os.getenv('STREAMING_SECTION_SIZE', 20000))
+        self.ingestion_max_concurrency: int = int(os.getenv('INGESTION_MAX_CONCURRENCY', 8))
+        self.incremental_indexing: bool = os.getenv('INCREMENTAL_INDEXING', 'true') == 'true'
+        self.document_loaders: BaseLoader = document_loaders
         self.text_splitter: TextSplitter = TokenTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap) if text_splitter is None else text_splitter
         self.embeddings: OpenAIEmbeddings = OpenAIEmbeddings(model=self.model, chunk_size=1) if embeddings is None else embeddings
-        if self.deployment_type == "Chat":
-            self.llm: ChatOpenAI = ChatOpenAI(model_name=self.deployment_name,
-                                              engine=self.deployment_name,
-                                              temperature=self.temperature,
-                                              max_tokens=self.max_tokens if self.max_tokens != -1 else None) if llm is None else llm
-        else:
-            self.llm: AzureOpenAI = AzureOpenAI(deployment_name=self.deployment_name,
-                                                temperature=self.temperature,
-                                                max_tokens=self.max_tokens) if llm is None else llm
-        if self.vector_store_type == "AzureSearch":
+        self.batch_embeddings: BatchEmbeddings = BatchEmbeddings(engine=self.model, cache=get_embeddings_cache(self.cache_redis_url)) if batch_embeddings is None else batch_embeddings
+        self.query_embeddings: QueryEmbeddingCache = QueryEmbeddingCache(self.embeddings.embed_query, engine=self.model,
+                                                                         redis_url=self.cache_redis_url,
+                                                                         aembed_query=self.batch_embeddings.aembed_query)
+        self.llm: AzureOpenAI = self.create_llm() if llm is None else llm
+        self.streaming_llm: AzureOpenAI = self.create_llm(streaming=True) if llm is None else llm
+        # Answers are only cached when a Redis is available, their TTL is set with ANSWER_CACHE_TTL
+        self.answer_cache: AnswerCache = AnswerCache(redis_url=self.cache_redis_url, index_name=self.index_name) if self.cache_redis_url else None
+        self.semantic_cache: SemanticAnswerCache = SemanticAnswerCache(self.answer_cache) \
+            if self.answer_cache is not None and os.getenv('SEMANTIC_CACHE_ENABLED', 'true') == 'true' else None
+        if vector_store is not None:
+            self.vector_store: VectorStore = vector_store
+        elif self.vector_store_type == "AzureSearch":
+            from utilities.azuresearch import AzureSearch
             self.vector_store: VectorStore = AzureSearch(azure_cognitive_search_name=self.vector_store_address,
                                                          azure_cognitive_search_key=self.vector_store_password,
                                                          index_name=self.index_name,
-                                                         embedding_function=self.embeddings.embed_query) if vector_store is None else vector_store
+                                                         embedding_function=self.query_embeddings.embed_query,
+                                                         aembedding_function=self.query_embeddings.aembed_query)
+        elif self.vector_store_type == "Numpy":
+            from utilities.numpystore import NumpyVectorStore
+            self.vector_store: VectorStore = NumpyVectorStore(path=self.vector_store_address,
+                                                              index_name=self.index_name,
+                                                              embedding_function=self.query_embeddings.embed_query)
         else:
-            self.vector_store: RedisExtended = RedisExtended(redis_url=self.vector_store_full_address,
-                                                             index_name=self.index_name,
-                                                             embedding_function=self.embeddings.embed_query) if vector_store is None else vector_store   
-        self.k : int = 3 if k is None else k
+            from utilities.redis import RedisExtended
+            self.vector_store: VectorStore = RedisExtended(redis_url=self.vector_store_full_address,
+                                                           index_name=self.index_name,
+                                                           embedding_function=self.query_embeddings.embed_query)
+        # Chunks retrieved per question, filters narrow the candidates so a small k is enough
+        self.k : int = int(os.getenv('RETRIEVAL_K', 4)) if k is None else k
 
-        self.pdf_parser : AzureFormRecognizerClient = AzureFormRecognizerClient() if pdf_parser is None else pdf_parser
         self.blob_client: AzureBlobStorageClient = AzureBlobStorageClient() if blob_client is None else blob_client
+        self.layout_cache_type: str = os.getenv('LAYOUT_CACHE_TYPE', 'blob')
         self.enable_translation : bool = False if enable_translation is None else enable_translation
-        self.translator : AzureTranslatorClient = AzureTranslatorClient() if translator is None else translator
 
-        self.user_agent: UserAgent() = UserAgent()
-        self.user_agent.random
+        # Clients created on first use, the dict and its lock are shared with the variants of this helper
+        self.clients: dict = {}
+        self.clients_lock = threading.Lock()
+        if pdf_parser is not None:
+            self.clients['pdf_parser'] = pdf_parser
+        if translator is not None:
+            self.clients['translator'] = translator
+
+        # Retrieve for the raw follow-up question while it is condensed, reusing the results when close enough
+        self.speculative_retrieval: bool = os.getenv('SPECULATIVE_RETRIEVAL', 'false') == 'true'
+        self.speculative_retrieval_threshold: float = float(os.getenv('SPECULATIVE_RETRIEVAL_THRESHOLD', 0.95))
+        self.speculation_stats: dict = {'used': 0, 'discarded': 0}
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('SPECULATIVE_RETRIEVAL_WORKERS', 4)))
+        # Deduplicate the retrieved chunks and fit them in CONTEXT_MAX_TOKENS
+        self.context_packer: ContextPacker = ContextPacker(model=self.deployment_name)
+        self.packing_stats: dict = {'requests': 0, 'tokens_saved': 0}
+        self.stats_lock = threading.Lock()
+
+        # Prompt and temperature variants sharing the clients of this helper
+        self.variants: dict = {}
+        self.variants_lock = threading.Lock()
+
+    @property
+    def pdf_parser(self) -> AzureFormRecognizerClient:
+        'Form Recognizer client, created on first use'
+        def create():
+            from utilities.formrecognizer import AzureFormRecognizerClient
+            return AzureFormRecognizerClient()
+        return self.get_client('pdf_parser', create)
+
+    @property
+    def translator(self) -> AzureTranslatorClient:
+        'Translator client, created on first use'
+        def create():
+            from utilities.translator import AzureTranslatorClient
+            return AzureTranslatorClient()
+        return self.get_client('translator', create)
+
+    @property
+    def layout_cache(self) -> LayoutCache:
+        'Cache of the layout analysis, None when LAYOUT_CACHE_TYPE is none'
+        def create():
+            from utilities.formrecognizer import LayoutCache
+            if self.layout_cache_type == 'blob':
+                return LayoutCache(blob_client=self.blob_client)
+            if self.layout_cache_type == 'local':
+                return LayoutCache(directory=os.getenv('LAYOUT_CACHE_DIR', os.path.join('.cache', 'layout')))
+            return None
+        return self.get_client('layout_cache', create)
 
-    def add_embeddings_lc(self, source_url):
+    @property
+    def user_agent(self):
+        'Random browser user agent, created on first use'
+        def create():
+            from fake_useragent import UserAgent
+            return UserAgent()
+        return self.get_client('user_agent', create)
+
+    def get_client(self, name, create):
+        'Get a shared client, created once under the lock even when requests need it concurrently'
+        if name not in self.clients:
+            with self.clients_lock:
+                if name not in self.clients:
+                    self.clients[name] = create()
+        return self.clients[name]
+
+    def create_llm(self, streaming=False):
+        'Create the language model for the configured deployment and temperature'
+        if self.deployment_type == "Chat":
+            return ChatOpenAI(model_name=self.deployment_name,
+                              engine=self.deployment_name,
+                              temperature=self.temperature,
+                              max_tokens=self.max_tokens if self.max_tokens != -1 else None,
+                              streaming=streaming)
+        return AzureOpenAI(deployment_name=self.deployment_name,
+                           temperature=self.temperature,
+                           max_tokens=self.max_tokens,
+                           streaming=streaming)
+
+    def with_options(self, custom_prompt: str = "", temperature: float = None):
+        'Get a helper with another prompt or temperature, sharing the clients of this one'
+        temperature = self.temperature if temperature is None else temperature
+        if custom_prompt == '' and temperature == self.temperature:
+            return self
+        with self.variants_lock:
+            if (custom_prompt, temperature) not in self.variants:
+                if len(self.variants) >= MAX_HELPER_VARIANTS:
+                    self.variants.pop(next(iter(self.variants)))
+                variant = copy.copy(self)
+                variant.prompt = PROMPT if custom_prompt == '' else PromptTemplate(template=custom_prompt, input_variables=["summaries", "question"])
+                if temperature != self.temperature:
+                    variant.temperature = temperature
+                    variant.llm = variant.create_llm()
+                    variant.streaming_llm = variant.create_llm(streaming=True)
+                self.variants[(custom_prompt, temperature)] = variant
+            return self.variants[(custom_prompt, temperature)]
+
+    def add_embeddings_lc(self, source_url, sections=None, tags=None, groups=None):
         'Add embeddings to the vector store from a source URL'
         try:
-            documents = self.document_loaders(source_url).load()
-            
-            # Convert to UTF-8 encoding for non-ascii text
-            for(document) in documents:
+            self.write_chunks(self.get_filename(source_url), self.iter_chunks(source_url, sections, tags, groups))
+        except Exception as exc:
+            logging.error(f"Error adding embeddings for {source_url}: {exc}")
+            raise exc
+        finally:
+            self.index_changed()
+
+    async def aadd_embeddings_lc(self, source_url, sections=None, tags=None, groups=None):
+        'Add embeddings to the vector store from a source URL, overlapping embedding requests and writes'
+        try:
+            await self.awrite_chunks(self.get_filename(source_url), self.iter_chunks(source_url, sections, tags, groups))
+        except Exception as exc:
+            logging.error(f"Error adding embeddings for {source_url}: {exc}")
+            raise exc
+        finally:
+            await asyncio.to_thread(self.index_changed)
+
+    def index_changed(self):
+        'Invalidate the cached answers after the content of the index changed'
+        if self.answer_cache is not None:
+            self.answer_cache.bump_index_version()
+
+    def delete_keys(self, keys):
+        'Delete chunks from the vector store'
+        self.vector_store.delete_keys(keys)
+        self.index_changed()
+
+    def delete_file(self, filename):
+        'Delete all the chunks of a file from the vector store'
+        deleted = self.vector_store.delete_file(filename)
+        self.index_changed()
+        return deleted
+
+    def delete_all(self):
+        'Delete every chunk of the vector store'
+        self.vector_store.delete_all()
+        self.index_changed()
+
+    def get_filename(self, source_url):
+        'Get the blob name of a source URL'
+        return "/".join(source_url.split('?')[0].split('/')[4:])
+
+    def iter_sections(self, source_url):
+        'Yield the text of the document in sections, streaming text files instead of loading them whole'
+        if not urllib.parse.urlparse(source_url).path.endswith('.txt'):
+            if self.document_loaders is None:
+                from langchain.document_loaders import WebBaseLoader
+                self.document_loaders = WebBaseLoader
+            for document in self.document_loaders(source_url).load():
+                # Convert to UTF-8 encoding for non-ascii text
                 try:
                     if document.page_content.encode("iso-8859-1") == document.page_content.encode("latin-1"):
                         document.page_content = document.page_content.encode("iso-8859-1").decode("utf-8", errors="ignore")
                 except:
                     pass
+                yield document.page_content
+            return
 
-            docs = self.text_splitter.split_documents(documents)
+        with requests.get(source_url, stream=True, timeout=120) as response:
+            response.raise_for_status()
+            if 'charset' not in response.headers.get('content-type', ''):
+                response.encoding = 'utf-8'
+            lines, size = [], 0
+            for line in response.iter_lines(decode_unicode=True):
+                lines.append(line)
+                size += len(line) + 1
+                # Cut the sections between paragraphs when possible
+                if (size >= self.streaming_section_size and line.strip() == '') or size >= 2 * self.streaming_section_size:
+                    yield "\n".join(lines)
+                    lines, size = [], 0
+            if lines:
+                yield "\n".join(lines)
 
-            # Remove half non-ascii character from start/end of doc content (langchain TokenTextSplitter may split a non-ascii character in half)
-            pattern = re.compile(r'[\x00-\x1f\x7f\u0080-\u00a0\u2000-\u3000\ufff0-\uffff]')
-            for doc in docs:
-                doc.page_content = re.sub(pattern, '', doc.page_content)
-                if doc.page_content == '':
-                    docs.remove(doc)
+    def iter_chunks(self, source_url, sections=None, tags=None, groups=None):
+        'Yield the chunks of the document and their keys, one section at a time'
+        source_url = source_url.split('?')[0]
+        filename = self.get_filename(source_url)
+        # Metadata the retrieval can be filtered on, chunks without groups are readable by everyone
+        tags, groups = split_values(tags), split_values(groups)
+        filter_metadata = {"tags": tags, "groups": groups, "ingest_date": int(time.time())}
+        # Changing the tags or groups of a file updates its unchanged chunks too
+        access = f"\n{','.join(sorted(tags))}\n{','.join(sorted(groups))}" if tags or groups else ""
 
-            keys = []
-            for i, doc in enumerate(docs):
+        # Remove half non-ascii character from start/end of doc content (langchain TokenTextSplitter may split a non-ascii character in half)
+        pattern = re.compile(r'[\x00-\x1f\x7f\u0080-\u00a0\u2000-\u3000\ufff0-\uffff]')
+        i = 0
+        for section in (self.iter_sections(source_url) if sections is None else sections):
+            for text in self.text_splitter.split_text(section):
+                text = re.sub(pattern, '', text)
+                if text == '':
+                    continue
                 # Create a unique key for the document
-                source_url = source_url.split('?')[0]
-                filename = "/".join(source_url.split('/')[4:])
                 hash_key = hashlib.sha1(f"{source_url}_{i}".encode('utf-8')).hexdigest()
                 hash_key = f"doc:{self.index_name}:{hash_key}"
-                keys.append(hash_key)
-                doc.metadata = {"source": f"[{source_url}]({source_url}_SAS_TOKEN_PLACEHOLDER_)" , "chunk": i, "key": hash_key, "filename": filename}
-            if self.vector_store_type == 'AzureSearch':
-                self.vector_store.add_documents(documents=docs, keys=keys)
-            else:
-                self.vector_store.add_documents(documents=docs, redis_url=self.vector_store_full_address,  index_name=self.index_name, keys=keys)
-            
-        except Exception as exc:
-            logging.error(f"Error adding embeddings for {source_url}: {exc}")
-            raise exc
+                content_hash = hashlib.sha1(f"{self.model}\n{text}{access}".encode('utf-8')).hexdigest()
+                metadata = {"source": f"[{source_url}]({source_url}_SAS_TOKEN_PLACEHOLDER_)" , "chunk": i, "key": hash_key, "filename": filename, "content_hash": content_hash, **filter_metadata}
+                yield Document(page_content=text, metadata=metadata), hash_key
+                i += 1
+
+    def iter_chunks_to_write(self, filename, chunks, stats):
+        'Yield batches of the new or changed chunks, collecting the keys of the file in stats'
+        stored_hashes = self.vector_store.get_chunk_hashes(filename) if self.incremental_indexing else {}
+        stats.update({'stored': stored_hashes, 'keys': set(), 'upserted': 0})
+        while True:
+            batch = list(itertools.islice(chunks, self.batch_embeddings.batch_size))
+            if not batch:
+                return
+            stats['keys'].update(key for _, key in batch)
+            batch = [(doc, key) for doc, key in batch if stored_hashes.get(key) != doc.metadata['content_hash']]
+            if batch:
+                stats['upserted'] += len(batch)
+                yield [doc for doc, _ in batch], [key for _, key in batch]
+
+    def delete_stale_chunks(self, filename, stats):
+        'Delete the chunks stored for the file that are not part of it anymore'
+        stale_keys = list(set(stats['stored']) - stats['keys']) if self.incremental_indexing else []
+        if stale_keys:
+            self.vector_store.delete_keys(stale_keys)
+        logging.info(f"{filename}: {stats['upserted']} of {len(stats['keys'])} chunks upserted, {len(stale_keys)} stale chunks deleted")
+
+    def write_chunks(self, filename, chunks):
+        'Embed and upsert the new or changed chunks of a file batch by batch and delete its stale chunks'
+        stats = {}
+        for docs, keys in self.iter_chunks_to_write(filename, chunks, stats):
+            # Embed the chunks in batches instead of one request per chunk
+            embeddings = self.batch_embeddings.embed_documents([doc.page_content for doc in docs])
+            self.add_documents(docs, keys, embeddings)
+        self.delete_stale_chunks(filename, stats)
+
+    async def awrite_chunks(self, filename, chunks):
+        'Embed and upsert the chunks of a file with concurrent, rate limited batches'
+        stats = {}
+        batches = self.iter_chunks_to_write(filename, chunks, stats)
+        semaphore = asyncio.Semaphore(self.ingestion_max_concurrency)
+        tasks = []
+
+        async def write_batch(docs, keys):
+            try:
+                embeddings = await self.batch_embeddings.aembed_documents([doc.page_content for doc in docs])
+                # Write this batch while the next ones are being embedded
+                await asyncio.to_thread(self.add_documents, docs, keys, embeddings)
+            finally:
+                semaphore.release()
+
+        try:
+            while True:
+                # Only read the document ahead of the batches in flight
+                await semaphore.acquire()
+                # Stop reading the document as soon as a batch failed
+                if any(task.done() and not task.cancelled() and task.exception() for task in tasks):
+                    semaphore.release()
+                    break
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    semaphore.release()
+                    break
+                tasks.append(asyncio.create_task(write_batch(*batch)))
+            await asyncio.gather(*tasks)
+        finally:
+            # Never leave batches running after a failure or a cancellation
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(self.delete_stale_chunks, filename, stats)
+
+    def add_documents(self, docs, keys, embeddings):
+        'Upsert chunks and their embeddings in the vector store'
+        if self.vector_store_type in ('AzureSearch', 'Numpy'):
+            self.vector_store.add_documents(documents=docs, keys=keys, embeddings=embeddings)
+        else:
+            self.vector_store.add_documents(documents=docs, redis_url=self.vector_store_full_address,  index_name=self.index_name, keys=keys, embeddings=embeddings)
+
+    def upload_converted_text(self, text, filename):
+        'Upload the extracted text to Azure Blob Storage without joining it in memory'
+        def iter_bytes():
+            for i, section in enumerate(text):
+                yield (section if i == 0 else f"\n{section}").encode('utf-8')
+
+        return self.blob_client.upload_file(iter_bytes(),
+                                            f"converted/{filename}.txt",
+                                            content_type='text/plain; charset=utf-8')
+
+    def analyze_file(self, source_url, filename):
+        'Extract the text from the file, reusing the layout of an unchanged file'
+        content_md5 = self.blob_client.get_blob_md5(filename) if self.layout_cache else None
+        layout = self.layout_cache.get(content_md5) if content_md5 else None
+        if layout is None:
+            layout = self.pdf_parser.analyze_layout(source_url)
+            if content_md5:
+                self.layout_cache.set(content_md5, layout)
+        else:
+            logging.info(f"Reusing the cached layout of {filename}")
+        return self.pdf_parser.layout_to_text(layout)
 
-    def convert_file_and_add_embeddings(self, source_url, filename, enable_translation=False):
+    def convert_file_and_add_embeddings(self, source_url, filename, enable_translation=False, tags=None, groups=None):
         'Extract the text from the file'
-        text = self.pdf_parser.analyze_read(source_url)
+        text = self.analyze_file(source_url, filename)
         # Translate if requested
-        text = list(map(lambda x: self.translator.translate(x), text)) if self.enable_translation else text
+        text = self.translator.translate_batch(text) if self.enable_translation else text
 
         # Upload the text to Azure Blob Storage
         converted_filename = f"converted/{filename}.txt"
-        source_url = self.blob_client.upload_file("\n".join(text),
-                                                  f"converted/{filename}.txt",
-                                                  content_type='text/plain; charset=utf-8')
+        source_url = self.upload_converted_text(text, filename)
 
         print(f"Converted file uploaded to {source_url} with filename {filename}")
         # Update the metadata to indicate that the file has been converted
         self.blob_client.upsert_blob_metadata(filename, {"converted": "true"})
 
-        self.add_embeddings_lc(source_url=source_url)
+        # Embed the extracted sections directly instead of downloading the converted file again
+        self.add_embeddings_lc(source_url=source_url, sections=text, tags=tags, groups=groups)
 
         return converted_filename
 
-    def get_all_documents(self, k: int = None):
-        'Get all documents from the vector store'
-        result = self.vector_store.similarity_search(query="*", k= k if k else self.k)
-        return pd.DataFrame(list(map(lambda x: {
-                'key': x.metadata['key'],
-                'filename': x.metadata['filename'],
-                'source': urllib.parse.unquote(x.metadata['source']), 
-                'content': x.page_content, 
-                'metadata' : x.metadata,
-                }, result)))
-
-    def get_semantic_answer_lang_chain(self, question, chat_history):
-        'Get the answer to a question using the semantic search'
+    async def aconvert_file_and_add_embeddings(self, source_url, filename, enable_translation=False, tags=None, groups=None):
+        'Extract the text from the file and add its embeddings without blocking the event loop'
+        text = await asyncio.to_thread(self.analyze_file, source_url, filename)
+        # Translate if requested
+        if self.enable_translation:
+            text = await asyncio.to_thread(self.translator.translate_batch, text)
+
+        # Upload the text to Azure Blob Storage
+        converted_filename = f"converted/{filename}.txt"
+        source_url = await asyncio.to_thread(self.upload_converted_text, text, filename)
+
+        logging.info(f"Converted file uploaded to {source_url} with filename {filename}")
+        # Update the metadata to indicate that the file has been converted
+        await asyncio.to_thread(self.blob_client.upsert_blob_metadata, filename, {"converted": "true"})
+
+        await self.aadd_embeddings_lc(source_url=source_url, sections=text, tags=tags, groups=groups)
+
+        return converted_filename
+
+    def iter_documents(self, page_size: int = 1000, include_content: bool = True):
+        'Yield the documents of the vector store in pages, leaving out the content if not needed'
+        return self.vector_store.iter_documents(page_size=page_size, include_content=include_content)
+
+    def get_all_documents(self, k: int = None, include_content: bool = True):
+        'Get all documents from the vector store, or the first k ones'
+        import pandas as pd
+        rows = []
+        for documents in self.iter_documents(page_size=min(k, 1000) if k else 1000,
+                                             include_content=include_content):
+            for document in documents:
+                row = {
+                    'key': document.metadata['key'],
+                    'filename': document.metadata.get('filename'),
+                    'source': urllib.parse.unquote(document.metadata.get('source', '')),
+                }
+                if include_content:
+                    row['content'] = document.page_content
+                row['metadata'] = document.metadata
+                rows.append(row)
+            if k and len(rows) >= k:
+                rows = rows[:k]
+                break
+        return pd.DataFrame(rows)
+
+    def get_cached_answer(self, question, chat_history, filters=None):
+        'Get the cached answer of the question or of a similar one, else the cache entry to fill'
+        if self.answer_cache is None or self.answer_cache.ttl <= 0:
+            return None, None
+        index_version = self.answer_cache.get_index_version()
+        if index_version is None:
+            return None, None
+        settings = self.answer_cache.make_settings(chat_history, self.prompt.template,
+                                                   self.temperature, self.deployment_name, filters)
+        entry = {'key': self.answer_cache.make_key(question, settings, index_version),
+                 'settings': settings, 'index_version': index_version, 'embedding': None}
+        cached = self.answer_cache.get(entry['key'])
+        if cached is not None:
+            self.answer_cache.count('exact_hits')
+        elif self.semantic_cache is not None and self.semantic_cache.check_index():
+            # The embedding is cached, the retriever does not ask for it again
+            entry['embedding'] = self.query_embeddings.embed_query(question)
+            cached, _ = self.semantic_cache.get(entry['embedding'], settings, index_version)
+            if cached is not None:
+                self.answer_cache.count('semantic_hits')
+        if cached is None:
+            self.answer_cache.count('misses')
+            return None, entry
+        self.answer_cache.count('saved_tokens', cached.get('tokens', 0))
+        return cached, None
+
+    def cache_answer(self, question, entry, answer):
+        'Store an answer in the exact and the semantic caches'
+        self.answer_cache.set(entry['key'], answer)
+        if entry['embedding'] is not None:
+            self.semantic_cache.set(question, entry['embedding'], entry['settings'],
+                                    entry['index_version'], answer)
+
+    async def aget_cached_answer(self, question, chat_history, filters=None):
+        'Get the cached answer like get_cached_answer with the async Redis client'
+        if self.answer_cache is None or self.answer_cache.ttl <= 0:
+            return None, None
+        if self.answer_cache.async_client is None:
+            return await asyncio.to_thread(self.get_cached_answer, question, chat_history, filters)
+        index_version = await self.answer_cache.aget_index_version()
+        if index_version is None:
+            return None, None
+        settings = self.answer_cache.make_settings(chat_history, self.prompt.template,
+                                                   self.temperature, self.deployment_name, filters)
+        entry = {'key': self.answer_cache.make_key(question, settings, index_version),
+                 'settings': settings, 'index_version': index_version, 'embedding': None}
+        cached = await self.answer_cache.aget(entry['key'])
+        if cached is not None:
+            await self.answer_cache.acount('exact_hits')
+        elif self.semantic_cache is not None and await self.semantic_cache.acheck_index():
+            entry['embedding'] = await self.query_embeddings.aembed_query(question)
+            cached, _ = await self.semantic_cache.aget(entry['embedding'], settings, index_version)
+            if cached is not None:
+                await self.answer_cache.acount('semantic_hits')
+        if cached is None:
+            await self.answer_cache.acount('misses')
+            return None, entry
+        await self.answer_cache.acount('saved_tokens', cached.get('tokens', 0))
+        return cached, None
+
+    async def acache_answer(self, question, entry, answer):
+        'Store an answer in the exact and the semantic caches with the async Redis client'
+        if self.answer_cache.async_client is None:
+            return await asyncio.to_thread(self.cache_answer, question, entry, answer)
+        await self.answer_cache.aset(entry['key'], answer)
+        if entry['embedding'] is not None:
+            await self.semantic_cache.aset(question, entry['embedding'], entry['settings'],
+                                           entry['index_version'], answer)
+
+    def get_cache_stats(self):
+        'Get the hit and miss counters of the caches'
+        stats = {'query_embeddings': self.query_embeddings.stats()}
+        with self.stats_lock:
+            speculation = dict(self.speculation_stats)
+        attempts = speculation['used'] + speculation['discarded']
+        speculation['use_rate'] = speculation['used'] / attempts if attempts else 0.0
+        stats['speculative_retrieval'] = speculation
+        with self.stats_lock:
+            stats['context_packing'] = dict(self.packing_stats)
+        if self.answer_cache is not None:
+            answers = self.answer_cache.stats()
+            lookups = sum(answers.get(key, 0) for key in ('exact_hits', 'semantic_hits', 'misses'))
+            answers['hit_rate'] = (answers.get('exact_hits', 0) + answers.get('semantic_hits', 0)) / lookups if lookups else 0.0
+            stats['answers'] = answers
+        return stats
+
+    def condense_question(self, question, chat_history, callbacks=None):
+        'Rephrase a follow-up question as a standalone question'
+        if not chat_history:
+            return question
+        from langchain.chains.llm import LLMChain
+        from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
+        question_generator = LLMChain(llm=self.llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=False)
+        history = "".join(f"\nHuman: {human}\nAssistant: {ai}" for human, ai in chat_history)
+        return question_generator.run(question=question, chat_history=history, callbacks=callbacks)
+
+    async def acondense_question(self, question, chat_history, callbacks=None):
+        'Rephrase a follow-up question as a standalone question with an async completion'
+        if not chat_history:
+            return question
+        from langchain.chains.llm import LLMChain
+        from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
         question_generator = LLMChain(llm=self.llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=False)
-        doc_chain = load_qa_with_sources_chain(self.llm, chain_type="stuff", verbose=True, prompt=self.prompt)
-        chain = ConversationalRetrievalChain(
-            retriever=self.vector_store.as_retriever(),
-            question_generator=question_generator,
-            combine_docs_chain=doc_chain,
-            return_source_documents=True,
-            # top_k_docs_for_context= self.k
-        )
-        result = chain({"question": question, "chat_history": chat_history})
-        context = "\n".join(list(map(lambda x: x.page_content, result['source_documents'])))
-        sources = "\n".join(set(map(lambda x: x.metadata["source"], result['source_documents'])))
+        history = "".join(f"\nHuman: {human}\nAssistant: {ai}" for human, ai in chat_history)
+        return await question_generator.arun(question=question, chat_history=history, callbacks=callbacks)
+
+    def retrieve(self, question, filters=None):
+        'Get the chunks relevant to a standalone question, among the ones matching the filters'
+        # The store narrows the candidates before the nearest neighbour search. The stores are searched
+        # directly, the langchain Redis retriever ignores the k and the filters of its search_kwargs
+        search_kwargs = {'filters': self.vector_store.build_filter(filters)} if filters else {}
+        return self.vector_store.similarity_search(question, k=self.k, **search_kwargs)
+
+    async def aretrieve(self, question, filters=None):
+        'Get the chunks relevant to a standalone question with async embedding and search requests'
+        embedding = await self.query_embeddings.aembed_query(question)
+        search_kwargs = {'filters': self.vector_store.build_filter(filters)} if filters else {}
+        return await self.vector_store.asimilarity_search_by_vector(embedding, k=self.k, **search_kwargs)
+
+    def use_speculation(self, question_embedding, new_question_embedding):
+        'Whether the chunks retrieved for the raw question can be used for the condensed one'
+        question_embedding, new_question_embedding = np.array(question_embedding), np.array(new_question_embedding)
+        similarity = float(np.dot(question_embedding, new_question_embedding) /
+                           (np.linalg.norm(question_embedding) * np.linalg.norm(new_question_embedding)))
+        used = similarity >= self.speculative_retrieval_threshold
+        with self.stats_lock:
+            self.speculation_stats['used' if used else 'discarded'] += 1
+        return used
+
+    def condense_and_retrieve(self, question, chat_history, callbacks=None, filters=None):
+        'Condense the question and retrieve its chunks, speculatively retrieving for the raw question meanwhile'
+        if not chat_history or not self.speculative_retrieval:
+            new_question = self.condense_question(question, chat_history, callbacks=callbacks)
+            return new_question, self.retrieve(new_question, filters)
+
+        speculation = self.executor.submit(self.retrieve, question, filters)
+        new_question = self.condense_question(question, chat_history, callbacks=callbacks)
+        # Both embeddings are cached, the retrieval below does not compute them again
+        if self.use_speculation(self.query_embeddings.embed_query(question),
+                                self.query_embeddings.embed_query(new_question)):
+            return new_question, speculation.result()
+        speculation.cancel()
+        return new_question, self.retrieve(new_question, filters)
 
+    async def acondense_and_retrieve(self, question, chat_history, callbacks=None, filters=None):
+        'Condense the question and retrieve its chunks without blocking, speculating like condense_and_retrieve'
+        if not chat_history or not self.speculative_retrieval:
+            new_question = await self.acondense_question(question, chat_history, callbacks=callbacks)
+            return new_question, await self.aretrieve(new_question, filters)
+
+        speculation = asyncio.create_task(self.aretrieve(question, filters))
+        new_question = await self.acondense_question(question, chat_history, callbacks=callbacks)
+        embeddings = await asyncio.gather(self.query_embeddings.aembed_query(question),
+                                          self.query_embeddings.aembed_query(new_question))
+        if self.use_speculation(*embeddings):
+            return new_question, await speculation
+        speculation.cancel()
+        return new_question, await self.aretrieve(new_question, filters)
+
+    def cached_answer_events(self, question, cached):
+        'Events of an answer served from the cache'
+        sources = cached['sources'].replace('_SAS_TOKEN_PLACEHOLDER_', self.blob_client.get_container_sas())
+        return [{'type': 'sources', 'context': cached['context'], 'sources': sources},
+                {'type': 'token', 'token': cached['answer']},
+                {'type': 'answer', 'question': question, 'answer': cached['answer'],
+                 'context': cached['context'], 'sources': sources}]
+
+    def pack_context(self, source_documents):
+        'Pack the retrieved chunks in the context budget, return them with the context and sources texts'
+        # Drop the duplicated overlaps of adjacent chunks and stay within the context budget
+        source_documents, packing = self.context_packer.pack(source_documents)
+        with self.stats_lock:
+            self.packing_stats['requests'] += 1
+            self.packing_stats['tokens_saved'] += packing['tokens_saved']
+        context = "\n".join(list(map(lambda x: x.page_content, source_documents)))
+        sources = "\n".join(set(map(lambda x: x.metadata["source"], source_documents)))
+        return source_documents, packing, context, sources
+
+    def count_answer_tokens(self, source_documents, question, answer):
+        'Prompt and completion tokens of the answer, as sent by the stuff chain'
+        summaries = "\n\n".join(f"Content: {document.page_content}\nSource: {document.metadata.get('source', '')}"
+                                for document in source_documents)
+        encoding = self.context_packer.encoding
+        return len(encoding.encode(self.prompt.format(summaries=summaries, question=question))) + \
+            len(encoding.encode(answer))
+
+    def stream_semantic_answer(self, question, chat_history, streaming=True, filters=None):
+        'Yield the sources of the answer once retrieved, then the answer token by token and the full answer'
+        # Invalid filters are rejected before any model call
+        filters = normalize_filters(filters)
+        cached, cache_entry = self.get_cached_answer(question, chat_history, filters)
+        if cached is not None:
+            yield from self.cached_answer_events(question, cached)
+            return
+
+        from langchain.callbacks.openai_info import OpenAICallbackHandler
+        from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+        # Usage of the condensing completion, the streamed answer reports none and is counted locally
+        usage = OpenAICallbackHandler()
+        new_question, source_documents = self.condense_and_retrieve(question, chat_history, callbacks=[usage],
+                                                                    filters=filters)
+        source_documents, packing, context, sources = self.pack_context(source_documents)
+        container_sas = self.blob_client.get_container_sas()
+        yield {'type': 'sources', 'context': context,
+               'sources': sources.replace('_SAS_TOKEN_PLACEHOLDER_', container_sas)}
+
+        doc_chain = load_qa_with_sources_chain(self.streaming_llm if streaming else self.llm,
+                                               chain_type="stuff", verbose=True, prompt=self.prompt)
+        inputs = {"input_documents": source_documents, "question": new_question}
+        if streaming:
+            tokens = queue.Queue()
+            result = {}
+            def run_chain():
+                try:
+                    result['output'] = doc_chain(inputs, callbacks=[QueueCallbackHandler(tokens)])
+                except Exception as exc:
+                    result['error'] = exc
+                finally:
+                    tokens.put(None)
+            threading.Thread(target=run_chain, daemon=True).start()
+            streamer = AnswerStreamer()
+            while True:
+                token = tokens.get()
+                chunk = streamer.add(token) if token is not None else streamer.flush()
+                if chunk:
+                    yield {'type': 'token', 'token': chunk}
+                if token is None:
+                    break
+            if 'error' in result:
+                raise result['error']
+        else:
+            result = {'output': doc_chain(inputs)}
+        answer = strip_sources(result['output']['output_text'])
+        if not streaming:
+            yield {'type': 'token', 'token': answer}
+
+        if cache_entry:
+            # The SAS token is added when serving the answer so that the cache never holds one
+            tokens_used = usage.total_tokens + self.count_answer_tokens(source_documents, new_question, answer)
+            self.cache_answer(question, cache_entry, {'answer': answer, 'context': context, 'sources': sources,
+                                                      'tokens': tokens_used})
+
+        yield {'type': 'answer', 'question': question, 'answer': answer, 'context': context,
+               'sources': sources.replace('_SAS_TOKEN_PLACEHOLDER_', container_sas), 'packing': packing}
+
+    def get_semantic_answer_lang_chain(self, question, chat_history, filters=None):
+        'Get the answer to a question using the semantic search'
+        for event in self.stream_semantic_answer(question, chat_history, streaming=False, filters=filters):
+            if event['type'] == 'answer':
+                return event['question'], event['answer'], event['context'], event['sources']
+
+    async def astream_semantic_answer(self, question, chat_history, streaming=True, filters=None):
+        'Yield the same events as stream_semantic_answer, awaiting the I/O instead of blocking a worker thread'
+        filters = normalize_filters(filters)
+        cached, cache_entry = await self.aget_cached_answer(question, chat_history, filters)
+        if cached is not None:
+            for event in self.cached_answer_events(question, cached):
+                yield event
+            return
+
+        from langchain.callbacks.openai_info import OpenAICallbackHandler
+        from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+        # Usage of the condensing completion, the streamed answer reports none and is counted locally
+        usage = OpenAICallbackHandler()
+        new_question, source_documents = await self.acondense_and_retrieve(question, chat_history,
+                                                                           callbacks=[usage], filters=filters)
+        source_documents, packing, context, sources = self.pack_context(source_documents)
         container_sas = self.blob_client.get_container_sas()
-        
-        result['answer'] = result['answer'].split('SOURCES:')[0].split('Sources:')[0].split('SOURCE:')[0].split('Source:')[0]
-        sources = sources.replace('_SAS_TOKEN_PLACEHOLDER_', container_sas)
+        yield {'type': 'sources', 'context': context,
+               'sources': sources.replace('_SAS_TOKEN_PLACEHOLDER_', container_sas)}
+
+        doc_chain = load_qa_with_sources_chain(self.streaming_llm if streaming else self.llm,
+                                               chain_type="stuff", verbose=True, prompt=self.prompt)
+        inputs = {"input_documents": source_documents, "question": new_question}
+        if streaming:
+            tokens = asyncio.Queue()
+            async def run_chain():
+                try:
+                    return await doc_chain.acall(inputs, callbacks=[AsyncQueueCallbackHandler(tokens)])
+                finally:
+                    await tokens.put(None)
+            chain_task = asyncio.create_task(run_chain())
+            streamer = AnswerStreamer()
+            while True:
+                token = await tokens.get()
+                chunk = streamer.add(token) if token is not None else streamer.flush()
+                if chunk:
+                    yield {'type': 'token', 'token': chunk}
+                if token is None:
+                    break
+            output = await chain_task
+        else:
+            output = await doc_chain.acall(inputs)
+        answer = strip_sources(output['output_text'])
+        if not streaming:
+            yield {'type': 'token', 'token': answer}
+
+        if cache_entry:
+            tokens_used = usage.total_tokens + self.count_answer_tokens(source_documents, new_question, answer)
+            await self.acache_answer(question, cache_entry,
+                                     {'answer': answer, 'context': context, 'sources': sources,
+                                      'tokens': tokens_used})
+
+        yield {'type': 'answer', 'question': question, 'answer': answer, 'context': context,
+               'sources': sources.replace('_SAS_TOKEN_PLACEHOLDER_', container_sas), 'packing': packing}
 
-        return question, result['answer'], context, sources
+    async def aget_semantic_answer(self, question, chat_history, filters=None):
+        'Get the answer to a question using the semantic search, without blocking the event loop'
+        async for event in self.astream_semantic_answer(question, chat_history, streaming=False, filters=filters):
+            if event['type'] == 'answer':
+                return event['question'], event['answer'], event['context'], event['sources']
 
     def get_embeddings_model(self):
         'Get the embeddings model to use for the vector store'
@@ -227,3 +836,36 @@ class LLMHelper:
             return self.llm([HumanMessage(content=prompt)]).content
 
         return self.llm(prompt)
+
+
+_helpers = {}
+_helpers_lock = threading.Lock()
+# Settings read by an LLMHelper and its clients, a helper is created again when one of them changes
+HELPER_SETTINGS = (
+    'OPENAI_API_BASE', 'OPENAI_API_KEY', 'OPENAI_ENGINE', 'OPENAI_ENGINES', 'OPENAI_DEPLOYMENT_TYPE',
+    'OPENAI_TEMPERATURE', 'OPENAI_MAX_TOKENS', 'OPENAI_EMEBDDINGS_ENGINE', 'OPENAI_EMBEDDINGS_ENGINE_DOC',
+    'OPENAI_EMBEDDINGS_ENGINE_QUERY', 'VECTOR_STORE_TYPE', 'AZURE_SEARCH_SERVICE_NAME', 'AZURE_SEARCH_ADMIN_KEY',
+    'AZURESEARCH_DIMENSIONS', 'AZURESEARCH_FIELDS_ID', 'AZURESEARCH_FIELDS_CONTENT', 'AZURESEARCH_FIELDS_CONTENT_HASH',
+    'AZURESEARCH_FIELDS_TITLE', 'AZURESEARCH_FIELDS_TAG', 'AZURESEARCH_FIELDS_TAGS', 'AZURESEARCH_FIELDS_FILENAME',
+    'AZURESEARCH_FIELDS_GROUPS', 'AZURESEARCH_FIELDS_INGEST_DATE', 'NUMPY_STORE_PATH', 'REDIS_ADDRESS', 'REDIS_PORT',
+    'REDIS_PROTOCOL', 'REDIS_PASSWORD', 'REDIS_VECTOR_TYPE', 'REDIS_VECTOR_DIMENSIONS', 'REDIS_INDEX_ALGORITHM',
+    'REDIS_INDEX_M', 'REDIS_INDEX_EF_CONSTRUCTION', 'REDIS_INDEX_EF_RUNTIME', 'REDIS_INDEX_INITIAL_CAP',
+    'CACHE_REDIS_URL', 'ANSWER_CACHE_TTL', 'SEMANTIC_CACHE_ENABLED', 'SEMANTIC_CACHE_THRESHOLD',
+    'EMBEDDINGS_CACHE_TYPE', 'EMBEDDINGS_CACHE_PATH', 'EMBEDDINGS_CACHE_TTL', 'EMBEDDINGS_BATCH_SIZE',
+    'EMBEDDINGS_BATCH_MAX_TOKENS', 'QUERY_EMBEDDINGS_CACHE_SIZE', 'QUERY_EMBEDDINGS_CACHE_TTL', 'CHUNK_SIZE',
+    'CHUNK_OVERLAP', 'STREAMING_SECTION_SIZE', 'INGESTION_MAX_CONCURRENCY', 'INCREMENTAL_INDEXING', 'RETRIEVAL_K',
+    'SPECULATIVE_RETRIEVAL', 'SPECULATIVE_RETRIEVAL_THRESHOLD', 'SPECULATIVE_RETRIEVAL_WORKERS', 'CONTEXT_MAX_TOKENS',
+    'BLOB_ACCOUNT_NAME', 'BLOB_ACCOUNT_KEY', 'BLOB_CONTAINER_NAME', 'LAYOUT_CACHE_TYPE', 'LAYOUT_CACHE_DIR',
+    'FORM_RECOGNIZER_ENDPOINT', 'FORM_RECOGNIZER_KEY', 'FORM_RECOGNIZER_MAX_PARALLELISM',
+    'FORM_RECOGNIZER_PAGES_PER_REQUEST', 'PAGES_PER_EMBEDDINGS', 'TRANSLATE_ENDPOINT', 'TRANSLATE_KEY',
+    'TRANSLATE_REGION', 'TRANSLATION_CACHE_SIZE', 'VNET_DEPLOYMENT',
+)
+
+def get_llm_helper(custom_prompt: str = "", temperature: float = None) -> LLMHelper:
+    'Get the process wide LLMHelper of the current configuration, with the prompt and temperature applied'
+    config = tuple(os.getenv(name) for name in HELPER_SETTINGS)
+    with _helpers_lock:
+        if config not in _helpers:
+            _helpers[config] = LLMHelper()
+        llm_helper = _helpers[config]
+    return llm_helper.with_options(custom_prompt=custom_prompt, temperature=temperature)
@@ -0,0 +1,321 @@
+'''Vector store keeping the embeddings in a memory-mapped NumPy matrix'''
+from __future__ import annotations
+
+import os
+import json
+import asyncio
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from utilities.filters import normalize_filters
+
+logger = logging.getLogger()
+
+# Rows allocated when the matrix is created, it doubles whenever it is full
+INITIAL_CAPACITY = 1024
+# Stay below the SQLite limit of bound parameters
+MAX_SQL_PARAMETERS = 500
+# Filtered searches copy the rows of at most this many candidates, larger sets are masked in place
+MAX_GATHERED_ROWS = 10000
+
+
+class NumpyVectorStore(VectorStore):
+    '''Embedded vector store searching the embeddings with a brute force cosine similarity.
+
+    The normalized float32 embeddings are rows of a memory-mapped .npy matrix and the
+    content and metadata of the chunks live in a SQLite sidecar mapping the keys to the rows.
+    '''
+    def __init__(
+        self,
+        path: str,
+        index_name: str,
+        embedding_function: Callable,
+        **kwargs: Any,
+    ):
+        self.path = path
+        self.index_name = index_name
+        self.embedding_function = embedding_function
+        os.makedirs(path, exist_ok=True)
+        self.matrix_path = os.path.join(path, f"{index_name}.npy")
+        self.lock = threading.RLock()
+        # Writers of other processes wait for the lock of the database instead of failing
+        self.connection = sqlite3.connect(os.path.join(path, f"{index_name}.db"), check_same_thread=False,
+                                          timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS chunks '
+                                '(row INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, filename TEXT, '
+                                'content TEXT, metadata TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS chunks_filename ON chunks (filename)')
+        self.connection.commit()
+        self.matrix: np.ndarray = None
+        self.valid: np.ndarray = np.zeros(0, dtype=bool)
+        self.size = 0
+        self.data_version = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        'Reload the matrix and the rows in use after another process changed the store'
+        data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+        self.matrix = np.load(self.matrix_path, mmap_mode='r+') if os.path.exists(self.matrix_path) else None
+        self.valid = np.zeros(len(self.matrix) if self.matrix is not None else 0, dtype=bool)
+        rows = [row for row, in self.connection.execute('SELECT row FROM chunks')]
+        self.valid[rows] = True
+        self.size = max(rows) + 1 if rows else 0
+
+    def ensure_capacity(self, rows: int, dimensions: int) -> None:
+        'Grow the matrix so that it holds at least the given number of rows'
+        if self.matrix is None:
+            self.matrix = np.lib.format.open_memmap(self.matrix_path, mode='w+', dtype=np.float32,
+                                                    shape=(max(rows, INITIAL_CAPACITY), dimensions))
+        elif rows > len(self.matrix):
+            # Copy to a new file swapped in place, readers still mapping the old one are not disturbed
+            temporary_path = f"{self.matrix_path}.{uuid.uuid4().hex}.tmp"
+            matrix = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float32,
+                                               shape=(max(rows, 2 * len(self.matrix)), self.matrix.shape[1]))
+            matrix[:len(self.matrix)] = self.matrix
+            matrix.flush()
+            del matrix
+            os.replace(temporary_path, self.matrix_path)
+            self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+        else:
+            return
+        self.valid = np.concatenate([self.valid, np.zeros(len(self.matrix) - len(self.valid), dtype=bool)])
+
+    def get_rows(self, keys: List[str]) -> Dict[str, int]:
+        'Get the row of every stored key'
+        rows = {}
+        for i in range(0, len(keys), MAX_SQL_PARAMETERS):
+            batch = keys[i:i + MAX_SQL_PARAMETERS]
+            rows.update(self.connection.execute(
+                f"SELECT key, row FROM chunks WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall())
+        return rows
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        embeddings: Optional[List[List[float]]] = None,
+        keys: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        'Upsert texts, using the precomputed embeddings when provided'
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas if metadatas else [{} for _ in texts]
+        keys = keys if keys else [f"doc:{self.index_name}:{uuid.uuid4().hex}" for _ in texts]
+        vectors = np.array(embeddings if embeddings else [self.embedding_function(text) for text in texts],
+                           dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        with self.lock:
+            with self.write_transaction():
+                self.refresh()
+                # Updated keys keep their row, new keys fill the free rows first
+                rows = self.get_rows(keys)
+                new_keys = [key for key in dict.fromkeys(keys) if key not in rows]
+                free_rows = np.flatnonzero(~self.valid).tolist()[:len(new_keys)]
+                free_rows += list(range(len(self.valid), len(self.valid) + len(new_keys) - len(free_rows)))
+                rows.update(zip(new_keys, free_rows))
+                self.ensure_capacity(max(rows.values()) + 1, vectors.shape[1])
+                self.matrix[[rows[key] for key in keys]] = vectors
+                self.matrix.flush()
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO chunks (row, key, filename, content, metadata) VALUES (?, ?, ?, ?, ?)',
+                    [(rows[key], key, metadata.get('filename'), text, json.dumps(metadata))
+                     for key, text, metadata in zip(keys, texts, metadatas)])
+            self.data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            self.valid[list(rows.values())] = True
+            self.size = max(self.size, max(rows.values()) + 1)
+        return keys
+
+    @contextmanager
+    def write_transaction(self):
+        '''Hold the write lock of the database from the allocation of the rows to the commit.
+
+        BEGIN IMMEDIATE serializes the writers of every process sharing the store, so two of them
+        never pick the same free row of the matrix.
+        '''
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
+    def delete_keys(self, keys: List[str]) -> None:
+        'Delete keys from the store'
+        with self.lock:
+            with self.write_transaction():
+                self.refresh()
+                rows = self.get_rows(keys)
+                self.connection.executemany('DELETE FROM chunks WHERE key = ?', [(key,) for key in rows])
+            self.valid[list(rows.values())] = False
+
+    def build_filter(self, filters: dict) -> Optional[Tuple[str, list]]:
+        'SQL condition and parameters selecting the chunks matching the filters'
+        filters = normalize_filters(filters)
+        clauses, parameters = [], []
+        if 'filenames' in filters:
+            clauses.append(f"filename IN ({','.join('?' * len(filters['filenames']))})")
+            parameters += filters['filenames']
+        if 'tags' in filters:
+            clauses.append("EXISTS (SELECT 1 FROM json_each(metadata, '$.tags') "
+                           f"WHERE value IN ({','.join('?' * len(filters['tags']))}))")
+            parameters += filters['tags']
+        if 'groups' in filters:
+            # The chunks without any group are readable by everyone
+            clauses.append("(COALESCE(json_array_length(metadata, '$.groups'), 0) = 0 OR "
+                           "EXISTS (SELECT 1 FROM json_each(metadata, '$.groups') "
+                           f"WHERE value IN ({','.join('?' * len(filters['groups']))})))")
+            parameters += filters['groups']
+        if 'ingested_after' in filters:
+            clauses.append("json_extract(metadata, '$.ingest_date') >= ?")
+            parameters.append(filters['ingested_after'])
+        if 'ingested_before' in filters:
+            clauses.append("json_extract(metadata, '$.ingest_date') <= ?")
+            parameters.append(filters['ingested_before'])
+        return (' AND '.join(clauses), parameters) if clauses else None
+
+    def batch_similarity_search_by_vector_with_score(
+        self, embeddings: List[List[float]], k: int = 4, filters: Optional[Tuple[str, list]] = None
+    ) -> List[List[Tuple[Document, float]]]:
+        'Return the k most similar documents of every embedding and their cosine similarity'
+        queries = np.array(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries /= np.where(norms == 0, 1, norms)
+        with self.lock:
+            self.refresh()
+            if filters:
+                candidates = np.array(sorted(row for row, in self.connection.execute(
+                    f"SELECT row FROM chunks WHERE {filters[0]}", filters[1])), dtype=np.int64)
+                count = min(k, len(candidates))
+            else:
+                candidates = None
+                count = min(k, int(np.count_nonzero(self.valid[:self.size])))
+            if count == 0:
+                return [[] for _ in embeddings]
+            if candidates is not None and len(candidates) <= MAX_GATHERED_ROWS:
+                # Only the few rows matching the filters are copied and scored
+                scores = queries @ self.matrix[candidates].T
+            else:
+                # Score the memory-mapped rows in place, indexing them with a list would copy
+                # every candidate row for each query, the other rows are masked out
+                if candidates is None:
+                    mask = self.valid[:self.size]
+                else:
+                    mask = np.zeros(self.size, dtype=bool)
+                    mask[candidates] = True
+                scores = queries @ self.matrix[:self.size].T
+                scores[:, ~mask] = -np.inf
+                candidates = np.arange(self.size)
+            top = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            top = candidates[top]
+            rows = sorted(set(top.ravel().tolist()))
+            documents = {}
+            for i in range(0, len(rows), MAX_SQL_PARAMETERS):
+                batch = rows[i:i + MAX_SQL_PARAMETERS]
+                for row, content, metadata in self.connection.execute(
+                        f"SELECT row, content, metadata FROM chunks WHERE row IN ({','.join('?' * len(batch))})",
+                        batch):
+                    documents[row] = Document(page_content=content, metadata=json.loads(metadata))
+        return [[(documents[row], float(score)) for row, score in zip(top[i], top_scores[i])]
+                for i in range(len(top))]
+
+    def batch_similarity_search(self, queries: List[str], k: int = 4,
+                                filters: Optional[Tuple[str, list]] = None) -> List[List[Document]]:
+        'Return the k most similar documents of every query with a single matrix product'
+        results = self.batch_similarity_search_by_vector_with_score(
+            [self.embedding_function(query) for query in queries], k=k, filters=filters)
+        return [[doc for doc, _ in docs_and_scores] for docs_and_scores in results]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filters: Optional[Tuple[str, list]] = None) -> List[Tuple[Document, float]]:
+        'Return the documents most similar to the query and their cosine similarity'
+        return self.batch_similarity_search_by_vector_with_score([self.embedding_function(query)], k=k,
+                                                                 filters=filters)[0]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        'Return the documents most similar to the query'
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filters=kwargs.get('filters'))]
+
+    async def asimilarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                           filters: Optional[Tuple[str, list]] = None) -> List[Document]:
+        'Return the documents most similar to the embedding, searching in a worker thread'
+        results = await asyncio.to_thread(self.batch_similarity_search_by_vector_with_score,
+                                          [embedding], k, filters)
+        return [doc for doc, _ in results[0]]
+
+    def iter_documents(self, page_size: int = 1000,
+                       include_content: bool = True) -> Iterator[List[Document]]:
+        'Yield all the documents of the store in pages, without any embedding call'
+        last_row = -1
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT row, {'content' if include_content else 'NULL'}, metadata FROM chunks "
+                    "WHERE row > ? ORDER BY row LIMIT ?", (last_row, page_size)).fetchall()
+            if not rows:
+                return
+            yield [Document(page_content=content or '', metadata=json.loads(metadata))
+                   for _, content, metadata in rows]
+            last_row = rows[-1][0]
+
+    def get_files(self) -> Dict[str, int]:
+        'Get the number of chunks of every file of the store'
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT filename, COUNT(*) FROM chunks WHERE filename IS NOT NULL GROUP BY filename'))
+
+    def get_file_keys(self, filename: str) -> List[str]:
+        'Get the keys of the chunks of a file'
+        with self.lock:
+            return [key for key, in self.connection.execute(
+                'SELECT key FROM chunks WHERE filename = ? ORDER BY key', (filename,))]
+
+    def delete_file(self, filename: str) -> int:
+        'Delete all the chunks of a file, return the number of chunks deleted'
+        keys = self.get_file_keys(filename)
+        self.delete_keys(keys)
+        return len(keys)
+
+    def delete_all(self) -> None:
+        'Delete every chunk of the store'
+        with self.lock:
+            keys = [key for key, in self.connection.execute('SELECT key FROM chunks')]
+        self.delete_keys(keys)
+
+    def get_chunk_hashes(self, filename: str) -> Dict[str, str]:
+        'Get the content hash of every chunk stored for a file'
+        with self.lock:
+            return {key: json.loads(metadata).get('content_hash', '')
+                    for key, metadata in self.connection.execute(
+                        'SELECT key, metadata FROM chunks WHERE filename = ?', (filename,))}
+
+    @classmethod
+    def from_texts(
+        cls: Type[NumpyVectorStore],
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        path: str = os.path.join('.cache', 'vectorstore'),
+        index_name: str = 'embeddings',
+        **kwargs: Any,
+    ) -> NumpyVectorStore:
+        'Create a store from a list of texts'
+        store = cls(path, index_name, embedding.embed_query)
+        store.add_texts(texts, metadatas, embeddings=embedding.embed_documents(texts), **kwargs)
+        return store
@@ -0,0 +1,125 @@
+'''Helper functions to stay within the Azure OpenAI quota'''
+
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, TypeVar
+
+import openai
+from dotenv import load_dotenv
+
+logger = logging.getLogger()
+
+T = TypeVar('T')
+
+
+# Throttling and transient errors retried on both paths, like the langchain embeddings did
+RETRIED_ERRORS = (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIError,
+                  openai.error.APIConnectionError, openai.error.ServiceUnavailableError)
+
+
+class AsyncTokenBucket:
+    'Token bucket limiting the requests and the tokens sent per minute'
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        # Fraction of the quota in use, lowered when the service throttles us
+        self.rate_scale = 1.0
+        self.tokens = float(tokens_per_minute)
+        self.requests = float(requests_per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        'Add the tokens and requests earned since the last update'
+        now = time.monotonic()
+        elapsed = (now - self.updated) / 60
+        self.updated = now
+        self.tokens = min(self.tokens_per_minute * self.rate_scale,
+                          self.tokens + elapsed * self.tokens_per_minute * self.rate_scale)
+        self.requests = min(self.requests_per_minute * self.rate_scale,
+                            self.requests + elapsed * self.requests_per_minute * self.rate_scale)
+
+    async def acquire(self, tokens: int):
+        'Wait until a request of the given size fits in the quota'
+        while True:
+            # No await between the check and the update, so no lock is needed on a single loop
+            self.refill()
+            capacity = self.tokens_per_minute * self.rate_scale
+            tokens_needed = min(tokens, capacity)
+            if self.tokens >= tokens_needed and self.requests >= 1:
+                self.tokens -= tokens_needed
+                self.requests -= 1
+                return
+            wait = max((tokens_needed - self.tokens) / capacity,
+                       (1 - self.requests) / (self.requests_per_minute * self.rate_scale)) * 60
+            await asyncio.sleep(max(wait, 0.01))
+
+    def throttle(self):
+        'Halve the rate after a 429 response'
+        self.rate_scale = max(0.1, self.rate_scale / 2)
+        self.tokens = min(self.tokens, self.tokens_per_minute * self.rate_scale)
+        self.requests = min(self.requests, self.requests_per_minute * self.rate_scale)
+        logger.warning('Azure OpenAI throttled the requests, rate lowered to %.0f%% of the quota',
+                       self.rate_scale * 100)
+
+    def recover(self):
+        'Slowly increase the rate back after a successful request'
+        self.rate_scale = min(1.0, self.rate_scale + 0.05)
+
+
+async def call_with_backoff(limiter: AsyncTokenBucket,
+                            request: Callable[[], Awaitable[T]],
+                            tokens: int,
+                            max_retries: int = 6) -> T:
+    'Run a rate limited request, backing off when the service throttles or fails transiently'
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(tokens)
+        try:
+            result = await request()
+            limiter.recover()
+            return result
+        except RETRIED_ERRORS as exc:
+            # Only throttling lowers the rate, a transient failure is just retried
+            if isinstance(exc, openai.error.RateLimitError):
+                limiter.throttle()
+            if attempt == max_retries:
+                raise
+            headers = getattr(exc, 'headers', None) or {}
+            retry_after = headers.get('retry-after')
+            delay = float(retry_after) if retry_after else \
+                min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+            await asyncio.sleep(delay)
+
+
+def call_with_retry(request: Callable[[], T], max_retries: int = 6) -> T:
+    'Run a blocking request, backing off when the service throttles or fails transiently'
+    for attempt in range(max_retries + 1):
+        try:
+            return request()
+        except RETRIED_ERRORS as exc:
+            if attempt == max_retries:
+                raise
+            headers = getattr(exc, 'headers', None) or {}
+            retry_after = headers.get('retry-after')
+            delay = float(retry_after) if retry_after else \
+                min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.warning('Azure OpenAI request failed (%s), retrying in %.1f seconds', exc, delay)
+            time.sleep(delay)
+
+
+_limiters = {}
+
+
+def get_rate_limiter(engine: str, purpose: str = 'documents') -> AsyncTokenBucket:
+    'Get the process wide rate limiter of an Azure OpenAI deployment for documents or queries'
+    if (engine, purpose) not in _limiters:
+        load_dotenv()
+        # Queries have their own budget so that a large ingestion does not delay the chat answers
+        prefix = 'OPENAI_QUERY_EMBEDDINGS' if purpose == 'query' else 'OPENAI_EMBEDDINGS'
+        defaults = (60000, 360) if purpose == 'query' else (240000, 1440)
+        _limiters[(engine, purpose)] = AsyncTokenBucket(
+            tokens_per_minute=int(os.getenv(f'{prefix}_TPM', defaults[0])),
+            requests_per_minute=int(os.getenv(f'{prefix}_RPM', defaults[1])))
+    return _limiters[(engine, purpose)]
@@ -1,16 +1,108 @@
 '''Helper function for Redis'''
 
+import os
+import re
+import json
 import logging
-from typing import Any, Callable, List
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from langchain.vectorstores.redis import Redis
-import pandas as pd
+import numpy as np
+import redis.asyncio
+from langchain.docstore.document import Document
 from redis.commands.search.query import Query
+from redis.commands.search.aggregation import AggregateRequest
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.commands.search.field import VectorField, TextField
+from redis.commands.search.field import VectorField, TextField, TagField, NumericField
+from redis.exceptions import ResponseError
+from utilities.filters import normalize_filters
 
 logger = logging.getLogger()
 
+VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16}
+
+# Group of the chunks readable by everyone, a tag field cannot match a missing value
+PUBLIC_GROUP = "public"
+
+
+def get_vector_index_settings() -> dict:
+    'Settings of the vector index configured with the REDIS_INDEX_* and REDIS_VECTOR_* variables'
+    return {
+        "algorithm": os.getenv("REDIS_INDEX_ALGORITHM", "HNSW").upper(),
+        "vector_type": os.getenv("REDIS_VECTOR_TYPE", "FLOAT32").upper(),
+        "dimensions": int(os.getenv("REDIS_VECTOR_DIMENSIONS", 1536)),
+        "initial_cap": int(os.getenv("REDIS_INDEX_INITIAL_CAP", 10000)),
+        "m": int(os.getenv("REDIS_INDEX_M", 16)),
+        "ef_construction": int(os.getenv("REDIS_INDEX_EF_CONSTRUCTION", 200)),
+        "ef_runtime": int(os.getenv("REDIS_INDEX_EF_RUNTIME", 10)),
+    }
+
+
+def create_vector_field(name: str, settings: dict, distance_metric: str = "COSINE") -> VectorField:
+    'Vector field of an index with the given settings'
+    attributes = {
+        "TYPE": settings["vector_type"],
+        "DIM": settings["dimensions"],
+        "DISTANCE_METRIC": distance_metric,
+        "INITIAL_CAP": settings["initial_cap"],
+    }
+    if settings["algorithm"] == "HNSW":
+        attributes.update({
+            "M": settings["m"],
+            "EF_CONSTRUCTION": settings["ef_construction"],
+            "EF_RUNTIME": settings["ef_runtime"],
+        })
+    return VectorField(name, settings["algorithm"], attributes)
+
+
+def knn_query(k: int, settings: dict, vector_field: str = "content_vector", filters: str = "*") -> str:
+    'Query string of a KNN search, with the EF_RUNTIME of the settings on HNSW indexes'
+    ef_runtime = f" EF_RUNTIME {settings['ef_runtime']}" if settings["algorithm"] == "HNSW" else ""
+    return f"{filters}=>[KNN {k} @{vector_field} $vector{ef_runtime} AS vector_score]"
+
+
+def create_filter_fields() -> list:
+    'Fields of the metadata the KNN queries can be pre-filtered on'
+    return [
+        TagField("filename", separator="|"),
+        TagField("tags"),
+        TagField("groups"),
+        NumericField("ingest_date"),
+    ]
+
+
+def get_filter_values(metadata: dict) -> dict:
+    'Values of the filter fields of a chunk'
+    return {
+        "filename": metadata.get("filename", ""),
+        "tags": ",".join(metadata.get("tags", [])),
+        "groups": ",".join(metadata.get("groups", [])) or PUBLIC_GROUP,
+        "ingest_date": metadata.get("ingest_date", 0),
+    }
+
+
+def escape_tag(value: str) -> str:
+    'Escape the punctuation and spaces of a tag value'
+    return re.sub(r"([^\w])", r"\\\1", value)
+
+
+def filter_query(filters: dict) -> str:
+    'Pre-filter of a KNN query matching the filters'
+    filters = normalize_filters(filters)
+    clauses = []
+    for name, field in (("filenames", "filename"), ("tags", "tags")):
+        if name in filters:
+            clauses.append(f"@{field}:{{{'|'.join(escape_tag(value) for value in filters[name])}}}")
+    if "groups" in filters:
+        groups = filters["groups"] + [PUBLIC_GROUP]
+        clauses.append(f"@groups:{{{'|'.join(escape_tag(value) for value in groups)}}}")
+    if "ingested_after" in filters or "ingested_before" in filters:
+        after, before = filters.get("ingested_after", "-inf"), filters.get("ingested_before", "+inf")
+        clauses.append(f"@ingest_date:[{after} {before}]")
+    return f"({' '.join(clauses)})" if clauses else "*"
+
+
 class RedisExtended(Redis):
     'Helper class for Redis'
     def __init__(
@@ -18,9 +110,15 @@ class RedisExtended(Redis):
         redis_url: str,
         index_name: str,
         embedding_function: Callable,
+        index_settings: dict = None,
         **kwargs: Any,
     ):
         super().__init__(redis_url, index_name, embedding_function)
+        # Client of the async searches, it only connects on the first one
+        self.async_client = redis.asyncio.from_url(redis_url)
+        # Changing the vector type or the dimensions requires creating the index again
+        self.index_settings = get_vector_index_settings() if index_settings is None else index_settings
+        self.vector_dtype = VECTOR_DTYPES[self.index_settings["vector_type"]]
 
         # Check if index exists
         try:
@@ -31,11 +129,15 @@ class RedisExtended(Redis):
             self.create_prompt_index()
 
         try:
-            self.client.ft(self.index_name).info()
+            info = self.client.ft(self.index_name).info()
         # pylint disable=bare-except
         except:
             # Create Redis Index
             self.create_index()
+            self.client.set(self.file_keys_rebuilt_name(), 1)
+        else:
+            self.add_filter_fields(info)
+            self.ensure_file_keys()
 
     def check_existing_index(self, index_name: str = ''):
         'Check if the index exists'
@@ -46,33 +148,276 @@ class RedisExtended(Redis):
         except:
             return False
 
-    def delete_keys(self, keys: List[str]) -> None:
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        embeddings: Optional[List[List[float]]] = None,
+        keys: Optional[List[str]] = None,
+        batch_size: int = 1000,
+        **kwargs: Any,
+    ) -> List[str]:
+        'Add texts to Redis, using the precomputed embeddings when provided'
+        ids = []
+        pipeline = self.client.pipeline(transaction=False)
+        for i, text in enumerate(texts):
+            # Use provided values by default or fallback
+            key = keys[i] if keys else f"doc:{self.index_name}:{uuid.uuid4().hex}"
+            metadata = metadatas[i] if metadatas else {}
+            embedding = embeddings[i] if embeddings else self.embedding_function(text)
+            pipeline.hset(
+                key,
+                mapping={
+                    "content": text,
+                    "content_vector": np.array(embedding, dtype=self.vector_dtype).tobytes(),
+                    "metadata": json.dumps(metadata),
+                    **get_filter_values(metadata)
+                }
+            )
+            # Track the chunks of each file
+            if metadata.get("filename"):
+                pipeline.sadd(self.file_keys_name(metadata["filename"]), key)
+            ids.append(key)
+            # Write batch
+            if (i + 1) % batch_size == 0:
+                pipeline.execute()
+        # Cleanup final batch
+        pipeline.execute()
+        return ids
+
+    def delete_keys(self, keys: List[str], batch_size: int = 1000) -> None:
         'Delete keys from Redis'
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            filenames = self.get_filenames(batch)
+            # UNLINK frees the memory in the background and one pipeline saves a round-trip per key,
+            # one key per command so the keys can live in different cluster slots
+            pipeline = self.client.pipeline(transaction=False)
+            for key in batch:
+                pipeline.unlink(key)
+            for key, filename in filenames.items():
+                if filename:
+                    pipeline.srem(self.file_keys_name(filename), key)
+            pipeline.execute()
+
+    def file_keys_name(self, filename: str) -> str:
+        'Name of the set holding the keys of the chunks of a file'
+        return f"filekeys:{self.index_name}:{filename}"
+
+    def get_filenames(self, keys: List[str]) -> Dict[str, str]:
+        'Get the filename stored in the metadata of each key'
+        pipeline = self.client.pipeline(transaction=False)
         for key in keys:
-            self.client.delete(key)
+            pipeline.hget(key, "metadata")
+        filenames = {}
+        # Keys which are not hashes answer with an error instead of a metadata
+        for key, metadata in zip(keys, pipeline.execute(raise_on_error=False)):
+            if isinstance(metadata, (bytes, str)):
+                filenames[key] = json.loads(metadata).get("filename")
+        return filenames
+
+    def get_files(self) -> Dict[str, int]:
+        'Get the number of chunks of every file of the index'
+        prefix = self.file_keys_name("")
+        names = [name for batch in self.scan_keys(f"{prefix}*") for name in batch]
+        pipeline = self.client.pipeline(transaction=False)
+        for name in names:
+            pipeline.scard(name)
+        names = [name.decode("utf-8") if isinstance(name, bytes) else name for name in names]
+        return {name[len(prefix):]: count for name, count in zip(names, pipeline.execute()) if count}
+
+    def get_file_keys(self, filename: str) -> List[str]:
+        'Get the keys of the chunks of a file'
+        return sorted(key.decode("utf-8") if isinstance(key, bytes) else key
+                      for key in self.client.smembers(self.file_keys_name(filename)))
+
+    def delete_file(self, filename: str, batch_size: int = 1000) -> int:
+        'Delete all the chunks of a file, return the number of chunks deleted'
+        set_name = self.file_keys_name(filename)
+        deleted = 0
+        # SSCAN keeps Redis responsive on large files, one key per UNLINK stays cluster compatible
+        pipeline = self.client.pipeline(transaction=False)
+        for key in self.client.sscan_iter(set_name, count=batch_size):
+            pipeline.unlink(key)
+            deleted += 1
+            if deleted % batch_size == 0:
+                pipeline.execute()
+        pipeline.unlink(set_name)
+        pipeline.execute()
+        return deleted
+
+    def delete_all(self) -> None:
+        'Delete every chunk of the index, also the ones of no file, and the sets of keys of the files'
+        for pattern in (f"doc:{self.index_name}:*", self.file_keys_name("*")):
+            for keys in self.scan_keys(pattern):
+                pipeline = self.client.pipeline(transaction=False)
+                for key in keys:
+                    pipeline.unlink(key)
+                pipeline.execute()
+
+    def file_keys_rebuilt_name(self) -> str:
+        'Name of the marker set once the sets of keys of the files hold every chunk of the index'
+        return f"filekeys-rebuilt:{self.index_name}"
+
+    def ensure_file_keys(self) -> None:
+        'Backfill the sets of keys of the files once, for the chunks written before the files were tracked'
+        if self.client.exists(self.file_keys_rebuilt_name()):
+            return
+        # Adding a key twice is harmless, processes starting together may both run it
+        self.rebuild_file_keys()
+        self.client.set(self.file_keys_rebuilt_name(), 1)
+
+    def rebuild_file_keys(self) -> None:
+        'Rebuild the sets of keys of every file from the documents of the index'
+        for documents in self.iter_documents(include_content=False):
+            pipeline = self.client.pipeline(transaction=False)
+            for document in documents:
+                if document.metadata.get("filename"):
+                    pipeline.sadd(self.file_keys_name(document.metadata["filename"]),
+                                  document.metadata["key"])
+            pipeline.execute()
+
+    def get_chunk_hashes(self, filename: str) -> Dict[str, str]:
+        'Get the content hash of every chunk stored for a file'
+        set_name = self.file_keys_name(filename)
+        keys = [key.decode("utf-8") if isinstance(key, bytes) else key
+                for key in self.client.smembers(set_name)]
+        if not keys:
+            # Chunks written before the files were tracked are only found by their filename
+            keys = self.search_file_keys(filename)
+            if keys:
+                self.client.sadd(set_name, *keys)
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, "metadata")
+        hashes = {}
+        missing = []
+        for key, metadata in zip(keys, pipeline.execute()):
+            if metadata is None:
+                missing.append(key)
+            else:
+                hashes[key] = json.loads(metadata).get("content_hash", "")
+        # Forget the chunks deleted without going through delete_keys
+        if missing:
+            self.client.srem(set_name, *missing)
+        return hashes
+
+    def search_file_keys(self, filename: str, page_size: int = 1000) -> List[str]:
+        'Find the keys of the chunks of a file with the filename field of the index'
+        keys = []
+        while True:
+            query = Query(f"@filename:{{{escape_tag(filename)}}}").no_content()\
+                .paging(len(keys), page_size).dialect(2)
+            results = self.client.ft(self.index_name).search(query)
+            keys += [result.id for result in results.docs]
+            if len(results.docs) < page_size:
+                return keys
+
+    def scan_keys(self, pattern: str, batch_size: int = 1000) -> Iterator[List[str]]:
+        'Yield batches of keys matching the pattern without blocking Redis like KEYS'
+        batch = []
+        for key in self.client.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_documents(self, page_size: int = 1000,
+                       include_content: bool = True) -> Iterator[List[Document]]:
+        'Yield all the documents of the index in pages, without any embedding call'
+        fields = ["@__key", "@metadata", "@content"] if include_content else ["@__key", "@metadata"]
+        request = AggregateRequest("*").load(*fields).cursor(count=page_size)
+        result = self.client.ft(self.index_name).aggregate(request)
+        try:
+            while True:
+                documents = []
+                for row in result.rows:
+                    row = [value.decode("utf-8") if isinstance(value, bytes) else value for value in row]
+                    values = dict(zip(row[::2], row[1::2]))
+                    metadata = json.loads(values.get("metadata", "{}"))
+                    metadata.setdefault("key", values["__key"])
+                    documents.append(Document(page_content=values.get("content", ""), metadata=metadata))
+                if documents:
+                    yield documents
+                if not result.cursor or not result.cursor.cid:
+                    return
+                result = self.client.ft(self.index_name).aggregate(result.cursor)
+        finally:
+            # Free the cursor on the server when the caller stops early
+            if result.cursor and result.cursor.cid:
+                self.client.execute_command("FT.CURSOR", "DEL", self.index_name, result.cursor.cid)
 
     def delete_keys_pattern(self, pattern: str) -> None:
         'Delete keys from Redis based on pattern'
-        keys = self.client.keys(pattern)
-        self.delete_keys(keys)
+        for keys in self.scan_keys(pattern):
+            self.delete_keys(keys)
 
     def create_index(self, prefix = "doc", distance_metric:str="COSINE"):
         'Create Redis Index'
         content = TextField(name="content")
         metadata = TextField(name="metadata")
-        content_vector = VectorField("content_vector",
-                    "HNSW", {
-                        "TYPE": "FLOAT32",
-                        "DIM": 1536,
-                        "DISTANCE_METRIC": distance_metric,
-                        "INITIAL_CAP": 1000,
-                    })
+        content_vector = create_vector_field("content_vector", self.index_settings, distance_metric)
         # Create index
         self.client.ft(self.index_name).create_index(
-            fields = [content, metadata, content_vector],
+            fields = [content, metadata, content_vector] + create_filter_fields(),
             definition = IndexDefinition(prefix=[prefix], index_type=IndexType.HASH)
         )
 
+    def add_filter_fields(self, info: dict) -> None:
+        'Add the filter fields to an index created without them and fill them from the metadata'
+        names = {attribute[1].decode("utf-8") if isinstance(attribute[1], bytes) else attribute[1]
+                 for attribute in info["attributes"]}
+        fields = [field for field in create_filter_fields() if field.name not in names]
+        if not fields:
+            return
+        try:
+            self.client.ft(self.index_name).alter_schema_add(fields)
+        except ResponseError as exc:
+            # Another process added them first
+            logger.warning(f"Could not add the filter fields to {self.index_name}: {exc}")
+            return
+        for documents in self.iter_documents(include_content=False):
+            pipeline = self.client.pipeline(transaction=False)
+            for document in documents:
+                pipeline.hset(document.metadata["key"], mapping=get_filter_values(document.metadata))
+            pipeline.execute()
+
+    def build_filter(self, filters: dict) -> str:
+        'Pre-filter of the similarity search matching the filters'
+        return filter_query(filters)
+
+    def similarity_query(self, k: int, filters: str = "*") -> Query:
+        'KNN query of the k documents most similar to a vector among the ones matching the pre-filter'
+        return Query(knn_query(k, self.index_settings, filters=filters or "*"))\
+            .return_fields("metadata", "content", "vector_score")\
+            .sort_by("vector_score")\
+            .paging(0, k)\
+            .dialect(2)
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filters: str = "*") -> List[Tuple[Document, float]]:
+        'Return the documents most similar to the query among the ones matching the pre-filter'
+        embedding = self.embedding_function(query)
+        results = self.client.ft(self.index_name).search(
+            self.similarity_query(k, filters), {"vector": np.array(embedding, dtype=self.vector_dtype).tobytes()})
+        return [(Document(page_content=result.content, metadata=json.loads(result.metadata)),
+                 float(result.vector_score))
+                for result in results.docs]
+
+    async def asimilarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                           filters: str = "*") -> List[Document]:
+        'Return the documents most similar to the embedding without blocking the event loop'
+        results = await self.async_client.ft(self.index_name).search(
+            self.similarity_query(k, filters), {"vector": np.array(embedding, dtype=self.vector_dtype).tobytes()})
+        return [Document(page_content=result.content, metadata=json.loads(result.metadata))
+                for result in results.docs]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        'Return the documents most similar to the query'
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filters=kwargs.get("filters"))]
+
     # Prompt management
     def create_prompt_index(self, index_name="prompt-index", prefix = "prompt"):
         'Create Redis Index for prompt results'
@@ -96,8 +441,23 @@ class RedisExtended(Redis):
             }
         )
 
+    def add_prompt_results(self, results: List[dict]) -> None:
+        'Add many prompt results to Redis in a single round-trip'
+        pipeline = self.client.pipeline(transaction=False)
+        for result in results:
+            pipeline.hset(
+                f"prompt:{result['id']}",
+                mapping={
+                    "result": result['result'],
+                    "filename": result.get('filename', ''),
+                    "prompt": result.get('prompt', '')
+                }
+            )
+        pipeline.execute()
+
     def get_prompt_results(self, prompt_index_name="prompt-index", number_of_results: int=3155):
         'Get prompt results from Redis'
+        import pandas as pd
         base_query = '*'
         return_fields = ['id','result','filename','prompt']
         query = Query(base_query)\
@@ -0,0 +1,72 @@
+'''Helper functions to stream the answers token by token'''
+
+import json
+import queue
+import asyncio
+from typing import Any
+
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+
+# Markers the model uses to list the sources after the answer
+SOURCES_MARKERS = ['SOURCES:', 'Sources:', 'SOURCE:', 'Source:']
+
+
+def strip_sources(text: str) -> str:
+    'Remove the sources listed by the model after the answer'
+    for marker in SOURCES_MARKERS:
+        text = text.split(marker)[0]
+    return text
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    'Callback handler putting the new tokens of the language model in a queue'
+    def __init__(self, tokens: queue.Queue):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        'Queue a new token'
+        self.tokens.put(token)
+
+
+class AsyncQueueCallbackHandler(AsyncCallbackHandler):
+    'Callback handler putting the new tokens of the language model in an asyncio queue'
+    def __init__(self, tokens: asyncio.Queue):
+        self.tokens = tokens
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        'Queue a new token'
+        await self.tokens.put(token)
+
+
+class AnswerStreamer:
+    'Turn the raw tokens of the model into answer text, holding back what could be a sources marker'
+    def __init__(self):
+        self.text = ''
+        self.sent = 0
+        self.done = False
+
+    def add(self, token: str) -> str:
+        'Add a token, return the answer text that can be shown'
+        if self.done:
+            return ''
+        self.text += token
+        visible = strip_sources(self.text)
+        if len(visible) < len(self.text):
+            # The answer is complete once the model starts listing the sources
+            self.done = True
+            end = len(visible)
+        else:
+            end = max(self.sent, len(visible) - max(len(marker) for marker in SOURCES_MARKERS))
+        chunk, self.sent = visible[self.sent:end], end
+        return chunk
+
+    def flush(self) -> str:
+        'Return the answer text not shown yet'
+        visible = strip_sources(self.text)
+        chunk, self.sent = visible[self.sent:], len(visible)
+        return chunk
+
+
+def format_server_sent_event(event: str, data: Any) -> str:
+    'Format an event of a text/event-stream response'
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
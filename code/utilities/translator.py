@@ -1,13 +1,73 @@
 '''Helper functions for translation'''
 
 import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
 from urllib.parse import urlencode, urljoin
 import requests
 from dotenv import load_dotenv
 
+# Limits of a single Translator request
+MAX_ELEMENTS_PER_REQUEST = 1000
+MAX_CHARACTERS_PER_REQUEST = 50000
+# Boundaries a text over the character limit is split on, from the coarsest to the finest
+SPLIT_PATTERNS = (r'(\n\s*\n)', r'(?<=[.!?。！？])(\s+)', r'(\s+)')
+
 # pylint: disable=line-too-long
 default_languages = {"translation":{"af":{"name":"Afrikaans","nativeName":"Afrikaans","dir":"ltr"},"am":{"name":"Amharic","nativeName":"አማርኛ","dir":"ltr"},"ar":{"name":"Arabic","nativeName":"العربية","dir":"rtl"},"as":{"name":"Assamese","nativeName":"অসমীয়া","dir":"ltr"},"az":{"name":"Azerbaijani","nativeName":"Azərbaycan","dir":"ltr"},"ba":{"name":"Bashkir","nativeName":"Bashkir","dir":"ltr"},"bg":{"name":"Bulgarian","nativeName":"Български","dir":"ltr"},"bn":{"name":"Bangla","nativeName":"বাংলা","dir":"ltr"},"bo":{"name":"Tibetan","nativeName":"བོད་སྐད་","dir":"ltr"},"bs":{"name":"Bosnian","nativeName":"Bosnian","dir":"ltr"},"ca":{"name":"Catalan","nativeName":"Català","dir":"ltr"},"cs":{"name":"Czech","nativeName":"Čeština","dir":"ltr"},"cy":{"name":"Welsh","nativeName":"Cymraeg","dir":"ltr"},"da":{"name":"Danish","nativeName":"Dansk","dir":"ltr"},"de":{"name":"German","nativeName":"Deutsch","dir":"ltr"},"dsb":{"name":"Lower Sorbian","nativeName":"Dolnoserbšćina","dir":"ltr"},"dv":{"name":"Divehi","nativeName":"ދިވެހިބަސް","dir":"rtl"},"el":{"name":"Greek","nativeName":"Ελληνικά","dir":"ltr"},"en":{"name":"English","nativeName":"English","dir":"ltr"},"es":{"name":"Spanish","nativeName":"Español","dir":"ltr"},"et":{"name":"Estonian","nativeName":"Eesti","dir":"ltr"},"eu":{"name":"Basque","nativeName":"Euskara","dir":"ltr"},"fa":{"name":"Persian","nativeName":"فارسی","dir":"rtl"},"fi":{"name":"Finnish","nativeName":"Suomi","dir":"ltr"},"fil":{"name":"Filipino","nativeName":"Filipino","dir":"ltr"},"fj":{"name":"Fijian","nativeName":"Na Vosa Vakaviti","dir":"ltr"},"fo":{"name":"Faroese","nativeName":"Føroyskt","dir":"ltr"},"fr":{"name":"French","nativeName":"Français","dir":"ltr"},"fr-CA":{"name":"French (Canada)","nativeName":"Français (Canada)","dir":"ltr"},"ga":{"name":"Irish","nativeName":"Gaeilge","dir":"ltr"},"gl":{"name":"Galician","nativeName":"Galego","dir":"ltr"},"gom":{"name":"Konkani","nativeName":"Konkani","dir":"ltr"},"gu":{"name":"Gujarati","nativeName":"ગુજરાતી","dir":"ltr"},"ha":{"name":"Hausa","nativeName":"Hausa","dir":"ltr"},"he":{"name":"Hebrew","nativeName":"עברית","dir":"rtl"},"hi":{"name":"Hindi","nativeName":"हिन्दी","dir":"ltr"},"hr":{"name":"Croatian","nativeName":"Hrvatski","dir":"ltr"},"hsb":{"name":"Upper Sorbian","nativeName":"Hornjoserbšćina","dir":"ltr"},"ht":{"name":"Haitian Creole","nativeName":"Haitian Creole","dir":"ltr"},"hu":{"name":"Hungarian","nativeName":"Magyar","dir":"ltr"},"hy":{"name":"Armenian","nativeName":"Հայերեն","dir":"ltr"},"id":{"name":"Indonesian","nativeName":"Indonesia","dir":"ltr"},"ig":{"name":"Igbo","nativeName":"Ásụ̀sụ́ Ìgbò","dir":"ltr"},"ikt":{"name":"Inuinnaqtun","nativeName":"Inuinnaqtun","dir":"ltr"},"is":{"name":"Icelandic","nativeName":"Íslenska","dir":"ltr"},"it":{"name":"Italian","nativeName":"Italiano","dir":"ltr"},"iu":{"name":"Inuktitut","nativeName":"ᐃᓄᒃᑎᑐᑦ","dir":"ltr"},"iu-Latn":{"name":"Inuktitut (Latin)","nativeName":"Inuktitut (Latin)","dir":"ltr"},"ja":{"name":"Japanese","nativeName":"日本語","dir":"ltr"},"ka":{"name":"Georgian","nativeName":"ქართული","dir":"ltr"},"kk":{"name":"Kazakh","nativeName":"Қазақ Тілі","dir":"ltr"},"km":{"name":"Khmer","nativeName":"ខ្មែរ","dir":"ltr"},"kmr":{"name":"Kurdish (Northern)","nativeName":"Kurdî (Bakur)","dir":"ltr"},"kn":{"name":"Kannada","nativeName":"ಕನ್ನಡ","dir":"ltr"},"ko":{"name":"Korean","nativeName":"한국어","dir":"ltr"},"ku":{"name":"Kurdish (Central)","nativeName":"Kurdî (Navîn)","dir":"rtl"},"ky":{"name":"Kyrgyz","nativeName":"Кыргызча","dir":"ltr"},"ln":{"name":"Lingala","nativeName":"Lingála","dir":"ltr"},"lo":{"name":"Lao","nativeName":"ລາວ","dir":"ltr"},"lt":{"name":"Lithuanian","nativeName":"Lietuvių","dir":"ltr"},"lug":{"name":"Ganda","nativeName":"Ganda","dir":"ltr"},"lv":{"name":"Latvian","nativeName":"Latviešu","dir":"ltr"},"lzh":{"name":"Chinese (Literary)","nativeName":"中文 (文言文)","dir":"ltr"},"mai":{"name":"Maithili","nativeName":"Maithili","dir":"ltr"},"mg":{"name":"Malagasy","nativeName":"Malagasy","dir":"ltr"},"mi":{"name":"Māori","nativeName":"Te Reo Māori","dir":"ltr"},"mk":{"name":"Macedonian","nativeName":"Македонски","dir":"ltr"},"ml":{"name":"Malayalam","nativeName":"മലയാളം","dir":"ltr"},"mn-Cyrl":{"name":"Mongolian (Cyrillic)","nativeName":"Mongolian (Cyrillic)","dir":"ltr"},"mn-Mong":{"name":"Mongolian (Traditional)","nativeName":"ᠮᠣᠩᠭᠣᠯ ᠬᠡᠯᠡ","dir":"ltr"},"mr":{"name":"Marathi","nativeName":"मराठी","dir":"ltr"},"ms":{"name":"Malay","nativeName":"Melayu","dir":"ltr"},"mt":{"name":"Maltese","nativeName":"Malti","dir":"ltr"},"mww":{"name":"Hmong Daw","nativeName":"Hmong Daw","dir":"ltr"},"my":{"name":"Myanmar (Burmese)","nativeName":"မြန်မာ","dir":"ltr"},"nb":{"name":"Norwegian","nativeName":"Norsk Bokmål","dir":"ltr"},"ne":{"name":"Nepali","nativeName":"नेपाली","dir":"ltr"},"nl":{"name":"Dutch","nativeName":"Nederlands","dir":"ltr"},"nso":{"name":"Sesotho sa Leboa","nativeName":"Sesotho sa Leboa","dir":"ltr"},"nya":{"name":"Nyanja","nativeName":"Nyanja","dir":"ltr"},"or":{"name":"Odia","nativeName":"ଓଡ଼ିଆ","dir":"ltr"},"otq":{"name":"Querétaro Otomi","nativeName":"Hñähñu","dir":"ltr"},"pa":{"name":"Punjabi","nativeName":"ਪੰਜਾਬੀ","dir":"ltr"},"pl":{"name":"Polish","nativeName":"Polski","dir":"ltr"},"prs":{"name":"Dari","nativeName":"دری","dir":"rtl"},"ps":{"name":"Pashto","nativeName":"پښتو","dir":"rtl"},"pt":{"name":"Portuguese (Brazil)","nativeName":"Português (Brasil)","dir":"ltr"},"pt-PT":{"name":"Portuguese (Portugal)","nativeName":"Português (Portugal)","dir":"ltr"},"ro":{"name":"Romanian","nativeName":"Română","dir":"ltr"},"ru":{"name":"Russian","nativeName":"Русский","dir":"ltr"},"run":{"name":"Rundi","nativeName":"Rundi","dir":"ltr"},"rw":{"name":"Kinyarwanda","nativeName":"Kinyarwanda","dir":"ltr"},"sd":{"name":"Sindhi","nativeName":"سنڌي","dir":"ltr"},"si":{"name":"Sinhala","nativeName":"සිංහල","dir":"ltr"},"sk":{"name":"Slovak","nativeName":"Slovenčina","dir":"ltr"},"sl":{"name":"Slovenian","nativeName":"Slovenščina","dir":"ltr"},"sm":{"name":"Samoan","nativeName":"Gagana Sāmoa","dir":"ltr"},"sn":{"name":"Shona","nativeName":"chiShona","dir":"ltr"},"so":{"name":"Somali","nativeName":"Soomaali","dir":"ltr"},"sq":{"name":"Albanian","nativeName":"Shqip","dir":"ltr"},"sr-Cyrl":{"name":"Serbian (Cyrillic)","nativeName":"Српски (ћирилица)","dir":"ltr"},"sr-Latn":{"name":"Serbian (Latin)","nativeName":"Srpski (latinica)","dir":"ltr"},"st":{"name":"Sesotho","nativeName":"Sesotho","dir":"ltr"},"sv":{"name":"Swedish","nativeName":"Svenska","dir":"ltr"},"sw":{"name":"Swahili","nativeName":"Kiswahili","dir":"ltr"},"ta":{"name":"Tamil","nativeName":"தமிழ்","dir":"ltr"},"te":{"name":"Telugu","nativeName":"తెలుగు","dir":"ltr"},"th":{"name":"Thai","nativeName":"ไทย","dir":"ltr"},"ti":{"name":"Tigrinya","nativeName":"ትግር","dir":"ltr"},"tk":{"name":"Turkmen","nativeName":"Türkmen Dili","dir":"ltr"},"tlh-Latn":{"name":"Klingon (Latin)","nativeName":"Klingon (Latin)","dir":"ltr"},"tlh-Piqd":{"name":"Klingon (pIqaD)","nativeName":"Klingon (pIqaD)","dir":"ltr"},"tn":{"name":"Setswana","nativeName":"Setswana","dir":"ltr"},"to":{"name":"Tongan","nativeName":"Lea Fakatonga","dir":"ltr"},"tr":{"name":"Turkish","nativeName":"Türkçe","dir":"ltr"},"tt":{"name":"Tatar","nativeName":"Татар","dir":"ltr"},"ty":{"name":"Tahitian","nativeName":"Reo Tahiti","dir":"ltr"},"ug":{"name":"Uyghur","nativeName":"ئۇيغۇرچە","dir":"rtl"},"uk":{"name":"Ukrainian","nativeName":"Українська","dir":"ltr"},"ur":{"name":"Urdu","nativeName":"اردو","dir":"rtl"},"uz":{"name":"Uzbek (Latin)","nativeName":"Uzbek (Latin)","dir":"ltr"},"vi":{"name":"Vietnamese","nativeName":"Tiếng Việt","dir":"ltr"},"xh":{"name":"Xhosa","nativeName":"isiXhosa","dir":"ltr"},"yo":{"name":"Yoruba","nativeName":"Èdè Yorùbá","dir":"ltr"},"yua":{"name":"Yucatec Maya","nativeName":"Yucatec Maya","dir":"ltr"},"yue":{"name":"Cantonese (Traditional)","nativeName":"粵語 (繁體)","dir":"ltr"},"zh-Hans":{"name":"Chinese Simplified","nativeName":"中文 (简体)","dir":"ltr"},"zh-Hant":{"name":"Chinese Traditional","nativeName":"繁體中文 (繁體)","dir":"ltr"},"zu":{"name":"Zulu","nativeName":"Isi-Zulu","dir":"ltr"}}}
 
+class LRUCache:
+    'Thread safe least recently used cache'
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        'Get an item, None when missing'
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        'Add an item, evicting the least recently used one when full'
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+# Shared by all the clients so translations survive the Streamlit reruns
+_translation_cache = LRUCache(int(os.getenv('TRANSLATION_CACHE_SIZE', 1024)))
+
+def split_text(text, limit=MAX_CHARACTERS_PER_REQUEST, level=0):
+    '''Split a text over the character limit on paragraph, then sentence and word boundaries.
+
+    Return the pieces with the separator following each, the translated pieces are joined with them.
+    '''
+    if len(text) <= limit:
+        return [(text, '')]
+    if level == len(SPLIT_PATTERNS):
+        return [(text[i:i + limit], '') for i in range(0, len(text), limit)]
+    parts = re.split(SPLIT_PATTERNS[level], text)
+    units = []
+    for i in range(0, len(parts), 2):
+        sub_units = split_text(parts[i], limit, level + 1)
+        sub_units[-1] = (sub_units[-1][0], sub_units[-1][1] + (parts[i + 1] if i + 1 < len(parts) else ''))
+        units.extend(sub_units)
+    # Merge the consecutive units back in pieces as large as the limit allows
+    pieces = []
+    for unit, separator in units:
+        if pieces and len(pieces[-1][0]) + len(pieces[-1][1]) + len(unit) <= limit:
+            pieces[-1] = (pieces[-1][0] + pieces[-1][1] + unit, separator)
+        else:
+            pieces.append((unit, separator))
+    return pieces
+
 class AzureTranslatorClient:
     'Azure Translator Client'
     def __init__(self, translate_key=None, translate_region=None, translate_endpoint=None):
@@ -30,41 +90,72 @@ class AzureTranslatorClient:
             self.translate_endpoint = urljoin(self.translate_endpoint,
                                               f"/translator/text/v3.0/translate?api-version={self.api_version}")
 
-
-    def translate(self, text, language='en'):
-        'Translates text to the specified language'
-        headers = {
+        self.headers = {
             'Ocp-Apim-Subscription-Key': self.translate_key,
             'Ocp-Apim-Subscription-Region': self.translate_region,
             'Content-type': 'application/json'
         }
-        params = urlencode({})
-        body = [{
-            'text': text
-        }]
-        request = requests.post(self.detect_endpoint,
-                                params=params,
-                                headers=headers,
-                                json=body,
-                                timeout=120)
-        response = request.json()
-        if response[0]['language'] != language:
-            params = urlencode({
-                'from': response[0]['language'],
-                'to': language
-            })
-            body = [{
-                'text': text
-            }]
-            request = requests.post(self.translate_endpoint,
-                                    params=params,
-                                    headers=headers,
-                                    json=body,
-                                    timeout=120)
-            response = request.json()
-            return response[0]['translations'][0]['text']
+        # Reuse the connections across requests
+        self.session = requests.Session()
+
 
-        return text
+    def translate(self, text, language='en'):
+        'Translates text to the specified language'
+        return self.translate_batch([text], language)[0]
+
+    def translate_batch(self, texts, language='en', source_language=None):
+        'Translates many texts to the specified language, packing them in as few requests as possible'
+        results = [None] * len(texts)
+        cache_keys = [(hashlib.sha1(text.encode('utf-8')).hexdigest(), language) for text in texts]
+        missing = []
+        for i, cache_key in enumerate(cache_keys):
+            cached = _translation_cache.get(cache_key)
+            if cached is not None:
+                results[i] = cached
+            else:
+                missing.append(i)
+        # Texts over the character limit of a request are translated in pieces
+        pieces = [(i, piece, separator) for i in missing for piece, separator in split_text(texts[i])]
+        translated = {i: [] for i in missing}
+        for batch in self.get_batches([piece for _, piece, _ in pieces]):
+            for j, translation in zip(batch, self.post_translate([pieces[j][1] for j in batch], language, source_language)):
+                translated[pieces[j][0]].append(translation + pieces[j][2])
+        for i in missing:
+            results[i] = ''.join(translated[i])
+            _translation_cache.put(cache_keys[i], results[i])
+        return results
+
+    def get_batches(self, texts):
+        'Yield lists of indexes of texts respecting the element and character limits of a request'
+        batch, batch_size = [], 0
+        for i, text in enumerate(texts):
+            if batch and (len(batch) == MAX_ELEMENTS_PER_REQUEST or batch_size + len(text) > MAX_CHARACTERS_PER_REQUEST):
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(i)
+            batch_size += len(text)
+        if batch:
+            yield batch
+
+    def post_translate(self, texts, language, source_language=None):
+        'Translate a batch of texts with a single request, detecting the source language when not known'
+        params = {'to': language}
+        if source_language:
+            params['from'] = source_language
+        request = self.session.post(self.translate_endpoint,
+                                    params=urlencode(params),
+                                    headers=self.headers,
+                                    json=[{'text': text} for text in texts],
+                                    timeout=120)
+        request.raise_for_status()
+        translations = []
+        for text, response in zip(texts, request.json()):
+            # Keep the original text when it is already in the requested language
+            if response.get('detectedLanguage', {}).get('language') == language:
+                translations.append(text)
+            else:
+                translations.append(response['translations'][0]['text'])
+        return translations
 
     def get_available_languages(self):
         'Get available languages'